@@ -21,7 +21,6 @@ setup(
     'pandas',
     'peakutils',
     'photutils',
-    'pysynphot',
     'importlib-metadata; python_version >= "3.8"',
     'scipy',
     'xarray'
@@ -5,22 +5,27 @@ import numpy as np
 import batman
 import george
 from george import kernels
-from scipy import optimize,stats
+from scipy import optimize,stats,linalg
 import matplotlib.pyplot as plt
+from collections import OrderedDict
 from Tiberius.src.fitting_utils import parametric_fitting_functions as pf
 from Tiberius.src.fitting_utils import plotting_utils as pu
+from Tiberius.src.fitting_utils import semiseparable_gp as sgp
+
+# The steps used to calculate the derivatives of the batman light curve by central differences, in the units of each parameter
+batman_fd_steps = {'t0':1e-5,'period':1e-6,'inc':1e-4,'aRs':1e-4,'ecc':1e-5,'omega':1e-3,'k':1e-6,'u1':1e-5,'u2':1e-5,'u3':1e-5,'u4':1e-5}
 
 class TransitModelGPPM(object):
-    def __init__(self,pars_dict,systematics_model_inputs,kernel_classes,flux_error,time_array,kernel_priors=None,wn_kernel=True,use_kipping=False,ld_std_priors=None,polynomial_orders=None,ld_law="quadratic",exp_ramp=False,exp_ramp_components=0,step_func=False):
+    def __init__(self,pars_dict,systematics_model_inputs,kernel_classes,flux_error,time_array,kernel_priors=None,wn_kernel=True,use_kipping=False,ld_std_priors=None,polynomial_orders=None,ld_law="quadratic",exp_ramp=False,exp_ramp_components=0,step_func=False,gp_cache_size=4,linear_poly_mode=None,poly_prior_width=None):
 
         """
-        The GPPM transit model class, which uses batman to generate the analytic, quadratically limb-darkened transit light curves, and george to generate the GP red noise models.
+        The GPPM transit model class, which uses batman to generate the analytic, quadratically limb-darkened transit light curves, and george (or semiseparable_gp for a single _celerite kernel) to generate the GP red noise models.
         However, this has the added option of fitting the time dependence with a polynomial, removing it as a parameter given to the GP. The thought behind this is that the GP has less to do, leading to smaller uncertainties in Rp/Rs.
 
         Inputs:
         pars_dict - the dictionary of the planet's transit parameters, as defined in gppm_fit.py:
         systematics_model_inputs - the ndarray of ancillary data parsed to the GP/polynomials, e.g. np.array([airmass,sky,time])
-        kernel_classes - the names of the kernels to be used (same length as systematics_model_inputs). If not using a GP, keep this as 'None'
+        kernel_classes - the names of the kernels to be used (same length as systematics_model_inputs). If not using a GP, keep this as 'None'. A single Matern32 or Exp kernel can be given a _celerite suffix (e.g. 'Matern32_celerite') to use the O(N) semiseparable_gp.SemiseparableGP instead of george
         flux_error - the errors on the flux data points to be fitted. It is not very satisfactory to parse these here but they are needed so that the can be added to the covariance matrix computed by the GP
         time_array - the array of time, defined here so that the batman model can be init upon the first call of the model
         kernel_priors - use this to define the upper and lower bounds on the kernel hyperparameters. Default=None, in which case the GP just places bounds such that the hyperparameters do not get computationally too large or small
@@ -33,6 +38,10 @@ class TransitModelGPPM(object):
         exp_ramp - True/False. Do you want to additionally fit a 2 component expoential ramp model? Default = False
         exp_ramp_components (int) - The number of exponential ramp components to fit. Default=0, no ramp.
         step_func - True/False. Do you want to additionally fit a step function model with arbitrary breakpoint? Default = False
+        gp_cache_size (int) - The number of computed GPs, keyed by their hyperparameters, that lnlike keeps so that models differing only in their transit/systematics parameters reuse the factorised covariance. Default = 4
+        linear_poly_mode - None/"solve"/"marginalise". The model is linear in the polynomial coefficients (c1,c2,...), so rather than being fitted parameters (if they're not fixed) these can be solved for by weighted least squares at every call of lnlike,
+                           which removes them from the free parameters. With "solve", the likelihood is that of the best fitting coefficients. With "marginalise", the coefficients are analytically marginalised over. Default=None (the coefficients are fitted parameters)
+        poly_prior_width - the standard deviation(s) of the Gaussian prior on the polynomial coefficients used by linear_poly_mode, centred on their starting values. Either a single value or one per coefficient. Default=None (uniform prior)
 
         Returns:
         TransitModelGPPM object
@@ -51,6 +60,13 @@ class TransitModelGPPM(object):
         self.exp_ramp_used = exp_ramp
         self.exp_ramp_components = exp_ramp_components
         self.step_func_used = step_func
+        self.linear_poly_mode = None
+
+        # the computed GPs used by lnlike, most recently used last
+        self.gp_cache_size = gp_cache_size
+        self.gp_cache = OrderedDict()
+        self.gp_cache_hits = 0
+        self.gp_cache_misses = 0
 
         # Acknowledge the fact that we're using a polynomial here
         if polynomial_orders is None:
@@ -61,6 +77,26 @@ class TransitModelGPPM(object):
                 self.poly_fixed = False
             else:
                 self.poly_fixed = True
+            # the powers of the inputs only need calculating once, so that each polynomial model is a single matrix-vector product
+            self.poly_design_matrix = pf.polynomial_design_matrix(systematics_model_inputs,polynomial_orders)
+
+            if linear_poly_mode is not None and not self.poly_fixed:
+                if linear_poly_mode not in ["solve","marginalise"]:
+                    raise ValueError('linear_poly_mode must be None, "solve" or "marginalise", not %s'%linear_poly_mode)
+                self.linear_poly_mode = linear_poly_mode
+
+                # the coefficients are solved for by lnlike, so are held as fixed values rather than Params
+                self.pars = pars_dict.copy()
+                ncoefficients = polynomial_orders.sum()+1
+                self.poly_prior_mean = np.array([self.pars['c%d'%i].startVal for i in range(1,ncoefficients+1)])
+                for i in range(1,ncoefficients+1):
+                    self.pars['c%d'%i] = float(self.poly_prior_mean[i-1])
+                self.poly_fixed = True
+
+                if poly_prior_width is None:
+                    self.poly_prior_precision = np.zeros(ncoefficients)
+                else:
+                    self.poly_prior_precision = np.ones(ncoefficients)/np.asarray(poly_prior_width,dtype=float)**2
 
         if exp_ramp:
             if type(pars_dict["r1"]) is Param:
@@ -213,6 +249,37 @@ class TransitModelGPPM(object):
         Returns:
         transitShape - the modelled transit light curve"""
 
+        transitShape = self.transit_shape(time)
+        model = transitShape
+
+        if self.poly_used: # then we're using a polynomial to fit systematics
+            red_noise_poly_model = self.red_noise_poly(time,sys_model_inputs)
+            model *= red_noise_poly_model
+
+        if self.exp_ramp_used:
+            exponential_ramp_model = self.exponential_ramp(time)
+            model *= exponential_ramp_model
+
+        if self.step_func_used:
+            step_model = self.step_function(time)
+            model *= step_model
+
+        if not self.poly_used and not self.exp_ramp_used and not self.step_func_used: # we're using a normalization constant to offset the transit depth
+            model *= self.pars['f'].currVal
+
+        return model
+
+
+    def transit_shape(self,time=None):
+
+        """Calculates the Mandel & Agol transit light curve alone for the current parameters, using batman.
+
+        Inputs:
+        time - the array of times at which to evaluate the model. Can be left blank if this has not changed from the initial init call.
+
+        Returns:
+        transitShape - the modelled transit light curve, without any systematics model"""
+
         if self.white_light_fit:
             self.batman_params.t0 = self.pars['t0'].currVal                       #time of inferior conjunction
             if not self.period_fixed:
@@ -267,24 +334,157 @@ class TransitModelGPPM(object):
                 self.batman_model = batman.TransitModel(self.batman_params, time, nthreads=1)
 
         transitShape = self.batman_model.light_curve(self.batman_params)
-        model = transitShape
 
-        if self.poly_used: # then we're using a polynomial to fit systematics
-            red_noise_poly_model = self.red_noise_poly(time,sys_model_inputs)
-            model *= red_noise_poly_model
+        return transitShape
+
+
+    def calc_batch(self,pars_array,time=None,sys_model_inputs=None):
+
+        """Calculates the model for many sets of parameters at once, e.g. for all walkers of an emcee ensemble. The transit light curves are calculated
+        by batman one set of parameters at a time, while the polynomial, exponential ramp, step function and normalisation models are evaluated for all sets
+        of parameters as single array operations. The model is left with the last set of parameters.
+
+        Inputs:
+        pars_array - the array of free parameter values with shape (nsets, npars), in the order of self.namelist
+        time - the array of times at which to evaluate the model. Can be left blank if this has not changed from the initial init call.
+        sys_model_inputs - the array of inputs to give the polynomials if fitting with polys. Can be left blank if this has not changed from the initial init call or you're not using polynomials.
+
+        Returns:
+        models - the modelled light curves with shape (nsets, ntimes)"""
+
+        pars_array = np.atleast_2d(pars_array)
+
+        transit_shapes = []
+        for pars in pars_array:
+            update_model(self,pars)
+            transit_shapes.append(self.transit_shape(time))
+        models = np.array(transit_shapes)
+
+        def parameter_values(name):
+            """the values of a parameter for every set of parameters, whether it's free or fixed"""
+            if name in self.namelist:
+                return pars_array[:,self.namelist.index(name)]
+            return np.full(len(pars_array),self.pars[name])
+
+        if time is None:
+            time = self.time_array
+
+        if self.poly_used:
+            red_noise_pars = np.array([parameter_values('c%d'%i) for i in range(1,self.polynomial_orders.sum()+2)]).T
+            models *= pf.systematics_model(red_noise_pars,None,self.polynomial_orders,design_matrix=self.polynomial_design_matrix(sys_model_inputs))
 
         if self.exp_ramp_used:
-            exponential_ramp_model = self.exponential_ramp(time)
-            model *= exponential_ramp_model
+            exponential_ramp_models = 1
+            for i in range(0,2*self.exp_ramp_components,2):
+                exponential_ramp_models += parameter_values('r%d'%(i+1))[:,None]*np.exp(parameter_values('r%d'%(i+2))[:,None]*time)
+            models *= exponential_ramp_models
 
         if self.step_func_used:
-            step_model = self.step_function(time)
-            model *= step_model
+            # the same indexing as step_model[:breakpoint] in step_function
+            ntimes = len(time)
+            breakpoints = parameter_values('breakpoint').astype(int)
+            breakpoints = np.clip(np.where(breakpoints < 0,breakpoints+ntimes,breakpoints),0,ntimes)
+            before_break = np.arange(ntimes) < breakpoints[:,None]
+            models *= np.where(before_break,parameter_values('step1')[:,None],parameter_values('step2')[:,None])
 
-        if not self.poly_used and not self.exp_ramp_used and not self.step_func_used: # we're using a normalization constant to offset the transit depth
-            model *= self.pars['f'].currVal
+        if not self.poly_used and not self.exp_ramp_used and not self.step_func_used:
+            models *= parameter_values('f')[:,None]
 
-        return model
+        return models
+
+
+    def calc_jacobian(self,time=None,sys_model_inputs=None):
+
+        """Calculates the model and its derivatives with respect to each of the free parameters. The derivatives of the polynomial, exponential ramp, step function
+        and normalisation terms are analytic, while those of the transit light curve parameters are calculated by central differences of the batman model (with the steps of batman_fd_steps).
+        The breakpoint of the step function moves in whole integrations, so its derivative is the central difference of the step function over +/- 1 integration.
+        The GP hyperparameters don't enter the model, so have derivatives of zero.
+
+        Inputs:
+        time - the array of times at which to evaluate the model. Can be left blank if this has not changed from the initial init call.
+        sys_model_inputs - the array of inputs to give the polynomials if fitting with polys. Can be left blank if this has not changed from the initial init call or you're not using polynomials.
+
+        Returns:
+        model - the modelled light curve, as returned by calc
+        jacobian - the derivatives of the model with shape (npars, ntimes), in the order of self.namelist"""
+
+        if time is None:
+            time = self.time_array
+
+        transit_shape = self.transit_shape(time)
+
+        # the systematics components, which multiply the transit light curve
+        components = OrderedDict()
+        if self.poly_used:
+            components['poly'] = self.red_noise_poly(time,sys_model_inputs)
+        if self.exp_ramp_used:
+            components['ramp'] = self.exponential_ramp(time)*np.ones_like(time)
+        if self.step_func_used:
+            components['step'] = self.step_function(time)
+        if not self.poly_used and not self.exp_ramp_used and not self.step_func_used:
+            components['f'] = self.pars['f'].currVal*np.ones_like(time)
+
+        def product(exclude=None):
+            """the transit light curve multiplied by all systematics components except exclude"""
+            p = transit_shape.copy()
+            for name,c in components.items():
+                if name != exclude:
+                    p *= c
+            return p
+
+        model = product()
+        systematics = np.prod(list(components.values()),axis=0)
+
+        jacobian = np.zeros((len(self.namelist),len(time)))
+
+        for i,name in enumerate(self.namelist):
+
+            if name in batman_fd_steps:
+                value = self.pars[name].currVal
+                upper_value = value + batman_fd_steps[name]
+                lower_value = value - batman_fd_steps[name]
+                if name == 'ecc': # batman can't take a negative eccentricity
+                    lower_value = max(lower_value,0)
+                self.pars[name].currVal = upper_value
+                upper = self.transit_shape(time)
+                self.pars[name].currVal = lower_value
+                lower = self.transit_shape(time)
+                self.pars[name].currVal = value
+                jacobian[i] = (upper-lower)/(upper_value-lower_value)*systematics
+
+            elif name[0] == 'c' and name[1:].isdigit():
+                jacobian[i] = product('poly')*self.polynomial_design_matrix(sys_model_inputs)[int(name[1:])-1]
+
+            elif name[0] == 'r' and name[1:].isdigit():
+                n = int(name[1:])
+                if n%2: # the amplitude of the exponential
+                    jacobian[i] = product('ramp')*np.exp(self.pars['r%d'%(n+1)].currVal*time)
+                else: # the rate of the exponential
+                    jacobian[i] = product('ramp')*self.pars['r%d'%(n-1)].currVal*time*np.exp(self.pars[name].currVal*time)
+
+            elif name in ['step1','step2']:
+                before_break = np.arange(len(time)) < int(self.pars['breakpoint'].currVal)
+                if name == 'step1':
+                    jacobian[i] = product('step')*before_break
+                else:
+                    jacobian[i] = product('step')*~before_break
+
+            elif name == 'breakpoint':
+                value = self.pars[name].currVal
+                self.pars[name].currVal = value + 1
+                upper = self.step_function(time)
+                self.pars[name].currVal = value - 1
+                lower = self.step_function(time)
+                self.pars[name].currVal = value
+                jacobian[i] = (upper-lower)/2*product('step')
+
+            elif name == 'f':
+                jacobian[i] = transit_shape
+
+        # reset batman to the current parameters
+        self.transit_shape(time)
+
+        return model,jacobian
 
 
     def exponential_ramp(self,time=None):
@@ -312,7 +512,7 @@ class TransitModelGPPM(object):
 
     def red_noise_poly(self,time=None,sys_model_inputs=None,deconstruct_polys=False):
 
-        """The function that calculates the time polynomial to fit the red noise. This uses the pf.systematics_model() function.
+        """The function that calculates the time polynomial to fit the red noise. This uses the pf.systematics_model() function with the precomputed design matrix.
 
         Inputs:
         time - the array of times at which to evaluate the polynomial. Can be blank if these haven't changed from the initial init call.
@@ -330,20 +530,32 @@ class TransitModelGPPM(object):
         else:
             red_noise_pars = np.array([self.pars['c%d'%i].currVal for i in range(1,self.polynomial_orders.sum()+2)])
 
-        if sys_model_inputs is not None:
-            poly_inputs = sys_model_inputs
-        else:
-            poly_inputs = self.systematics_model_inputs
+        design_matrix = self.polynomial_design_matrix(sys_model_inputs)
 
         # generate the model
         if deconstruct_polys:
-            red_noise_trend,poly_components = pf.systematics_model(red_noise_pars,poly_inputs,self.polynomial_orders,False,deconstruct_polys)
+            red_noise_trend,poly_components = pf.systematics_model(red_noise_pars,None,self.polynomial_orders,False,deconstruct_polys,design_matrix)
             return red_noise_trend,poly_components
         else:
-            red_noise_trend = pf.systematics_model(red_noise_pars,poly_inputs,self.polynomial_orders,False,deconstruct_polys)
+            red_noise_trend = pf.systematics_model(red_noise_pars,None,self.polynomial_orders,False,deconstruct_polys,design_matrix)
             return red_noise_trend
 
 
+    def polynomial_design_matrix(self,sys_model_inputs=None):
+
+        """Return the design matrix of the polynomials (see pf.polynomial_design_matrix). This is the one calculated at initialisation unless different inputs are given.
+
+        Inputs:
+        sys_model_inputs - the array of inputs to feed into the polynomial. Can be blank if these haven't changed from the initial init call.
+
+        Returns:
+        design_matrix - the design matrix with shape (1 + sum(polynomial_orders), ntimes)"""
+
+        if sys_model_inputs is None or sys_model_inputs is self.systematics_model_inputs:
+            return self.poly_design_matrix
+        return pf.polynomial_design_matrix(sys_model_inputs,self.polynomial_orders)
+
+
     def step_function(self,time=None):
 
         """The function that calculates a step function to help fit out mirror tilt events in JWST data
@@ -531,8 +743,8 @@ class TransitModelGPPM(object):
         sys_model_inputs - the inputs to feed to the GP. Can be left blank if these haven't changed from the init call.
 
         Returns:
-        gp - george.GP object
-        gp_split - george.GP objects for each kernel (if split=True)
+        gp - george.GP object, or semiseparable_gp.SemiseparableGP object for a _celerite kernel
+        gp_split - the kernels of each component of the GP (if split=True)
 
         """
 
@@ -540,6 +752,34 @@ class TransitModelGPPM(object):
 
         A2 = self.pars['A'].currVal # log of the amplitude
 
+        if self.wn_kernel:
+            WN = self.pars['s'].currVal
+            fit_WN = True
+        else:
+            WN = None
+            fit_WN = False
+
+        if sys_model_inputs is None:
+            gp_model_inputs = self.systematics_model_inputs
+        else:
+            gp_model_inputs = sys_model_inputs
+
+        if any([c is not None and c.endswith("_celerite") for c in self.kernel_classes]):
+            if self.gp_ndim > 1:
+                raise ValueError("The _celerite kernels can only be used for a GP with a single kernel, not %s"%(",".join([str(c) for c in self.kernel_classes])))
+
+            # lniL = log-inverse-length-scale
+            L2 = ( 1./np.exp( self.pars['lniL_1'].currVal ) )**2
+            gp = sgp.SemiseparableGP(self.kernel_classes[0].replace("_celerite",""),A2,np.log(L2),WN)
+
+            if compute:
+                gp.compute(gp_model_inputs[0],yerr=flux_err)
+
+            if split:
+                return gp,[gp.kernel]
+            else:
+                return gp
+
         for i in range(self.gp_ndim):
 
             # lniL = log-inverse-length-scale
@@ -564,24 +804,12 @@ class TransitModelGPPM(object):
             else:
                 kernel += KERNEL
 
-        if self.wn_kernel:
-            WN = self.pars['s'].currVal
-            fit_WN = True
-        else:
-            WN = None
-            fit_WN = False
-
         if self.gp_ndim > 1:
             gp = george.GP(kernels.ConstantKernel(A2,ndim=self.gp_ndim,axes=np.arange(self.gp_ndim))*kernel,white_noise=WN,fit_white_noise=fit_WN,mean=0,fit_mean=False)
 
         else: # use george's HODLRSolver, which provides faster computation. My tests show this doesn't always seem to perform well for GPs with > 1 kernel.
             gp = george.GP(kernels.ConstantKernel(A2,ndim=self.gp_ndim,axes=np.arange(self.gp_ndim))*kernel,white_noise=WN,fit_white_noise=fit_WN,mean=0,fit_mean=False,solver=george.solvers.HODLRSolver)
 
-        if sys_model_inputs is None:
-            gp_model_inputs = self.systematics_model_inputs
-        else:
-            gp_model_inputs = sys_model_inputs
-
         if compute:
             if self.gp_ndim > 1:
                 gp.compute(gp_model_inputs.T,yerr=flux_err)
@@ -594,6 +822,49 @@ class TransitModelGPPM(object):
             return gp
 
 
+    def cached_gp(self,gp_model_inputs,flux_err):
+        """Return the GP computed for the current hyperparameters, model inputs and flux errors. The factorised covariance only depends on these,
+        so it is reused from the cache if they haven't changed, e.g. when only the transit or systematics parameters have. The least recently used
+        GP is dropped when there are more than gp_cache_size.
+
+        Inputs:
+        gp_model_inputs - the array of values/inputs fed to the GP
+        flux_err - the error in the flux data points
+
+        Returns:
+        gp - the computed george.GP object"""
+
+        hyperparameters = ['A']+['lniL_%d'%(i+1) for i in range(self.gp_ndim)]
+        if self.wn_kernel:
+            hyperparameters.append('s')
+
+        key = tuple(self.pars[h].currVal for h in hyperparameters)+(hash(np.asarray(gp_model_inputs).tobytes()),hash(np.asarray(flux_err).tobytes()))
+
+        if key in self.gp_cache:
+            self.gp_cache_hits += 1
+            self.gp_cache.move_to_end(key)
+            return self.gp_cache[key]
+
+        self.gp_cache_misses += 1
+
+        gp = self.construct_gp()
+        if self.gp_ndim > 1:
+            gp.compute(gp_model_inputs.T,flux_err)
+        else:
+            gp.compute(gp_model_inputs[0],flux_err)
+
+        self.gp_cache[key] = gp
+        while len(self.gp_cache) > self.gp_cache_size:
+            self.gp_cache.popitem(last=False)
+
+        return gp
+
+
+    def gp_cache_info(self):
+        """Return a dictionary of the number of cache hits and misses of the computed GPs used by lnlike, and the current and maximum size of the cache"""
+        return {'hits':self.gp_cache_hits,'misses':self.gp_cache_misses,'size':len(self.gp_cache),'maxsize':self.gp_cache_size}
+
+
     def lnlike(self,time,flux,flux_err,sys_model_inputs=None,typeII=False):
         """The log likelihood
 
@@ -609,25 +880,87 @@ class TransitModelGPPM(object):
         """
 
         if self.GP_used:
-            if typeII:
-                gp = self.starting_gp_object
-            else:
-                gp = self.construct_gp()
-
             if sys_model_inputs is None:
                 gp_model_inputs = self.systematics_model_inputs
             else:
                 gp_model_inputs = sys_model_inputs
 
-            if self.gp_ndim > 1:
-                gp.compute(gp_model_inputs.T,flux_err)
+            if typeII:
+                gp = self.starting_gp_object
+                if self.gp_ndim > 1:
+                    gp.compute(gp_model_inputs.T,flux_err)
+                else:
+                    gp.compute(gp_model_inputs[0],flux_err)
             else:
-                gp.compute(gp_model_inputs[0],flux_err)
+                gp = self.cached_gp(gp_model_inputs,flux_err)
+        else:
+            gp = None
+
+        if self.linear_poly_mode is not None:
+            lnlike_poly = self.solve_polynomial(time,flux,flux_err,gp)
+            if not np.isfinite(lnlike_poly):
+                return -np.inf
         else:
+            lnlike_poly = 0
+
+        if gp is None:
             n = len(flux)
-            return -0.5*(n*np.log(2*np.pi) + np.sum(np.log(flux_err**2)) + np.sum(((flux-self.calc(time))**2)/(flux_err**2)))
+            return lnlike_poly-0.5*(n*np.log(2*np.pi) + np.sum(np.log(flux_err**2)) + np.sum(((flux-self.calc(time))**2)/(flux_err**2)))
+
+        return lnlike_poly+gp.lnlikelihood(flux-self.calc(time),quiet=True)
+
 
-        return gp.lnlikelihood(flux-self.calc(time),quiet=True)
+    def solve_polynomial(self,time,flux,flux_err,gp=None):
+        """Set the polynomial coefficients to those that best fit the data given the rest of the model, for linear_poly_mode. As the model is the product of the
+        polynomial with the transit, ramp and step models, it is linear in the coefficients and these are found by (generalised) weighted least squares with
+        the Gaussian prior given by poly_prior_width. With a GP, the weights are given by the inverse of the GP's covariance matrix.
+
+        Inputs:
+        time - the array of times at which to evaluate the model
+        flux - the flux data points
+        flux_err - the error in the flux data points
+        gp - the computed GP, if using one. Default=None
+
+        Returns:
+        lnlike_poly - the term added to the ln likelihood of the best fitting coefficients. This is 0 for linear_poly_mode = "solve", while for "marginalise"
+                      it is the prior on the coefficients and the volume of their posterior, so that the total is the likelihood marginalised over the coefficients.
+                      This is -inf if the coefficients can't be solved for."""
+
+        other_model = self.transit_shape(time)
+        if self.exp_ramp_used:
+            other_model = other_model*self.exponential_ramp(time)
+        if self.step_func_used:
+            other_model = other_model*self.step_function(time)
+
+        design_matrix = self.poly_design_matrix*other_model
+
+        if gp is None:
+            weighted_design_matrix = design_matrix/flux_err**2
+            weighted_flux = flux/flux_err**2
+        else:
+            weighted_design_matrix = gp.apply_inverse(design_matrix.T).T
+            weighted_flux = gp.apply_inverse(flux)
+
+        precision = np.dot(design_matrix,weighted_design_matrix.T) + np.diag(self.poly_prior_precision)
+
+        try:
+            cholesky = linalg.cho_factor(precision)
+        except linalg.LinAlgError:
+            return -np.inf
+
+        coefficients = linalg.cho_solve(cholesky,np.dot(design_matrix,weighted_flux) + self.poly_prior_precision*self.poly_prior_mean)
+
+        for i,c in enumerate(coefficients):
+            self.pars['c%d'%(i+1)] = c
+
+        if self.linear_poly_mode == "solve":
+            return 0
+
+        prior_chi2 = np.sum(self.poly_prior_precision*(coefficients-self.poly_prior_mean)**2)
+        logdet_precision = 2*np.sum(np.log(np.diag(cholesky[0])))
+        logdet_prior = np.sum(np.log(self.poly_prior_precision[self.poly_prior_precision > 0]))
+
+        return -0.5*(prior_chi2 + logdet_precision - logdet_prior)
 
 
     def lnprob(self,time,flux,flux_err,sys_model_inputs=None,sys_priors=None,typeII=False):
@@ -651,6 +984,43 @@ class TransitModelGPPM(object):
             return lnp
 
 
+    def lnprob_batch(self,pars_array,time,flux,flux_err,sys_model_inputs=None,sys_priors=None,typeII=False):
+        """The log probability of many sets of parameters at once, e.g. for all walkers of an emcee ensemble (emcee's vectorize=True).
+        Without a GP, the models of all sets of parameters with a finite prior are calculated together with calc_batch. With a GP, the
+        likelihood of each set of parameters is evaluated in turn since each needs its own GP, as are those with linear_poly_mode since each solves for its own polynomial. The model is left with the last set of parameters.
+
+        Inputs:
+        pars_array - the array of free parameter values with shape (nsets, npars)
+        time - the array of times at which to evaluate the model
+        flux - the flux data points
+        flux_err - the error in the flux data points
+        sys_model_inputs - the array of values/inputs to feed to the GP. Can be left blank if these have not changed since the initial init call.
+        sys_priors - define the priors on [k,aRs,inc] if using them and fitting a white light curve. Default=None (no prior)
+        typeII - True/False - define whether we're using a typeII maximum likelihood estimation. Default=False
+
+        Returns:
+        lnp - the array of the evaluated ln probabilities"""
+
+        pars_array = np.atleast_2d(pars_array)
+        lnp = np.zeros(len(pars_array))
+        evaluate_each = self.GP_used or self.linear_poly_mode is not None
+
+        for j,pars in enumerate(pars_array):
+            update_model(self,pars)
+            lnp[j] = self.lnprior(sys_priors)
+            if evaluate_each and np.isfinite(lnp[j]):
+                lnp[j] += self.lnlike(time,flux,flux_err,sys_model_inputs,typeII)
+
+        if not evaluate_each:
+            finite = np.isfinite(lnp)
+            if np.any(finite):
+                models = self.calc_batch(pars_array[finite],time,sys_model_inputs)
+                n = len(flux)
+                lnp[finite] += -0.5*(n*np.log(2*np.pi) + np.sum(np.log(flux_err**2)) + np.sum(((flux-models)**2)/(flux_err**2),axis=1))
+
+        return lnp
+
+
     def calc_gp_component(self,time,flux,flux_err,sys_model_inputs=None,deconstruct_gp=False):
         """The function that generates the systematics (red) noise model using the GP.
 
@@ -681,11 +1051,9 @@ class TransitModelGPPM(object):
         else:
             gp = self.construct_gp(compute=True,flux_err=flux_err)
 
-        predictions = gp.predict(flux-mean_function,gp_model_inputs.T)
-
-        mu = predictions[0]
-        cov = predictions[1]
-        std = np.sqrt(np.diag(cov))
+        # only the variance is needed, which avoids the full covariance matrix
+        mu,var = gp.predict(flux-mean_function,gp_model_inputs.T,return_cov=False,return_var=True)
+        std = np.sqrt(var)
 
         if deconstruct_gp:
             return mu,std,mu_components
@@ -813,7 +1181,7 @@ class TransitModelGPPM(object):
         return beta_factor
 
 
-    def optimise_params(self,time,flux,flux_err,reset_starting_gp=False,contact1=None,contact4=None,full_model=False,sys_priors=None,verbose=True,LM_fit=False):
+    def optimise_params(self,time,flux,flux_err,reset_starting_gp=False,contact1=None,contact4=None,full_model=False,sys_priors=None,verbose=True,LM_fit=False,optimiser="Nelder-Mead"):
         """Function to optimise the parameters of the model. Either just for the GP hyperparams (default) using the out of transit data or the full transit model.
 
         Inputs:
@@ -827,12 +1195,17 @@ class TransitModelGPPM(object):
         full_model - True/False - are we optimising the full model (marginalising over *all* parameters)? Default=False
         verbose - True/False - print output of Nelder-Mead to screen? Default = True
         LM_fit - True/False - if using a Levenberg-Marquardt algorithm, we don't use a Nelder-Mead and we instead use this to optimize and estimate our uncertainties!
+        optimiser - the algorithm used to fit the full model if not using LM_fit: "Nelder-Mead" or "L-BFGS-B", which uses the gradient of the chi2 from calc_jacobian
+                    and typically needs far fewer model evaluations for many parameters. Models with a GP always use Nelder-Mead. Default="Nelder-Mead"
 
         Returns:
         gp.get_parameter_vector() - the optimised values for the GP hyperparameters
 
         """
 
+        if self.linear_poly_mode is not None: # lnlike sets the polynomial coefficients to those that best fit the current model
+            self.lnlike(time,flux,flux_err)
+
         if not full_model: # then we are only optimising the GP hyperparams
             if contact1 is not None:
                 evaluated_model = self.calc(time)
@@ -937,21 +1310,37 @@ class TransitModelGPPM(object):
 
         # Now if we're fitting the full model (all parameters) or we're not using a GP we perform this step
         if full_model or self.GP_used is False:
+            if optimiser not in ["Nelder-Mead","L-BFGS-B"]:
+                raise ValueError('optimiser must be "Nelder-Mead" or "L-BFGS-B", not %s'%optimiser)
+
             if verbose:
                 if LM_fit:
                     print("\n ...running Levenberg-Marquardt \n")
-                else:
+                elif self.GP_used:
                     print("\n Running Nelder-Mead")
+                else:
+                    print("\n Running %s"%optimiser)
                 disp = True
             else:
                 disp = False
 
-            if not LM_fit:
+            # the chi2 of a model with a GP includes the GP prediction, which calc_jacobian doesn't differentiate, so these always use Nelder-Mead
+            if not LM_fit and (optimiser == "Nelder-Mead" or self.GP_used):
                 results = optimize.minimize(nll, p0,args=(self,y,True,time,flux_err,sys_priors,False),method='Nelder-Mead',bounds=tuple(bnds),options=dict(maxiter=1e4,disp=disp))
+            elif not LM_fit:
+                # the gradients of the parameters differ by orders of magnitude, so these are scaled by the widths implied by the curvature of the chi2 at p0 (the diagonal of J^T J/e^2)
+                _,jacobian = self.calc_jacobian(time)
+                curvature = np.sum((jacobian/flux_err)**2,axis=1)
+                p_scale = np.where(curvature > 0,1/np.sqrt(np.where(curvature > 0,curvature,1)),1)
+                scaled_bnds = tuple([(None if lower is None else lower/s,None if upper is None else upper/s) for (lower,upper),s in zip(bnds,p_scale)])
+                results = optimize.minimize(chisq_and_grad, p0/p_scale,jac=True,args=(self,y,time,flux_err,sys_priors,p_scale),method='L-BFGS-B',bounds=scaled_bnds,options=dict(maxiter=1e4,disp=disp))
+                results.x = results.x*p_scale
             else:
                 results = optimize.least_squares(nll, p0,args=(self,y,True,time,flux_err,sys_priors,False,True),method='lm')
 
             update_model(self,results.x)
+            if self.linear_poly_mode is not None:
+                self.lnlike(time,flux,flux_err)
 
             if LM_fit:
                 J = results.jac
@@ -995,6 +1384,19 @@ class TransitModelGPPM(object):
         return gp.get_parameter_vector()
 
 
+    # The cached GPs can be large, so are not saved when the model is pickled or copied. Models pickled before the cache existed start with an empty one.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['gp_cache'] = OrderedDict()
+        return state
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        for name,default in [('gp_cache_size',4),('gp_cache_hits',0),('gp_cache_misses',0),('linear_poly_mode',None)]:
+            self.__dict__.setdefault(name,default)
+        self.__dict__.setdefault('gp_cache',OrderedDict())
+        if self.__dict__.get('poly_used') and 'poly_design_matrix' not in state:
+            self.poly_design_matrix = pf.polynomial_design_matrix(self.systematics_model_inputs,self.polynomial_orders)
+
     # Parameters to set and update values within the object
     def __getitem__(self,ind):
             return self.data[ind].currVal
@@ -1007,6 +1409,9 @@ class TransitModelGPPM(object):
 
     @property
     def npars(self):
+        """The number of fitted parameters, used by reducedChisq, BIC and AIC. With linear_poly_mode this includes the polynomial coefficients solved for by lnlike, which aren't in the free parameters (len(self))"""
+        if self.linear_poly_mode is not None:
+            return len(self.data) + len(self.poly_prior_mean)
         return len(self.data)
 
 class Param(object):
@@ -1077,9 +1482,11 @@ def nll(p,model,y,full_model=False,x=None,e=None,sys_priors=None,typeII=False,LM
         the weighted residuals of the model fit"""
 
     if full_model:
-        for i in range(model.npars):
+        for i in range(len(model)):
             model[i] = p[i]
         if np.isfinite(model.lnprior(sys_priors)):
+            if model.linear_poly_mode is not None: # lnlike sets the polynomial coefficients to those that best fit this model
+                model.lnlike(x,y,e)
             if LM_fit:
                 if model.GP_used: # note: LM fit is not working 100% with GPs
                     mu, std = model.calc_gp_component(x,y,e)
@@ -1102,6 +1509,41 @@ def nll(p,model,y,full_model=False,x=None,e=None,sys_priors=None,typeII=False,LM
         # The scipy optimizer doesn't play well with infinities.
         return -ll if np.isfinite(ll) else 1e25
 
+def chisq_and_grad(p,model,y,x,e,sys_priors=None,p_scale=None):
+    """Function to calculate the chi2 of the full (mean) model and its gradient with respect to the parameters, using the derivatives of TransitModelGPPM.calc_jacobian.
+    This is the objective function of the gradient based (L-BFGS-B) optimisation of models without a GP, whose chi2 doesn't depend on a GP prediction.
+
+    Inputs:
+    p - the parameter values of the model
+    model - the TransitModelGPPM object
+    y - the y (flux) data points at which to evaluate the model
+    x - the array of times
+    e - the array of flux uncertainties
+    sys_priors - the priors on the system parameters, default=None (no priors)
+    p_scale - if the parameters are given in units of a scale for each parameter (p/p_scale), the array of the scales. Default=None (unscaled)
+
+    Returns:
+    chi2 - the chi2 of the model fit
+    grad - the gradient of the chi2 with respect to p"""
+
+    if p_scale is None:
+        p_scale = np.ones_like(p)
+
+    for i in range(len(model)):
+        model[i] = p[i]*p_scale[i]
+
+    if not np.isfinite(model.lnprior(sys_priors)):
+        # The scipy optimizer doesn't play well with infinities.
+        return 1e25,np.zeros_like(p)
+
+    if model.linear_poly_mode is not None: # lnlike sets the polynomial coefficients to those that best fit this model
+        model.lnlike(x,y,e)
+
+    evaluated_model,jacobian = model.calc_jacobian(x)
+    weighted_residuals = (y-evaluated_model)/e
+
+    return np.sum(weighted_residuals*weighted_residuals),-2*np.dot(jacobian,weighted_residuals/e)*p_scale
+
 def grad_nll(p,gp,y):
     """A function to compute the gradient of the objective function/ln-likelihood. This is a neccessary step for optimising the GP hyperparameters and is following the procedure given in the george documentation.
 
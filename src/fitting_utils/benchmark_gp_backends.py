@@ -0,0 +1,70 @@
+import argparse
+import time
+import numpy as np
+import george
+from george import kernels
+from Tiberius.src.fitting_utils import semiseparable_gp as sgp
+
+parser = argparse.ArgumentParser(description="Time the evaluation of the GP ln likelihood (compute + lnlikelihood) of a 1D kernel for george's HODLRSolver and BasicSolver and the semiseparable (_celerite) backend, as a function of the number of data points, to find the number of data points beyond which the semiseparable backend is faster.")
+parser.add_argument('-n','--npoints',help='The numbers of data points to time. Default = 100 300 1000 3000 10000',type=int,nargs='+',default=[100,300,1000,3000,10000])
+parser.add_argument('-k','--kernel',help='The kernel to use, Matern32 or Exp. Default = Matern32',default='Matern32')
+parser.add_argument('-l','--length_scale',help='The length scale of the kernel, in units of the (0-1) time range. Default = 0.05',type=float,default=0.05)
+parser.add_argument('-max_dense','--max_dense',help='The largest number of data points to time the O(N^3) george BasicSolver for. Default = 3000',type=int,default=3000)
+parser.add_argument('-max_hodlr','--max_hodlr',help='The largest number of data points to time the O(N log^2 N) george HODLRSolver for, which is independent of max_dense. Default = 3000',type=int,default=3000)
+parser.add_argument('-t','--min_time',help='The minimum time (in seconds) to spend timing each backend at each number of data points. Default = 1',type=float,default=1)
+args = parser.parse_args()
+
+
+def time_lnlike(gp,x,y,yerr,min_time):
+    """Return the mean time in seconds taken to compute the GP and evaluate its ln likelihood, repeated for at least min_time seconds"""
+    ncalls = 0
+    t0 = time.time()
+    while ncalls == 0 or time.time()-t0 < min_time:
+        gp.compute(x,yerr)
+        lnlike = gp.lnlikelihood(y)
+        ncalls += 1
+    return (time.time()-t0)/ncalls,lnlike
+
+
+george_kernel = {'Matern32':kernels.Matern32Kernel,'Exp':kernels.ExpKernel}[args.kernel]
+log_constant = np.log(1e-7)
+log_metric = np.log(args.length_scale**2)
+white_noise = np.log(1e-8)
+
+backends = ["george HODLR","george Basic","semiseparable"]
+print("%8s"%"N"+"".join(["%18s"%b for b in backends])+"%14s"%"max |dlnL|")
+
+crossover = {}
+
+for N in args.npoints:
+
+    x = np.sort(np.random.uniform(0,1,N))
+    yerr = np.ones(N)*3e-4
+    y = np.random.normal(0,3e-4,N)
+
+    timings = {}
+    lnlikes = []
+
+    for solver,name,max_N in [(george.solvers.HODLRSolver,"george HODLR",args.max_hodlr),(george.solvers.BasicSolver,"george Basic",args.max_dense)]:
+        if N > max_N:
+            continue
+        gp = george.GP(kernels.ConstantKernel(log_constant,ndim=1,axes=np.arange(1))*george_kernel(args.length_scale**2,ndim=1,axes=0),white_noise=white_noise,fit_white_noise=True,mean=0,fit_mean=False,solver=solver)
+        timings[name],lnlike = time_lnlike(gp,x,y,yerr,args.min_time)
+        if name == "george Basic":
+            lnlikes.append(lnlike)
+
+    gp = sgp.SemiseparableGP(args.kernel,log_constant,log_metric,white_noise)
+    timings["semiseparable"],lnlike = time_lnlike(gp,x,y,yerr,args.min_time)
+    lnlikes.append(lnlike)
+
+    for name in timings:
+        if name != "semiseparable" and timings["semiseparable"] < timings[name] and name not in crossover:
+            crossover[name] = N
+
+    print("%8d"%N+"".join(["%15.2f ms"%(timings[b]*1e3) if b in timings else "%18s"%"-" for b in backends])+"%14.2e"%(np.max(lnlikes)-np.min(lnlikes)))
+
+for name in backends[:2]:
+    if name in crossover:
+        print("The semiseparable backend is faster than %s from N = %d"%(name,crossover[name]))
+    else:
+        print("The semiseparable backend was not faster than %s for the N tested"%name)
@@ -0,0 +1,69 @@
+import argparse
+import time
+import numpy as np
+from collections import OrderedDict
+from Tiberius.src.fitting_utils import TransitModelGPPM as tmgp
+
+parser = argparse.ArgumentParser(description="Compare the Nelder-Mead and L-BFGS-B optimisations of TransitModelGPPM.optimise_params(full_model=True) on simulated white light curves, for polynomials with increasing numbers of coefficients. This prints the number of evaluations of the chi2 (and its gradient), the number of batman light curves calculated, the run time and the final chi2 of each optimiser.")
+parser.add_argument('-n','--npoints',help='The number of data points in the light curves. Default = 1000',type=int,default=1000)
+parser.add_argument('-i','--ninputs',help='The numbers of systematics model inputs to fit with polynomials. Default = 1 2 4 6',type=int,nargs='+',default=[1,2,4,6])
+parser.add_argument('-o','--order',help='The order of the polynomial of each input. Default = 2',type=int,default=2)
+parser.add_argument('-e','--exp_ramp',help='Also fit an exponential ramp? Default = False',action='store_true')
+parser.add_argument('-s','--seed',help='The seed of the random number generator. Default = 42',type=int,default=42)
+args = parser.parse_args()
+
+
+sys_priors = dict(k_prior=None,period_prior=None,ecc_prior=None,aRs_prior=None,inc_prior=None,t0_prior=None)
+noise = 5e-4
+rng = np.random.default_rng(args.seed)
+time_array = np.linspace(-0.12,0.12,args.npoints)
+
+
+def make_model(inputs,coefficients,t0,inc,aRs,k,u1,u2,ramp):
+    """Return a TransitModelGPPM of a white light curve with a polynomial of each input (and optionally an exponential ramp)"""
+    d = OrderedDict(t0=tmgp.Param(t0),inc=tmgp.Param(inc),aRs=tmgp.Param(aRs),period=3.5,ecc=0.,omega=90.,k=tmgp.Param(k),u1=tmgp.Param(u1),u2=tmgp.Param(u2))
+    for i,c in enumerate(coefficients):
+        d['c%d'%(i+1)] = tmgp.Param(c)
+    if args.exp_ramp:
+        d['r1'] = tmgp.Param(ramp[0])
+        d['r2'] = tmgp.Param(ramp[1])
+    return tmgp.TransitModelGPPM(d,inputs,None,np.ones_like(time_array)*noise,time_array,polynomial_orders=np.ones(len(inputs),dtype=int)*args.order,exp_ramp=args.exp_ramp,exp_ramp_components=int(args.exp_ramp))
+
+
+print("%8s%8s%14s%18s%18s%12s%12s"%("ninputs","npars","optimiser","chi2 evaluations","batman models","time (s)","chi2"))
+
+for ninputs in args.ninputs:
+
+    inputs = np.vstack([(time_array-time_array.mean())/time_array.std()]+[rng.normal(size=args.npoints) for i in range(ninputs-1)])
+    true_coefficients = np.hstack(([1],rng.normal(0,3e-4,ninputs*args.order)))
+    true_model = make_model(inputs,true_coefficients,0,87.5,9,0.12,0.35,0.2,(-1e-3,-40))
+    flux = true_model.calc(time_array)+rng.normal(0,noise,args.npoints)
+
+    for optimiser in ["Nelder-Mead","L-BFGS-B"]:
+
+        # start from the same offset parameters with flat polynomials
+        model = make_model(inputs,np.hstack(([1],np.zeros(ninputs*args.order))),0.002,87,9.5,0.11,0.3,0.25,(-5e-4,-20))
+
+        # count the chi2 evaluations and the batman light curves used by them (including those of the gradients)
+        nchi2 = [0]
+        nbatman = [0]
+        chisq = model.chisq
+        transit_shape = model.transit_shape
+        def counted_chisq(*chisq_args):
+            nchi2[0] += 1
+            return chisq(*chisq_args)
+        def counted_calc_jacobian(*calc_args):
+            nchi2[0] += 1
+            return tmgp.TransitModelGPPM.calc_jacobian(model,*calc_args)
+        def counted_transit_shape(*shape_args):
+            nbatman[0] += 1
+            return transit_shape(*shape_args)
+        model.chisq = counted_chisq
+        model.calc_jacobian = counted_calc_jacobian
+        model.transit_shape = counted_transit_shape
+
+        t0 = time.time()
+        model.optimise_params(time_array,flux,np.ones_like(time_array)*noise,full_model=True,sys_priors=sys_priors,verbose=False,optimiser=optimiser)
+        run_time = time.time()-t0
+
+        print("%8d%8d%14s%18d%18d%12.2f%12.1f"%(ninputs,model.npars,optimiser,nchi2[0],nbatman[0],run_time,chisq(time_array,flux,np.ones_like(time_array)*noise)))
@@ -7,9 +7,23 @@ import matplotlib.pyplot as plt
 import emcee
 from corner import corner,overplot_lines
 import sys
+import os
 from Tiberius.src.fitting_utils import TransitModelGPPM as tmgp
 import copy
 from scipy import stats
+from scipy import fft
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+try:
+    from mpi4py.futures import MPIPoolExecutor
+except ImportError: # only needed for pool_backend = mpi
+    MPIPoolExecutor = None
+
+# The pool backends that run_emcee can spread the walkers' likelihood evaluations over
+pool_backends = ["multiprocessing","futures","mpi"]
+
+# The arguments of lnprob_emcee (model, data, priors) in each worker process of the MCMC pool, set once by init_lnprob_worker when the pool is started
+worker_lnprob_args = None
 
 def parseParam(parString):
     """Function to convert input_dicts / parameters saved as 'mean +err -err' to floats with upper and lower errors. Currently used by plotting_utils.
@@ -32,7 +46,7 @@ def parseParam(parString):
     return val, upper_error, lower_error
 
 
-def save_LM_results(best_pars,uncertainties,namelist,bin_number,best_model,time,flux,flux_err,verbose=True):
+def save_LM_results(best_pars,uncertainties,namelist,bin_number,best_model,time,flux,flux_err,verbose=True,output_directory="."):
     """Function to save the results from an LM fit to a best_fit_parameters.dat and LM_statistics.dat tables equivalent to emcee results.
 
     Inputs:
@@ -45,6 +59,7 @@ def save_LM_results(best_pars,uncertainties,namelist,bin_number,best_model,time,
     flux - the flux array
     flux_err - the flux error array
     verbose - True/False - print the best-fitting results to terminal?
+    output_directory - the directory the tables are saved to. Default='.' (the current working directory)
 
     Returns:
     Nothing but saving the results to best_fit_parameters.dat and LM_statistics.txt"""
@@ -52,11 +67,11 @@ def save_LM_results(best_pars,uncertainties,namelist,bin_number,best_model,time,
     ndim = len(best_pars)
 
     if bin_number == 1:
-        new_tab = open('best_fit_parameters.txt','w')
-        diagnostic_tab = open('LM_statistics.txt','w')
+        new_tab = open(os.path.join(output_directory,'best_fit_parameters.txt'),'w')
+        diagnostic_tab = open(os.path.join(output_directory,'LM_statistics.txt'),'w')
     else:
-        new_tab = open('best_fit_parameters.txt','a')
-        diagnostic_tab = open('LM_statistics.txt','a')
+        new_tab = open(os.path.join(output_directory,'best_fit_parameters.txt'),'a')
+        diagnostic_tab = open(os.path.join(output_directory,'LM_statistics.txt'),'a')
 
     fitted_chi2 = best_model.chisq(time,flux,flux_err)
     fitted_reducedChi2 = best_model.reducedChisq(time,flux,flux_err)
@@ -96,21 +111,25 @@ def save_LM_results(best_pars,uncertainties,namelist,bin_number,best_model,time,
     return
 
 
-def recover_quartiles_single(samples,namelist,bin_number,verbose=True,save_result=False,burn=False):
+def recover_quartiles_single(samples,namelist,bin_number,verbose=True,save_result=False,burn=False,output_directory="."):
     """
     Function that calculates the 16th, 50th and 84th percentiles from a numpy array / emcee chain and saves these to a table.
 
     Inputs:
-    samples - the samples/chains from emcee
+    samples - the samples/chains from emcee, or the filename of a chain saved by run_emcee (prod_chain_wbXXXX.npy), which is read with memory mapping
     namelist - the names of the parameters that were fit - needed for printing and saving to file
     bin_number - the number of the wavelength bin we're considering. Necessary for printing and saving to file.
     verbose - True/False: do we want to print the results to screen?
     save_result - True/False: do we want to save the results to a table?
     burn - True/False: is this a burn-in chain? If so, save to burn_parameters.dat, else save to best_fit_parameters.dat
+    output_directory - the directory the tables are saved to. Default='.' (the current working directory)
 
     Returns:
     (median, upper bound, lower bound) with shape (nparameters,3)
     """
+    if isinstance(samples,str):
+        samples = load_chain(samples)[:,1:-1]
+
     lower = []
     median = []
     upper = []
@@ -133,18 +152,18 @@ def recover_quartiles_single(samples,namelist,bin_number,verbose=True,save_resul
     if save_result:
         if bin_number == 1:
             if burn:
-                new_tab = open('burn_parameters.txt','w')
+                new_tab = open(os.path.join(output_directory,'burn_parameters.txt'),'w')
                 # new_tab_2 = open('parameter_modes_burn.txt','w')
             else:
-                new_tab = open('best_fit_parameters.txt','w')
-                new_tab_2 = open('parameter_modes_prod.txt','w')
+                new_tab = open(os.path.join(output_directory,'best_fit_parameters.txt'),'w')
+                new_tab_2 = open(os.path.join(output_directory,'parameter_modes_prod.txt'),'w')
         else:
             if burn:
-                new_tab = open('burn_parameters.txt','a')
+                new_tab = open(os.path.join(output_directory,'burn_parameters.txt'),'a')
                 # new_tab_2 = open('parameter_modes_burn.txt','a')
             else:
-                new_tab = open('best_fit_parameters.txt','a')
-                new_tab_2 = open('parameter_modes_prod.txt','a')
+                new_tab = open(os.path.join(output_directory,'best_fit_parameters.txt'),'a')
+                new_tab_2 = open(os.path.join(output_directory,'parameter_modes_prod.txt'),'a')
 
     for i in range(ndim):
         par = samples[:,i]
@@ -182,6 +201,272 @@ def recover_quartiles_single(samples,namelist,bin_number,verbose=True,save_resul
     return np.array(median),np.array(upper),np.array(lower),np.array(mode)
 
 
+class ChainStore(object):
+
+    def __init__(self,filename,nwalkers,npars,resume=False,flush_interval=100):
+
+        """
+        The production chain saved to a binary .npy file, with one row per walker per saved step holding: walker number, parameter values, lnprobability (the same columns as the old text chains).
+        Space is preallocated for the steps that are going to be saved, rows are flushed to disk every flush_interval steps, and the file can be read with memory mapping (see load_chain).
+        Rows that have not been written have a NaN lnprobability, so a chain that was interrupted, or has finished, can be continued from its last complete step.
+
+        Inputs:
+        filename - the name of the .npy file, e.g. prod_chain_wb0001.npy
+        nwalkers - the number of emcee walkers
+        npars - the number of fitted parameters
+        resume - True/False: keep the steps already saved to filename and add new steps after them. Default=False (start a new chain)
+        flush_interval - the number of steps between writes to disk. Default=100
+
+        Returns:
+        ChainStore object
+        """
+
+        self.filename = filename
+        self.nwalkers = nwalkers
+        self.ncolumns = npars+2
+        self.flush_interval = flush_interval
+        self.steps_since_flush = 0
+
+        if resume and os.path.exists(filename):
+            self.chain = np.load(filename,mmap_mode='r+')
+            if self.chain.shape[1] != self.ncolumns:
+                raise ValueError("%s has %d parameters, not %d, so can't be continued"%(filename,self.chain.shape[1]-2,npars))
+            self.nrows = len(load_chain(filename))
+        else:
+            self.chain = None
+            self.nrows = 0
+
+        # the first row saved by this run, so that discard_steps only removes steps of this run
+        self.first_row = self.nrows
+
+    def allocate(self,nsteps):
+        """Make space in the file for nsteps more steps, after the steps already saved"""
+
+        nrows_total = self.nrows + nsteps*self.nwalkers
+
+        if self.chain is not None and len(self.chain) >= nrows_total:
+            return
+
+        new_chain = np.lib.format.open_memmap(self.filename+'.tmp','w+',dtype=float,shape=(nrows_total,self.ncolumns))
+        new_chain[self.nrows:,-1] = np.nan
+        if self.nrows > 0:
+            new_chain[:self.nrows] = self.chain[:self.nrows]
+        new_chain.flush()
+
+        self.chain = None # release the old file before replacing it
+        os.replace(self.filename+'.tmp',self.filename)
+        self.chain = new_chain
+
+    def save_step(self,pos,prob):
+        """Save the positions (nwalkers, npars) and lnprobabilities (nwalkers) of all walkers at one step of the chain"""
+
+        if self.chain is None or self.nrows+self.nwalkers > len(self.chain):
+            # chains of unknown length (nsteps = auto) grow the file as they go, doubling its size each time
+            self.allocate(max(self.nrows//self.nwalkers,1000))
+
+        rows = self.chain[self.nrows:self.nrows+self.nwalkers]
+        rows[:,0] = np.arange(self.nwalkers)
+        rows[:,1:-1] = pos
+        rows[:,-1] = prob
+        self.nrows += self.nwalkers
+
+        self.steps_since_flush += 1
+        if self.steps_since_flush >= self.flush_interval:
+            self.flush()
+
+    def discard_steps(self,nsteps):
+        """Remove the first nsteps steps saved by this run (e.g. the burn-in of a chain of unknown length), moving the later steps up in the file"""
+
+        start = self.first_row
+        stop = min(start + nsteps*self.nwalkers,self.nrows)
+        if stop == start:
+            return
+
+        nkeep = self.nrows - stop
+        self.chain[start:start+nkeep] = self.chain[stop:self.nrows]
+        self.chain[start+nkeep:self.nrows,-1] = np.nan # marks the rows as unwritten, see load_chain
+        self.nrows = start + nkeep
+        self.flush()
+
+    def flush(self):
+        if self.chain is not None:
+            self.chain.flush()
+        self.steps_since_flush = 0
+
+    def last_sample(self):
+        """Return the positions (nwalkers, npars) of all walkers at the last saved step, or None if no steps have been saved"""
+        if self.nrows == 0:
+            return None
+        return np.array(self.chain[self.nrows-self.nwalkers:self.nrows,1:-1])
+
+
+class AutocorrelationMonitor(object):
+
+    def __init__(self,nwalkers,ndim,check_interval=100,multiple=50,max_lag=1000,c=5):
+
+        """
+        Tracks the integrated autocorrelation time of the chain as it runs, for nsteps = auto. The positions of the walkers are buffered and every
+        check_interval steps the lagged products of the buffered block with the preceding max_lag positions are added to running sums with FFTs, so the
+        cost and memory are set by max_lag rather than the length of the chain. These sums give the same estimate of the autocorrelation time as
+        emcee.autocorr.integrated_time (the autocorrelation function averaged over the walkers with Sokal's automatic window).
+
+        Inputs:
+        nwalkers - the number of emcee walkers
+        ndim - the number of fitted parameters
+        check_interval - the number of steps between estimates of the autocorrelation time. Default=100
+        multiple - the chain has converged once it is this many times longer than the median autocorrelation time. Default=50 (DFM's estimate)
+        max_lag - the longest lag of the autocorrelation function, so autocorrelation times longer than max_lag/c can't be measured. Default=1000
+        c - the window size of Sokal's automatic window, in units of the autocorrelation time. Default=5
+
+        Returns:
+        AutocorrelationMonitor object
+        """
+
+        self.check_interval = check_interval
+        self.multiple = multiple
+        self.max_lag = max_lag
+        self.c = c
+
+        self.nsteps = 0
+        self.reference = None # positions are measured relative to the first step to avoid losing precision in the sums
+        self.block = np.zeros((check_interval,nwalkers,ndim)) # the positions since the sums were last updated
+        self.nbuffered = 0
+        self.recent = np.zeros((max_lag+1,nwalkers,ndim)) # the last max_lag+1 positions added to the sums, oldest first (zero before the first step)
+        self.first_sums = np.zeros((max_lag+1,nwalkers,ndim)) # the sums of the first l positions
+        self.lagged_sums = np.zeros((max_lag+1,nwalkers,ndim)) # the sums of x(t)*x(t-l)
+        self.sums = np.zeros((nwalkers,ndim))
+
+        self.tau_steps = []
+        self.tau_history = []
+        self.steps_per_tau = 0
+        self.converged = False
+
+    def update(self,pos):
+        """Add the positions (nwalkers, ndim) of the walkers at the next step of the chain, returning True once the chain has converged"""
+
+        if self.reference is None:
+            self.reference = np.array(pos)
+
+        self.block[self.nbuffered] = pos - self.reference
+        self.nbuffered += 1
+        self.nsteps += 1
+
+        if self.nbuffered == self.check_interval:
+            self.update_sums()
+
+        if self.nsteps % self.check_interval == 0:
+            self.check_convergence()
+
+        return self.converged
+
+    def update_sums(self):
+        """Add the buffered block of positions to the running sums. The products with every lag up to max_lag are found at once as the
+        cross-correlation of the block with the preceding max_lag positions, calculated with FFTs"""
+
+        m = self.nbuffered
+        if m == 0:
+            return
+
+        block = self.block[:m]
+        previous_steps = self.nsteps - m
+
+        # lagged_sums[l] += sum_t block[t]*positions[max_lag+t-l], where the positions are the last max_lag before the block followed by the block itself
+        positions = np.concatenate((self.recent[1:],block))
+        nfft = fft.next_fast_len(len(positions),real=True)
+        correlation = fft.irfft(np.conj(fft.rfft(block,nfft,axis=0))*fft.rfft(positions,nfft,axis=0),nfft,axis=0)
+        self.lagged_sums += correlation[self.max_lag::-1]
+
+        # the sums of the first l positions, for the steps of the block with l <= max_lag
+        cumulative_sums = self.sums + np.cumsum(block,axis=0)
+        steps = np.arange(previous_steps+1,previous_steps+m+1)
+        within_max_lag = steps <= self.max_lag
+        self.first_sums[steps[within_max_lag]] = cumulative_sums[within_max_lag]
+
+        self.sums = cumulative_sums[-1]
+        self.recent = positions[-(self.max_lag+1):]
+        self.nbuffered = 0
+
+    def integrated_time(self):
+        """Estimate the integrated autocorrelation time of each parameter.
+
+        Returns:
+        tau - the autocorrelation time of each parameter, in steps
+        measured - True/False for each parameter: whether the automatic window fell within max_lag. If not, tau is a lower limit"""
+
+        self.update_sums()
+
+        n = self.nsteps
+        nlags = min(n,self.max_lag+1)
+        lags = np.arange(nlags)
+        mean = self.sums/n
+
+        # the sums of x(t) over t >= l and t < n-l, needed to subtract the mean from each pair of positions
+        later_sums = self.sums - self.first_sums[:nlags]
+        last = self.recent[::-1][:nlags]
+        earlier_sums = self.sums - np.concatenate((np.zeros_like(last[:1]),np.cumsum(last,axis=0)[:-1]))
+
+        autocovariance = self.lagged_sums[:nlags] - mean*(later_sums+earlier_sums) + (n-lags)[:,None,None]*mean**2
+
+        with np.errstate(invalid='ignore',divide='ignore'):
+            acf = np.nanmean(autocovariance/autocovariance[0],axis=1)
+
+        taus = 2*np.cumsum(acf,axis=0) - 1
+
+        outside_window = lags[:,None] >= self.c*taus
+        measured = np.any(outside_window,axis=0)
+        window = np.where(measured,np.argmax(outside_window,axis=0),nlags-1)
+
+        return taus[window,np.arange(taus.shape[1])],measured
+
+    def check_convergence(self):
+        """Update the autocorrelation time and record it, setting self.converged if the chain is long enough"""
+
+        tau,measured = self.integrated_time()
+        self.tau_steps.append(self.nsteps)
+        self.tau_history.append(tau)
+
+        if not np.all(measured):
+            return
+
+        self.steps_per_tau = self.nsteps/np.median(tau)
+
+        # ideal scenario, we're >= multiple x the median autocorr time
+        if self.steps_per_tau >= self.multiple:
+            self.converged = True
+
+        # not so good scenario but chains are getting long
+        elif self.steps_per_tau >= 20 and self.nsteps >= 10000:
+            self.converged = True
+
+    def save(self,filename,namelist):
+        """Save the autocorrelation time of each parameter at each check to a table"""
+        if len(self.tau_steps) > 0:
+            np.savetxt(filename,np.column_stack((self.tau_steps,self.tau_history)),fmt="%g",header="step "+" ".join(namelist))
+
+
+def load_chain(filename,mmap=True):
+    """Load a chain saved by run_emcee, only returning the complete steps.
+
+    Inputs:
+    filename - the name of the .npy chain file, e.g. prod_chain_wb0001.npy
+    mmap - True/False: memory map the file rather than reading it all into memory. Default=True
+
+    Returns:
+    chain - array with one row per walker per saved step and columns: walker number, parameter values, lnprobability"""
+
+    if mmap:
+        chain = np.load(filename,mmap_mode='r')
+    else:
+        chain = np.load(filename)
+
+    # the unwritten rows at the end of the file have a NaN lnprobability
+    incomplete = np.isnan(chain[:,-1])
+    if np.any(incomplete):
+        chain = chain[:np.argmax(incomplete)]
+
+    return chain
+
+
 def make_corner_plot(sample_chains,bin_number,namelist,parameter_modes,save_fig=False,title=None):
     """Use DFM's corner package to make a corner plot of the emcee chains.
 
@@ -236,7 +521,7 @@ def lnprob_emcee(pars,model,x,y,e,sys_model_inputs=None,sys_priors=None,typeII=F
         for i in range(len(pars)):
             model[i] = pars[i]
     else:
-        for i in range(model.npars):
+        for i in range(len(model)):
             model[i] = pars[i]
 
     model_lnprob = model.lnprob(x,y,e,sys_model_inputs,sys_priors,typeII)
@@ -244,6 +529,100 @@ def lnprob_emcee(pars,model,x,y,e,sys_model_inputs=None,sys_priors=None,typeII=F
     return model_lnprob
 
 
+def lnprob_emcee_vectorized(pars_array,model,x,y,e,sys_model_inputs=None,sys_priors=None,typeII=False):
+    """Calculate the lnprobability of every walker in the ensemble in one call, for emcee's vectorize=True. This uses lnprob_batch of the transit model class,
+    which calculates the models of all walkers as a single (nwalkers, ntimes) array.
+
+    Inputs:
+    pars_array - the sets of parameters of all walkers, with shape (nwalkers, npars)
+    model - the TransitModel or TransitModelGP object
+    x - array of times
+    y - array of fluxes
+    e - array of errors on fluxes
+    sys_model_inputs - the inputs of the systematics model. Can be left blank if these are unchanged since the model was initialised.
+    sys_priors - array of standard deviations on Rp/Rs, a/Rs and inclination. Only used for white light fits. Default = None (no prior used).
+    typeII - True/False: are we performing typeII maximum likelihood - only used by TransitModelGP
+
+    Returns:
+    evaluated log likelihoods (array of length nwalkers)
+    """
+
+    return model.lnprob_batch(pars_array,x,y,e,sys_model_inputs,sys_priors,typeII)
+
+
+def init_lnprob_worker(lnprob_args):
+    """Initialise a worker process of the MCMC pool, so that the model and data are sent to each worker once rather than with every set of parameters"""
+    global worker_lnprob_args
+    worker_lnprob_args = lnprob_args
+
+
+def lnprob_worker(pars):
+    """Calculate the lnprobability with lnprob_emcee in a worker process of the MCMC pool, using the model and data the worker was initialised with.
+
+    Inputs:
+    pars - the new set of parameters that we're updating the model with
+
+    Returns:
+    evaluated log likelihood (float)
+    """
+    return lnprob_emcee(pars,*worker_lnprob_args)
+
+
+class ExecutorPool(object):
+    """Wraps a concurrent.futures style executor in the map/close interface of multiprocessing.Pool that emcee uses, sending the walkers to the workers in one chunk per worker"""
+
+    def __init__(self,executor,nworkers):
+        self.executor = executor
+        self.nworkers = nworkers
+
+    def map(self,function,iterable):
+        tasks = list(iterable)
+        chunksize = max(1,int(np.ceil(len(tasks)/self.nworkers)))
+        return list(self.executor.map(function,tasks,chunksize=chunksize))
+
+    def close(self):
+        self.executor.shutdown()
+
+    def join(self):
+        pass
+
+
+def make_pool(pool_backend,nprocesses,lnprob_args):
+    """Start the pool of worker processes over which emcee evaluates the lnprobabilities of the walkers. Each worker is sent the model and data once, when the pool is started.
+
+    Inputs:
+    pool_backend - multiprocessing (multiprocessing.Pool), futures (concurrent.futures.ProcessPoolExecutor) or mpi (mpi4py.futures.MPIPoolExecutor)
+    nprocesses - the number of worker processes. For mpi, if this is <= 1 the workers are the other processes of the MPI world, e.g. when running with mpiexec -n N python -m mpi4py.futures gppm_fit.py
+    lnprob_args - the arguments of lnprob_emcee after the parameters: [model,x,y,e,sys_model_inputs,sys_priors,typeII]
+
+    Returns:
+    pool - the pool, with map, close and join methods
+    pool_description - a description of the pool for the statistics tables
+    """
+
+    if pool_backend == "multiprocessing":
+        pool = multiprocessing.Pool(nprocesses,initializer=init_lnprob_worker,initargs=(lnprob_args,))
+
+    elif pool_backend == "futures":
+        pool = ExecutorPool(ProcessPoolExecutor(nprocesses,initializer=init_lnprob_worker,initargs=(lnprob_args,)),nprocesses)
+
+    elif pool_backend == "mpi":
+        if MPIPoolExecutor is None:
+            raise ImportError("pool_backend = mpi needs mpi4py to be installed")
+        if nprocesses > 1:
+            executor = MPIPoolExecutor(max_workers=nprocesses,initializer=init_lnprob_worker,initargs=(lnprob_args,))
+        else:
+            from mpi4py import MPI
+            nprocesses = max(1,MPI.COMM_WORLD.Get_size()-1)
+            executor = MPIPoolExecutor(initializer=init_lnprob_worker,initargs=(lnprob_args,))
+        pool = ExecutorPool(executor,nprocesses)
+
+    else:
+        raise ValueError("pool_backend must be one of %s, not %s"%(", ".join(pool_backends),pool_backend))
+
+    return pool,"%s (%d processes)"%(pool_backend,nprocesses)
+
+
 def chi2(pars,model,x,y,e):
     """Calculate the chi2 using the class in-built chi2 calculator.
 
@@ -258,13 +637,13 @@ def chi2(pars,model,x,y,e):
     evaluated chi2 (float)"""
 
     # we need to update the model we're using to use pars as submitted by MCMC
-    for i in range(model.npars):
+    for i in range(len(model)):
             model[i] = pars[i]
 
     return model.chisq(x,y,e)
 
 
-def run_emcee(starting_model,x,y,e,nwalk,nsteps,nthreads,burn=False,wavelength_bin=0,sys_priors=None,typeII=False,save_chain=True):
+def run_emcee(starting_model,x,y,e,nwalk,nsteps,nthreads,burn=False,wavelength_bin=0,sys_priors=None,typeII=False,save_chain=True,vectorize=False,pool_backend="multiprocessing",resume_chain=False,autocorr_interval=100,autocorr_multiple=50,output_directory="."):
 
     """Run the MCMC.
 
@@ -274,12 +653,19 @@ def run_emcee(starting_model,x,y,e,nwalk,nsteps,nthreads,burn=False,wavelength_b
     y - array of fluxes
     e - array of errors on fluxes
     nwalk - the number of emcee walkers
-    nsteps - the number of steps in the MCMC chain. Set to 'auto' if wanting to use the autocorrelation time to determine when the chains have burned in
-    nthreads - the number of threads over which to run the MCMC
+    nsteps - the number of steps in the MCMC chain. Set to 'auto' if wanting to use the autocorrelation time to determine when the chains have burned in. These will never run over 20,000 steps
+    nthreads - the number of processes over which to evaluate the walkers' lnprobabilities. Set to 1 to run without a pool (unless using pool_backend = mpi)
     burn - True/False: is this a burn in run or production run? This changes how the output is saved.
     wavelength_bin - the number of the wavelength bin the fit is running to. Needed for accurate saving.
     sys_priors - array of standard deviations on Rp/Rs, a/Rs and inclination. Only used for white light fits. Default = None (no prior used).
     typeII - True/False: are we performing typeII maximum likelihood - only used by TransitModelGP
+    save_chain - True/False: save the production chain to file. Default=True
+    vectorize - True/False: evaluate the log probabilities of all walkers in a single call (see lnprob_emcee_vectorized), rather than one walker at a time. This doesn't use a pool. Default=False
+    pool_backend - the pool used when nthreads > 1: multiprocessing, futures or mpi (see make_pool). Default="multiprocessing"
+    resume_chain - True/False: continue the production chain saved in prod_chain_wbXXXX.npy from its last step, adding the new steps to the file. Default=False
+    autocorr_interval - for nsteps = auto, the number of steps between checks of the autocorrelation time. Default=100
+    autocorr_multiple - for nsteps = auto, the chain stops once it is this many times longer than the median autocorrelation time. Default=50
+    output_directory - the directory the chain, tables, plots and models are saved to. Default='.' (the current working directory)
 
     Returns:
     (fitted median parameter values, fitted upper parameter bounds, fitted lower parameter bounds, fitted TransitModel/TransitModelGP object)
@@ -287,24 +673,20 @@ def run_emcee(starting_model,x,y,e,nwalk,nsteps,nthreads,burn=False,wavelength_b
     """
 
 
-    if wavelength_bin > 0 and burn:
-        diagnostic_tab = open('burn_statistics.txt','a')
+    if burn:
+        diagnostic_filename = os.path.join(output_directory,'burn_statistics.txt')
+    else:
+        diagnostic_filename = os.path.join(output_directory,'prod_statistics.txt')
 
-    elif wavelength_bin > 0 and not burn:
-        diagnostic_tab = open('prod_statistics.txt','a')
+    if wavelength_bin > 0:
+        diagnostic_tab = open(diagnostic_filename,'a')
 
     else: # starting fresh
-        if burn:
-            diagnostic_tab = open('burn_statistics.txt','w')
-        else:
-            diagnostic_tab = open('prod_statistics.txt','w')
+        diagnostic_tab = open(diagnostic_filename,'w')
 
     diagnostic_tab.close()
 
-    if burn:
-        diagnostic_tab = open('burn_statistics.txt','a')
-    else:
-        diagnostic_tab = open('prod_statistics.txt','a')
+    diagnostic_tab = open(diagnostic_filename,'a')
 
     starting_model_values = tmgp.extract_model_values(starting_model,typeII)
 
@@ -317,11 +699,39 @@ def run_emcee(starting_model,x,y,e,nwalk,nsteps,nthreads,burn=False,wavelength_b
     else:
         p0 = [np.array(starting_model_values) + 1e-8 * np.random.randn(ndim) for j in range(nwalkers)]
 
+    # only the production chain is saved to file
+    if not burn and save_chain:
+        chain_store = ChainStore(os.path.join(output_directory,'prod_chain_wb%s.npy'%(str(wavelength_bin+1).zfill(4))),nwalkers,npars,resume=resume_chain)
+        if resume_chain and chain_store.last_sample() is not None:
+            print("Continuing the chain saved in %s"%chain_store.filename)
+            p0 = chain_store.last_sample()
+    else:
+        chain_store = None
+
+    lnprob_args = [starting_model,x,y,e,None,sys_priors,typeII]
+    pool = None
+
+    if vectorize:
+        if nthreads > 1 or pool_backend == "mpi":
+            print("Evaluating all walkers in a single call, the %s pool is not used"%pool_backend)
+        lnprob_function = lnprob_emcee_vectorized
+        pool_description = "none (vectorized)"
+
+    elif nthreads > 1 or pool_backend == "mpi":
+        # the model and data are sent to the workers when the pool starts, so emcee only sends them the walkers' parameters
+        pool,pool_description = make_pool(pool_backend,nthreads,lnprob_args)
+        lnprob_function = lnprob_worker
+        lnprob_args = []
+
+    else:
+        lnprob_function = lnprob_emcee
+        pool_description = "none (serial)"
+
     # intiate emcee sampler object
     if ndim > 1:
-        sampler = emcee.EnsembleSampler(nwalkers,npars,lnprob_emcee,args=[starting_model,x,y,e,None,sys_priors,typeII],threads=nthreads)
+        sampler = emcee.EnsembleSampler(nwalkers,npars,lnprob_function,args=lnprob_args,pool=pool,vectorize=vectorize)
     else: # from my own tests I find that for a single parameter, the acceptance fraction is too high. Increasing the stretch scale factor decreases the acceptance fraction to a more acceptable value
-        sampler = emcee.EnsembleSampler(nwalkers,npars,lnprob_emcee,args=[starting_model,x,y,e,None,sys_priors,typeII],threads=nthreads,moves=emcee.moves.StretchMove(10))
+        sampler = emcee.EnsembleSampler(nwalkers,npars,lnprob_function,args=lnprob_args,pool=pool,moves=emcee.moves.StretchMove(10),vectorize=vectorize)
 
     # run chains
     print('################')
@@ -331,58 +741,32 @@ def run_emcee(starting_model,x,y,e,nwalk,nsteps,nthreads,burn=False,wavelength_b
 
     else:
         print("Running production for bin %d..."%(wavelength_bin+1))
-        if save_chain:
-            f = open('prod_chain_wb%s.txt'%(str(wavelength_bin+1).zfill(4)),'w')
-            f.close()
 
     if nsteps == "auto":
-        not_converged = True
-        chain_number = 1
-        nsteps = 2000
+        # the autocorrelation time is updated as the chain runs so that it stops as soon as it's long enough
+        autocorr_monitor = AutocorrelationMonitor(nwalkers,ndim,check_interval=autocorr_interval,multiple=autocorr_multiple)
+        sampler, highest_prob_pars, highest_prob = advance_chain(sampler,p0,20000,chain_store,autocorr_monitor)
+        nsteps = autocorr_monitor.nsteps # updated nsteps for calculation of corner plots and parameter values later on
+
+        if autocorr_monitor.steps_per_tau >= autocorr_multiple:
+            print("\n\nChains run for %d total steps"%(nsteps))
+        elif autocorr_monitor.converged:
+            print("\n\n After %d steps the number of steps is %dX the autocorrelation time, finishing chain"%(nsteps,autocorr_monitor.steps_per_tau))
+        else:
+            print("\n\n After %d steps the chains have not yet converged, exiting"%(nsteps))
 
-        while not_converged:
+        if burn:
+            autocorr_monitor.save(os.path.join(output_directory,'burn_autocorr_wb%s.txt'%(str(wavelength_bin+1).zfill(4))),starting_model.namelist[:ndim])
+        else:
+            autocorr_monitor.save(os.path.join(output_directory,'prod_autocorr_wb%s.txt'%(str(wavelength_bin+1).zfill(4))),starting_model.namelist[:ndim])
 
-            if chain_number == 1:
-                sampler, highest_prob_pars, highest_prob = advance_chain(sampler,p0,nsteps,burn,save_chain,wavelength_bin)
-            else:
-                sampler, highest_prob_pars, highest_prob = advance_chain(sampler,sampler.get_last_sample(),nsteps,burn,save_chain,wavelength_bin)
-
-            total_steps = chain_number*nsteps
-
-            try:
-                auto_corr_time = np.round(total_steps/np.median(sampler.acor))
-
-                # ideal scenario, we're >= 50x the median autocorr time
-                if auto_corr_time >= 50: # taking DFM's estimate
-                    not_converged = False
-                    print("\n\nChains run for %d total steps"%(chain_number*nsteps))
-                    nsteps = total_steps # updated nsteps for calculation of corner plots and parameter values later on
-
-                # not so good scenario but chains are getting long
-                elif auto_corr_time >= 20 and total_steps >= 10000:
-                    print("\n\n After %d steps the number of steps is %dX the autocorrelation time, finishing chain"%(chain_number*nsteps,auto_corr_time))
-                    nsteps = total_steps # updated nsteps for calculation of corner plots and parameter values later on
-                    not_converged = False
-
-                # chains too long, probably won't converge now
-                elif total_steps >= 20000:
-                    print("\n\n After %d steps the chains have not yet converged, exiting"%(chain_number*nsteps))
-                    nsteps = total_steps
-                    not_converged = False
-
-                else:
-                    print("\n\n After %d steps the number of steps is %dX the autocorrelation time, running chain again"%(chain_number*nsteps,auto_corr_time))
-                    chain_number += 1
-            except:
-                if total_steps >= 20000:
-                    print("\n\n After %d steps the chains have not yet converged, exiting"%(chain_number*nsteps))
-                    nsteps = total_steps
-                    not_converged = False
-                else:
-                    print("\n\n After %d steps the chains have not yet converged, running chain again"%(chain_number*nsteps))
-                    chain_number += 1
     else:
-        sampler, highest_prob_pars, highest_prob = advance_chain(sampler,p0,nsteps,burn,save_chain,wavelength_bin)
+        sampler, highest_prob_pars, highest_prob = advance_chain(sampler,p0,nsteps,chain_store)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+        sampler.pool = None
 
     # save plots of chains
     if ndim > 1:
@@ -399,9 +783,9 @@ def run_emcee(starting_model,x,y,e,nwalk,nsteps,nthreads,burn=False,wavelength_b
 
     fig.tight_layout(h_pad=0.0)
     if burn:
-        fig.savefig('burn_chain_wb%s.png'%(str(wavelength_bin+1).zfill(4)))
+        fig.savefig(os.path.join(output_directory,'burn_chain_wb%s.png'%(str(wavelength_bin+1).zfill(4))))
     else:
-        fig.savefig('prod_chain_wb%s.png'%(str(wavelength_bin+1).zfill(4)))
+        fig.savefig(os.path.join(output_directory,'prod_chain_wb%s.png'%(str(wavelength_bin+1).zfill(4))))
     plt.close()
 
     if nsteps >= 500:
@@ -414,7 +798,7 @@ def run_emcee(starting_model,x,y,e,nwalk,nsteps,nthreads,burn=False,wavelength_b
 
     print('\n')
     # generate median, upper and lower bounds
-    med, up, low, mode = recover_quartiles_single(samples,starting_model.namelist,bin_number=(wavelength_bin+1),verbose=True,save_result=True,burn=burn)
+    med, up, low, mode = recover_quartiles_single(samples,starting_model.namelist,bin_number=(wavelength_bin+1),verbose=True,save_result=True,burn=burn,output_directory=output_directory)
 
     if not burn and ndim > 1:
         # pickle.dump(sampler,open('emcee_sampler_wb%s.pickle'%(str(wavelength_bin+1).zfill(2)),'wb'))
@@ -426,14 +810,14 @@ def run_emcee(starting_model,x,y,e,nwalk,nsteps,nthreads,burn=False,wavelength_b
         # ~ else:
             # ~ samples_corner = sampler.chain[:, int(nsteps/2):, :].reshape((-1, ndim))
 
-        make_corner_plot(samples_corner,bin_number=(wavelength_bin+1),save_fig=True,namelist=starting_model.namelist,parameter_modes=mode)
+        make_corner_plot(samples_corner,bin_number=(wavelength_bin+1),save_fig=True,namelist=starting_model.namelist,parameter_modes=mode,title=os.path.join(output_directory,'cornerplot_wb%s.png'%(str(wavelength_bin+1).zfill(4))))
 
     fitted_model = tmgp.update_model(starting_model,med)
 
+    fitted_lnlike = fitted_model.lnlike(x,y,e) # first, so that the polynomial coefficients of linear_poly_mode are solved for these parameters
     fitted_chi2 = fitted_model.chisq(x,y,e)
     fitted_reducedChi2 = fitted_model.reducedChisq(x,y,e)
     fitted_rms = fitted_model.rms(x,y,e)*1e6
-    fitted_lnlike = fitted_model.lnlike(x,y,e)
     fitted_lnprob = lnprob_emcee(med,fitted_model,x,y,e,None,sys_priors,typeII)
     fitted_BIC = fitted_model.BIC(x,y,e)
 
@@ -457,10 +841,10 @@ def run_emcee(starting_model,x,y,e,nwalk,nsteps,nthreads,burn=False,wavelength_b
     mode_model = copy.deepcopy(starting_model)
     mode_model = tmgp.update_model(mode_model,mode)
 
+    mode_lnlike = mode_model.lnlike(x,y,e) # first, so that the polynomial coefficients of linear_poly_mode are solved for these parameters
     mode_chi2 = mode_model.chisq(x,y,e)
     mode_reducedChi2 = mode_model.reducedChisq(x,y,e)
     mode_rms = mode_model.rms(x,y,e)*1e6
-    mode_lnlike = mode_model.lnlike(x,y,e)
     mode_lnprob = lnprob_emcee(mode,mode_model,x,y,e,None,sys_priors,typeII)
     mode_BIC = mode_model.BIC(x,y,e)
 
@@ -490,20 +874,22 @@ def run_emcee(starting_model,x,y,e,nwalk,nsteps,nthreads,burn=False,wavelength_b
 
         print('nsamples/median(autocorrelation time) = %d'%np.round(nsteps/np.median(sampler.acor)))
         diagnostic_tab.write('nsamples/median(autocorrelation time) = %d \n'%(np.round(nsteps/np.median(sampler.acor))))
-    except:
+    except emcee.autocorr.AutocorrError:
         print("\nAutocorrelation time can't be calculated - chains likely too short")
         diagnostic_tab.write("\nAutocorrelation time can't be calculated - chains likely too short \n")
 
     print('Acceptance fraction = %f'%(np.mean(sampler.acceptance_fraction)))
+    print('Pool backend = %s'%pool_description)
 
     diagnostic_tab.write('Acceptance fraction = %f \n'%(np.mean(sampler.acceptance_fraction)))
     diagnostic_tab.write('Total steps = %d \n'%(nsteps))
+    diagnostic_tab.write('Pool backend = %s \n'%(pool_description))
 
     diagnostic_tab.close()
 
     if not burn:
-        pickle.dump(fitted_model,open('prod_model_wb%s.pickle'%(str(wavelength_bin+1).zfill(4)),'wb'))
-        pickle.dump(mode_model,open('parameter_modes_model_wb%s.pickle'%(str(wavelength_bin+1).zfill(4)),'wb'))
+        pickle.dump(fitted_model,open(os.path.join(output_directory,'prod_model_wb%s.pickle'%(str(wavelength_bin+1).zfill(4))),'wb'))
+        pickle.dump(mode_model,open(os.path.join(output_directory,'parameter_modes_model_wb%s.pickle'%(str(wavelength_bin+1).zfill(4))),'wb'))
 
     if burn:
         print("...burn-in complete for bin %d"%(wavelength_bin+1))
@@ -515,20 +901,30 @@ def run_emcee(starting_model,x,y,e,nwalk,nsteps,nthreads,burn=False,wavelength_b
     return med,up,low,fitted_model
 
 
-def advance_chain(sampler,p0,nsteps,burn,save_chain,wavelength_bin):
+def advance_chain(sampler,p0,nsteps,chain_store=None,autocorr_monitor=None):
     """The function that advances the emcee sampler chain with a progress bar
 
     Inputs:
     sampler - the emcee sampler, intitiated in run_emcee
     p0 - the array of (starting) parameter nvalues
     nsteps - the number of steps to advance the chain over
-    burn - is this a burn chain? If so, don't save to file
-    save_chain - True/False, do we want to save the chain to file?
-    wavelength_bin - the number of the wavelength bin we're fitting, so that we can save the output correctly
+    chain_store - the ChainStore to save the chain to. Only the second half of the steps (or the last 100 steps for chains shorter than 500) are saved otherwise these files are huge! Default=None (not saved)
+    autocorr_monitor - the AutocorrelationMonitor used to stop the chain as soon as it has converged, in which case nsteps is the maximum number of steps. As the length of the chain isn't known in advance, all steps are saved
+                       and once the chain has stopped the burn-in is removed from the chain_store, keeping the same steps as used for the parameter values by run_emcee (after the first quarter of the steps, or the last 100 steps for chains shorter than 500). Default=None (run all nsteps)
 
     Returns:
     sampler - the inputted emcee sampler advanced by nsteps"""
 
+    if autocorr_monitor is not None: # we don't know how long the chain will be
+        first_saved_step = 0
+    elif nsteps > 500:
+        first_saved_step = int(nsteps/2.)+1
+    else:
+        first_saved_step = max(nsteps-99,0)
+
+    if chain_store is not None and autocorr_monitor is None:
+        chain_store.allocate(nsteps-first_saved_step)
+
     width = 100 # for progress bar
     highest_prob = 0
     print('Progress:') # for progress bar
@@ -540,19 +936,21 @@ def advance_chain(sampler,p0,nsteps,burn,save_chain,wavelength_bin):
             highest_prob_pars = pos[np.argmax(prob)]
             highest_prob = np.max(prob)
 
-        if not burn and save_chain:
-            f = open('prod_chain_wb%s.txt'%(str(wavelength_bin+1).zfill(4)),'a')
-        for k in range(pos.shape[0]):
-            # loop over all walkers and append to file
-            thisPos = pos[k]
-            thisProb = prob[k]
-            if not burn and save_chain: # only save production chain to file and only file steps otherwise these files are huge!
-                if nsteps > 500 and i > nsteps/2.:
-                    f.write("{0:4d} {1:s} {2:f}\n".format(k," ".join(map(str,thisPos)),thisProb ))
-                if nsteps < 500 and i > nsteps - 100:
-                    f.write("{0:4d} {1:s} {2:f}\n".format(k," ".join(map(str,thisPos)),thisProb ))
-        if not burn and save_chain:
-            f.close()
+        if chain_store is not None and i >= first_saved_step:
+            chain_store.save_step(pos,prob)
+
+        if autocorr_monitor is not None and autocorr_monitor.update(pos):
+            break
+
+    if chain_store is not None and autocorr_monitor is not None:
+        steps_run = i+1
+        if steps_run >= 500:
+            chain_store.discard_steps(int(steps_run/4))
+        else:
+            chain_store.discard_steps(max(steps_run-100,0))
+
+    if chain_store is not None:
+        chain_store.flush()
 
     return sampler, highest_prob_pars, highest_prob
 
@@ -8,64 +8,231 @@ import sys
 import os
 import copy
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from Tiberius.src.fitting_utils import TransitModelGPPM as tmgp
 from Tiberius.src.fitting_utils import plotting_utils as pu
 
-def systematics_model(p0,model_inputs,poly_orders,normalise_inputs=False,deconstruct_polys=False):
+def systematics_model(p0,model_inputs,poly_orders,normalise_inputs=False,deconstruct_polys=False,design_matrix=None):
 
     """
     Generate a systematics model which is fed any combination of airmass, fwhm, x positions, y positions and sky background.
 
     Input:
-    p0 -- the offset and coefficients of the model. The added offset must *always* be set at index of 0, i.e. p0[0].
+    p0 -- the offset and coefficients of the model. The added offset must *always* be set at index of 0, i.e. p0[0]. This can also be an array of shape (nsets, ncoefficients) to evaluate many sets of coefficients at once.
     model_inputs -- the ndarray of model inputs, e.g. [time,sky,x,y,...]
     poly_orders -- array of polynomial orders. This must be the same length as model_inputs and is interpreted in the same order as model_inputs, i.e. the first value given to poly_orders operates on the first vector for model_inputs
+    design_matrix -- the design matrix of model_inputs and poly_orders, as returned by polynomial_design_matrix. If this is given, model_inputs and normalise_inputs are not used, which saves recalculating the powers of the inputs for every call. Default=None
 
     example of poly_orders use:
     a cubic airmass polynomial, quadratic fwhm and xpos: model_inputs = [airmass,fwhm,xpos], poly_orders = np.array([3,2,2])
 
-    Returns: the evaluated, combined systematics model as a numpy array.
+    Returns: the evaluated, combined systematics model as a numpy array, with shape (nsets, ntimes) if p0 is 2D.
     if deconstruct_polys = True: it also returns an ndarray of each polynomial contribution to the overall model
     """
 
     # Ancillary data and poly_orders are ALWAYS in the order:
 
-    offset = p0[0] # offset added to model, which is at the start of p0
-    systematics_model = 0 # initiate systematics offset as being zero so that susbequent models can be added together
-    current_index = 0
-    individual_models = []
+    if design_matrix is None:
+        design_matrix = polynomial_design_matrix(model_inputs,poly_orders,normalise_inputs)
+
+    p0 = np.asarray(p0)
+    systematics_model = np.dot(p0,design_matrix) # includes the offset, which is at the start of p0
+
+    if deconstruct_polys:
+        individual_models = []
+        current_index = 0
+        for order in poly_orders:
+            if order > 0:
+                individual_models.append(np.dot(p0[...,1+current_index:1+current_index+order],design_matrix[1+current_index:1+current_index+order]))
+                current_index += order
+        return systematics_model,individual_models
+    else:
+        return systematics_model
+
+
+
+def polynomial_design_matrix(model_inputs,poly_orders,normalise_inputs=False):
+
+    """
+    Generate the design matrix of the systematics model, so that the model for coefficients p0 is np.dot(p0,design_matrix). This also allows the
+    model to be evaluated for many sets of coefficients at once, with p0 of shape (nsets, ncoefficients).
+
+    Input:
+    model_inputs -- the ndarray of model inputs, e.g. [time,sky,x,y,...]
+    poly_orders -- array of polynomial orders, as for systematics_model
+    normalise_inputs -- True/False: standardise each input before raising it to the polynomial powers, as for systematics_model
+
+    Returns: the design matrix with shape (1 + sum(poly_orders), ntimes). The first row (all ones) is the offset and the following rows are the powers of each input,
+    highest first, in the same order as the coefficients in p0.
+    """
+
+    rows = [np.ones(len(model_inputs[0]))]
 
     for i in range(len(model_inputs)):
         if poly_orders[i] > 0:
-            poly_coefficients = np.hstack((p0[1+current_index:1+current_index+poly_orders[i]],[0]))
-            poly = np.poly1d(poly_coefficients)
-
             if normalise_inputs:
                 input_norm = (model_inputs[i]-model_inputs[i].mean())/model_inputs[i].std()
             else:
                 input_norm = model_inputs[i]
 
-            poly_eval = poly(input_norm)
+            for power in range(poly_orders[i],0,-1):
+                rows.append(input_norm**power)
 
-            # add to current systematics model
-            systematics_model += poly_eval
-            individual_models.append(poly_eval)
+    return np.array(rows)
 
-            current_index += poly_orders[i]
 
-    if deconstruct_polys:
-        return systematics_model + offset,individual_models
-    else:
-        return systematics_model + offset
+# The fitting inputs of each worker process of fit_all_polynomial_combinations, set once by init_polynomial_worker when the pool is started
+worker_fit_inputs = None
+
+def init_polynomial_worker(starting_model,time_input,flux_input,error_input,model_inputs,sys_priors,optimiser="Nelder-Mead"):
+    """Initialise a worker process of fit_all_polynomial_combinations so that the model and data are only sent once per worker"""
+    global worker_fit_inputs
+    worker_fit_inputs = (starting_model,time_input,flux_input,error_input,model_inputs,sys_priors,optimiser)
+
+
+def fit_polynomial_candidate(candidate):
+    """Fit a single combination of polynomials in a worker process, using the inputs set by init_polynomial_worker.
+
+    Inputs:
+    candidate - tuple of (polynomial_orders, starting_values), where polynomial_orders gives the order for every model input (0 = not used) and starting_values
+                is the dictionary of parameter values to start the fit from (see set_and_fit_model)
+
+    Returns:
+    result - dictionary of the fitted statistics and parameter values, as returned by set_and_fit_model"""
+
+    polynomial_orders,starting_values = candidate
+    starting_model,time_input,flux_input,error_input,model_inputs,sys_priors,optimiser = worker_fit_inputs
+    return set_and_fit_model(starting_model,polynomial_orders,model_inputs,time_input,flux_input,error_input,sys_priors,starting_values,optimiser)
+
+
+def polynomial_candidates(ninputs,max_order):
+    """Generate every combination of model inputs and polynomial orders considered by fit_all_polynomial_combinations.
+
+    As the first model input is time, only up to a quadratic is considered for this. The other inputs are considered up to max_order.
+
+    Inputs:
+    ninputs - the number of model inputs
+    max_order - the maximum polynomial order of each input
+
+    Returns:
+    candidates - list of tuples of the polynomial order for every model input (0 = not used), excluding the combination that uses no inputs"""
+
+    order_ranges = [range(0,3)] + [range(0,max_order+1)]*(ninputs-1)
+    return [orders for orders in itertools.product(*order_ranges) if sum(orders) > 0]
+
+
+def parent_orders(polynomial_orders):
+    """The combinations of polynomials nested within polynomial_orders with one fewer coefficient, i.e. with the order of one input reduced by one"""
+    parents = []
+    for i,order in enumerate(polynomial_orders):
+        if order > 0:
+            parent = list(polynomial_orders)
+            parent[i] -= 1
+            if sum(parent) > 0:
+                parents.append(tuple(parent))
+    return parents
+
+
+def map_coefficients(parent_orders,parent_coefficients,polynomial_orders):
+    """Map the polynomial coefficients of one combination of polynomials onto another, for warm starting a fit. The offset and the coefficients of the
+    powers that both share are kept, while the new powers start at 0.
+
+    Inputs:
+    parent_orders - the polynomial orders of every model input (0 = not used) of the fitted combination
+    parent_coefficients - its coefficients, in the order of systematics_model: the offset and then the powers of each input used, highest first
+    polynomial_orders - the polynomial orders of every model input of the new combination
+
+    Returns:
+    coefficients - the starting coefficients of the new combination"""
+
+    coefficients = [parent_coefficients[0]]
+    current_index = 1
+
+    for parent_order,order in zip(parent_orders,polynomial_orders):
+        parent_block = parent_coefficients[current_index:current_index+parent_order] # highest power first
+        current_index += parent_order
+        block = np.zeros(order)
+        nshared = min(order,parent_order)
+        if nshared > 0:
+            block[order-nshared:] = parent_block[parent_order-nshared:]
+        coefficients += list(block)
+
+    return np.array(coefficients)
+
+
+def model_coefficients(model):
+    """The polynomial coefficients of a TransitModelGPPM object, whether they're fitted or fixed"""
+    return np.array([v.currVal if type(v) is tmgp.Param else v for v in [model.pars['c%d'%i] for i in range(1,model.polynomial_orders.sum()+2)]])
+
+
+def bic_lower_bound(npars,chi2_min,error_input):
+    """A lower bound on the BIC of a fit by set_and_fit_model, given the lowest chi squared that can be achieved by any combination of polynomials.
+
+    set_and_fit_model rescales the errors so that the reduced chi squared is 1 before calculating the BIC, so this is
+    BIC = npars ln(n) + n ln(2 pi) + sum(ln(error^2)) + n ln(chi2/(n-npars)) + (n-npars), which can't be lower than for chi2 = chi2_min.
 
+    Inputs:
+    npars - the number of free parameters of the model
+    chi2_min - the lowest chi squared (with the unscaled errors) of any combination of polynomials
+    error_input - the array of errors on the flux measurements
 
+    Returns:
+    the lower bound on the BIC"""
+
+    n = len(error_input)
+    return npars*np.log(n) + n*np.log(2*np.pi) + np.sum(np.log(error_input**2)) + n*np.log(chi2_min/(n-npars)) + (n-npars)
+
+
+def linear_polynomial_chi2(starting_model,values,polynomial_orders,model_inputs,time_input,flux_input,error_input):
+    """The chi squared of the best fitting combination of polynomials for fixed values of the other (transit) parameters, used by fit_all_polynomial_combinations.
+
+    As the model is linear in the polynomial coefficients, these are solved for by weighted linear least squares, which unlike an optimisation of every parameter can't fail to converge.
+
+    Inputs:
+    starting_model - a TransitModelGPPM object, whose parameters other than the polynomial coefficients are used
+    values - dictionary of the values of the parameters other than the polynomial coefficients, which replace those of the starting model
+    polynomial_orders - the polynomial order of every model input (0 = not used)
+    model_inputs - the ndarray of all basis vectors
+    time_input - array of time
+    flux_input - array of flux
+    error_input - array of errors on flux measurements
+
+    Returns:
+    chi2 - the chi squared of the best fitting polynomial coefficients"""
+
+    used = np.array(polynomial_orders) > 0
+    orders_used = np.array(polynomial_orders)[used]
+
+    d = OrderedDict()
+    for k,v in zip(starting_model.pars.keys(),starting_model.pars.values()):
+        if k[0] != "c":
+            d[k] = copy.deepcopy(v)
+            if k in values:
+                d[k].currVal = values[k]
+
+    for i in range(orders_used.sum()+1):
+        d['c%d'%(i+1)] = tmgp.Param(1.0)
+
+    current_model = tmgp.TransitModelGPPM(d,model_inputs[used],None,error_input,time_input,None,False,False,starting_model.ld_std_priors,orders_used,starting_model.ld_law)
 
+    design_matrix = current_model.polynomial_design_matrix()*current_model.transit_shape()
+    coefficients = np.linalg.lstsq((design_matrix/error_input).T,flux_input/error_input,rcond=None)[0]
 
-def fit_all_polynomial_combinations(starting_model,time_input,flux_input,error_input,model_inputs,max_order=4,sys_priors=None):
+    return np.sum(((flux_input-np.dot(coefficients,design_matrix))/error_input)**2)
+
+
+def fit_all_polynomial_combinations(starting_model,time_input,flux_input,error_input,model_inputs,max_order=4,sys_priors=None,nprocesses=1,prune=True,optimiser="Nelder-Mead"):
 
     """A function that fits all possible combinations of polynomial models.
 
-    This detrends against up to 8 basis vectors, each up to quartic in order.
+    This detrends against any number of basis vectors, each up to max_order in order (time, the first basis vector, is only considered up to quadratic).
+
+    The combinations are fitted in order of their number of coefficients, with the combinations that have the same number of coefficients fitted in parallel over
+    nprocesses processes. Each fit starts from the best fitting (lowest BIC) already-fitted combination nested within it, i.e. with one fewer coefficient. The combination
+    with every input at its maximum order is fitted first, as its chi squared is the lowest that any combination can reach. This gives a lower bound on the BIC of every
+    combination, and the combinations whose bound is above the best BIC so far are not fitted (pruned). As the fit of the most complex combination may not fully converge,
+    its chi squared is also found with the polynomial coefficients solved for by linear least squares (see linear_polynomial_chi2) at the transit parameters of every fit,
+    and the lowest of these is used. If this lowers the bound after combinations have been pruned, those whose bound is now below the best BIC are fitted after all.
 
     Takes as input:
 
@@ -76,432 +243,217 @@ def fit_all_polynomial_combinations(starting_model,time_input,flux_input,error_i
     model_inputs -- the ndarray of basis vectors
     max_order -- the maximum order of each polynomial to consider. Default = 4
     sys_prios -- the priors on the system parameters. Can be set to None for no priors
+    nprocesses -- the number of combinations to fit at once. Default = 1
+    prune -- True/False: skip the combinations whose BIC can't be lower than the best so far. Default = True
+    optimiser -- the algorithm used to fit each combination, "Nelder-Mead" or "L-BFGS-B" (see TransitModelGPPM.optimise_params). Default = "Nelder-Mead"
 
 
     Returns:
-    Nothing, but files of successful and unsuccessful fits are saved to a new directory, white_light_parametric_model_fits/.
-    The best model is the tail of the successful fits file
+    results - list of dictionaries of the results for each combination (see set_and_fit_model), which are also saved to white_light_parametric_model_fits/polynomial_combinations_tab.txt,
+    with the best combination for each statistic given at the bottom of the table.
 
     """
 
-    # generate boolean arrays of all possible combinations of True and False for an array of length equal to the number of model inputs
-    all_possible_combinations = itertools.product([True,False],repeat=len(model_inputs))
-
     try:
         os.mkdir("white_light_parametric_model_fits")
     except:
         pass
 
+    ninputs = len(model_inputs)
+    candidates = polynomial_candidates(ninputs,max_order)
+    full_orders = candidates[-1] # every input at its maximum order
+
+    # the reference model, which every fit is compared with
+    reference = {'rChi2':starting_model.reducedChisq(time_input,flux_input,error_input),
+                 'BIC':starting_model.BIC(time_input,flux_input,error_input),
+                 'AIC':starting_model.AIC(time_input,flux_input,error_input),
+                 'rms':starting_model.rms(time_input,flux_input),
+                 'beta':starting_model.red_noise_beta(time_input,flux_input,error_input)}
+    rms_cut = 1.5*reference['rms']
+
+    # the starting values of the fitted parameters other than the polynomial coefficients
+    reference_values = OrderedDict([(k,v.currVal) for k,v in starting_model.pars.items() if k[0] != "c" and type(v) is tmgp.Param])
+    reference_orders = np.zeros(ninputs,int)
+    if starting_model.poly_used:
+        reference_orders[:len(starting_model.polynomial_orders)] = starting_model.polynomial_orders
+        reference_coefficients = model_coefficients(starting_model)
+    else:
+        reference_coefficients = np.array([1.0])
+    npars_other = len(reference_values)
+
+    results = OrderedDict()
+    statuses = OrderedDict()
+
+    def starting_values(orders):
+        """The values to start the fit of a combination from: those of its best fitted parent, or the starting model"""
+        fitted_parents = [results[p] for p in parent_orders(orders) if p in results]
+        if len(fitted_parents) > 0:
+            parent = min(fitted_parents,key=lambda r: r['BIC'])
+            return {'parent':parent['polynomial_orders'],'values':parent['values'],'coefficients':map_coefficients(parent['polynomial_orders'],parent['coefficients'],orders)}
+        return {'parent':None,'values':reference_values,'coefficients':map_coefficients(reference_orders,reference_coefficients,orders)}
+
+    if nprocesses > 1:
+        pool = ProcessPoolExecutor(nprocesses,initializer=init_polynomial_worker,initargs=(starting_model,time_input,flux_input,error_input,model_inputs,sys_priors,optimiser))
+        fit_candidates = lambda batch: pool.map(fit_polynomial_candidate,batch)
+    else:
+        init_polynomial_worker(starting_model,time_input,flux_input,error_input,model_inputs,sys_priors,optimiser)
+        fit_candidates = lambda batch: map(fit_polynomial_candidate,batch)
+
+    print('Fitting %d combinations of polynomials with %d process(es)'%(len(candidates),nprocesses))
 
-    # make a reference for the best chi squared value so that subsequent fits can be compared with this
-    best_rChi2 = rChi2_cut =  3*starting_model.reducedChisq(time_input,flux_input,error_input)
-    best_BIC = starting_model.BIC(time_input,flux_input,error_input)
-    best_AIC = starting_model.AIC(time_input,flux_input,error_input)
-    best_rms = rms_cut = 1.5*starting_model.rms(time_input,flux_input)
-    best_beta = starting_model.red_noise_beta(time_input,flux_input,error_input)
-    best_rChi2_model = best_BIC_model = best_AIC_model = best_rms_model = best_beta_model = starting_model.polynomial_orders
-    best_rChi2_inputs = best_BIC_inputs = best_AIC_inputs = best_rms_inputs = best_beta_inputs = [True]*len(model_inputs)
-
-    # create results table for successful fits
-    results_tab = open('white_light_parametric_model_fits/successful_fits_results_tab.txt','w')
-    results_tab.write("Using linear polynomials as reference model...\n")
-    results_tab.write("Reference rChi2 = %.2f \n"%best_rChi2)
-    results_tab.write("Reference BIC = %.2f \n"%best_BIC)
-    results_tab.write("Reference AIC = %.2f \n"%best_AIC)
-    results_tab.write("Reference RMS = %d \n"%(best_rms*1e6))
-    results_tab.write("Reference red noise Beta = %.4f \n"%best_beta)
-    results_tab.write('---\n')
-    results_tab.write("Maximum polynomial order considered = %d \n"%max_order)
-    results_tab.write('---\n')
-    results_tab.close()
-
-    # create results table for failed fits
-    results_tab = open('white_light_parametric_model_fits/failed_fits_results_tab.txt','w')
-    results_tab.write("Using linear polynomials as reference model...\n")
-    results_tab.write("Reference rChi2 = %.2f \n"%best_rChi2)
-    results_tab.write("Reference BIC = %.2f \n"%best_BIC)
-    results_tab.write("Reference AIC = %.2f \n"%best_AIC)
-    results_tab.write("Reference RMS = %d \n"%(best_rms*1e6))
-    results_tab.write("Reference red noise Beta = %.4f \n"%best_beta)
-    results_tab.write('---\n')
-    results_tab.write("Maximum polynomial order considered = %d \n"%max_order)
-    results_tab.write('---\n')
-    results_tab.close()
-
-    # Now loop over each model input up the maximum order being considered in each.
-    # ~ print(all_possible_combinations)
-    # ~ width = len(all_possible_combinations)
-    ncombinations = 2**len(model_inputs)
-    npolys = len(model_inputs-1)*max_order+1
-    niterations = ncombinations*npolys
-    width = 100
-
-    progress_count = 0
-    print('Progress:') # for progress bar
-
-    # now loop over all possible combinations
-
-    for combination in all_possible_combinations:
-
-        n = int((width+1) * float(progress_count) / ncombinations)
-        sys.stdout.write("\r[{0}{1}]".format('#' * n, ' ' * (width - n))) # for progress bar
-        progress_count += 1
-
-        # Remove combinations that don't result in any detrending being used
-        if not np.any(combination):
-            continue
-
-        # switch on/off the detrend inputs
-        combination = np.array(combination)
-        MODEL_INPUTS = model_inputs[combination]
-        n_MODEL_INPUTS = len(np.where(combination)[0])
-
-        # We are only considering a maximum of a linear polynomial in time! Therefore time needs to be parsed as the first detrending vector in fitting_input.txt
-        if combination[0]: # combination[0] is time, therefore if time is True, set the maximum order to 2
-            first_poly_max_order = 2
-        else:
-            first_poly_max_order = max_order
+    try:
+        # the most complex combination gives the lowest chi squared that any (nested) combination can reach, if its fit converges
+        full_result = list(fit_candidates([(full_orders,starting_values(full_orders))]))[0]
+        chi2_min = min(full_result['chi2'],linear_polynomial_chi2(starting_model,full_result['values'],full_orders,model_inputs,time_input,flux_input,error_input))
 
-        for order_1 in range(1,first_poly_max_order+1):
-
-            if n_MODEL_INPUTS > 1:
-                for order_2 in range(1,max_order+1):
+        levels = OrderedDict()
+        for orders in candidates:
+            if orders != full_orders:
+                levels.setdefault(sum(orders),[]).append(orders)
 
-                    if n_MODEL_INPUTS > 2:
-                        for order_3 in range(1,max_order+1):
-
-                            if n_MODEL_INPUTS > 3:
-                                for order_4 in range(1,max_order+1):
-
-                                    if n_MODEL_INPUTS > 4:
-                                        for order_5 in range(1,max_order+1):
-
-                                            if n_MODEL_INPUTS > 5:
-                                                for order_6 in range(1,max_order+1):
-
-                                                    if n_MODEL_INPUTS > 6:
-                                                        for order_7 in range(1,max_order+1):
-
-                                                            if n_MODEL_INPUTS > 7:
-                                                                for order_8 in range(1,max_order+1):
-
-                                                                    polynomial_orders = np.array([order_1,order_2,order_3,order_4,order_5,order_6,order_7,order_8])
-                                                                    current_model,rChi2,BIC,AIC,rms,beta = set_and_fit_model(starting_model,polynomial_orders,MODEL_INPUTS,time_input,flux_input,error_input,sys_priors,rms_cut,combination)
-
-                                                                    if rChi2 < best_rChi2:
-                                                                        best_rChi2 = rChi2
-                                                                        best_rChi2_model = current_model.polynomial_orders
-                                                                        best_rChi2_inputs = combination
-
-                                                                    if BIC < best_BIC:
-                                                                        best_BIC = BIC
-                                                                        best_BIC_model = current_model.polynomial_orders
-                                                                        best_BIC_inputs = combination
-
-                                                                    if AIC < best_AIC:
-                                                                        best_AIC = AIC
-                                                                        best_AIC_model = current_model.polynomial_orders
-                                                                        best_AIC_inputs = combination
-
-                                                                    if rms < best_rms:
-                                                                        best_rms = rms
-                                                                        best_rms_model = current_model.polynomial_orders
-                                                                        best_rms_inputs = combination
-
-                                                                    if beta < best_beta:
-                                                                        best_beta = beta
-                                                                        best_beta_model = current_model.polynomial_orders
-                                                                        best_beta_inputs = combination
-
-                                                            else:
-                                                                polynomial_orders = np.array([order_1,order_2,order_3,order_4,order_5,order_6,order_7])
-                                                                current_model,rChi2,BIC,AIC,rms,beta = set_and_fit_model(starting_model,polynomial_orders,MODEL_INPUTS,time_input,flux_input,error_input,sys_priors,rms_cut,combination)
-
-                                                                if rChi2 < best_rChi2:
-                                                                    best_rChi2 = rChi2
-                                                                    best_rChi2_model = current_model.polynomial_orders
-                                                                    best_rChi2_inputs = combination
-
-                                                                if BIC < best_BIC:
-                                                                    best_BIC = BIC
-                                                                    best_BIC_model = current_model.polynomial_orders
-                                                                    best_BIC_inputs = combination
-
-                                                                if AIC < best_AIC:
-                                                                    best_AIC = AIC
-                                                                    best_AIC_model = current_model.polynomial_orders
-                                                                    best_AIC_inputs = combination
-
-                                                                if rms < best_rms:
-                                                                    best_rms = rms
-                                                                    best_rms_model = current_model.polynomial_orders
-                                                                    best_rms_inputs = combination
-
-                                                                if beta < best_beta:
-                                                                    best_beta = beta
-                                                                    best_beta_model = current_model.polynomial_orders
-                                                                    best_beta_inputs = combination
-
-                                                    else:
-                                                        polynomial_orders = np.array([order_1,order_2,order_3,order_4,order_5,order_6])
-                                                        current_model,rChi2,BIC,AIC,rms,beta = set_and_fit_model(starting_model,polynomial_orders,MODEL_INPUTS,time_input,flux_input,error_input,sys_priors,rms_cut,combination)
-
-                                                        if rChi2 < best_rChi2:
-                                                            best_rChi2 = rChi2
-                                                            best_rChi2_model = current_model.polynomial_orders
-                                                            best_rChi2_inputs = combination
-
-                                                        if BIC < best_BIC:
-                                                            best_BIC = BIC
-                                                            best_BIC_model = current_model.polynomial_orders
-                                                            best_BIC_inputs = combination
-
-                                                        if AIC < best_AIC:
-                                                            best_AIC = AIC
-                                                            best_AIC_model = current_model.polynomial_orders
-                                                            best_AIC_inputs = combination
-
-                                                        if rms < best_rms:
-                                                            best_rms = rms
-                                                            best_rms_model = current_model.polynomial_orders
-                                                            best_rms_inputs = combination
-
-                                                        if beta < best_beta:
-                                                            best_beta = beta
-                                                            best_beta_model = current_model.polynomial_orders
-                                                            best_beta_inputs = combination
-
-                                            else:
-                                                polynomial_orders = np.array([order_1,order_2,order_3,order_4,order_5])
-                                                current_model,rChi2,BIC,AIC,rms,beta = set_and_fit_model(starting_model,polynomial_orders,MODEL_INPUTS,time_input,flux_input,error_input,sys_priors,rms_cut,combination)
-
-                                                if rChi2 < best_rChi2:
-                                                    best_rChi2 = rChi2
-                                                    best_rChi2_model = current_model.polynomial_orders
-                                                    best_rChi2_inputs = combination
-
-                                                if BIC < best_BIC:
-                                                    best_BIC = BIC
-                                                    best_BIC_model = current_model.polynomial_orders
-                                                    best_BIC_inputs = combination
-
-                                                if AIC < best_AIC:
-                                                    best_AIC = AIC
-                                                    best_AIC_model = current_model.polynomial_orders
-                                                    best_AIC_inputs = combination
-
-                                                if rms < best_rms:
-                                                    best_rms = rms
-                                                    best_rms_model = current_model.polynomial_orders
-                                                    best_rms_inputs = combination
-
-                                                if beta < best_beta:
-                                                    best_beta = beta
-                                                    best_beta_model = current_model.polynomial_orders
-                                                    best_beta_inputs = combination
-
-
-                                    else:
-                                        polynomial_orders = np.array([order_1,order_2,order_3,order_4])
-                                        current_model,rChi2,BIC,AIC,rms,beta = set_and_fit_model(starting_model,polynomial_orders,MODEL_INPUTS,time_input,flux_input,error_input,sys_priors,rms_cut,combination)
-
-                                        if rChi2 < best_rChi2:
-                                            best_rChi2 = rChi2
-                                            best_rChi2_model = current_model.polynomial_orders
-                                            best_rChi2_inputs = combination
-
-                                        if BIC < best_BIC:
-                                            best_BIC = BIC
-                                            best_BIC_model = current_model.polynomial_orders
-                                            best_BIC_inputs = combination
-
-                                        if AIC < best_AIC:
-                                            best_AIC = AIC
-                                            best_AIC_model = current_model.polynomial_orders
-                                            best_AIC_inputs = combination
-
-                                        if rms < best_rms:
-                                            best_rms = rms
-                                            best_rms_model = current_model.polynomial_orders
-                                            best_rms_inputs = combination
-
-                                        if beta < best_beta:
-                                            best_beta = beta
-                                            best_beta_model = current_model.polynomial_orders
-                                            best_beta_inputs = combination
-
-                            else:
-                                polynomial_orders = np.array([order_1,order_2,order_3])
-                                current_model,rChi2,BIC,AIC,rms,beta = set_and_fit_model(starting_model,polynomial_orders,MODEL_INPUTS,time_input,flux_input,error_input,sys_priors,rms_cut,combination)
-
-                                if rChi2 < best_rChi2:
-                                    best_rChi2 = rChi2
-                                    best_rChi2_model = current_model.polynomial_orders
-                                    best_rChi2_inputs = combination
-
-                                if BIC < best_BIC:
-                                    best_BIC = BIC
-                                    best_BIC_model = current_model.polynomial_orders
-                                    best_BIC_inputs = combination
-
-                                if AIC < best_AIC:
-                                    best_AIC = AIC
-                                    best_AIC_model = current_model.polynomial_orders
-                                    best_AIC_inputs = combination
-
-                                if rms < best_rms:
-                                    best_rms = rms
-                                    best_rms_model = current_model.polynomial_orders
-                                    best_rms_inputs = combination
-
-                                if beta < best_beta:
-                                    best_beta = beta
-                                    best_beta_model = current_model.polynomial_orders
-                                    best_beta_inputs = combination
+        best_BIC = full_result['BIC']
 
+        while len(levels) > 0:
 
+            for ncoefficients,level in sorted(levels.items()):
+
+                to_fit = []
+                for orders in level:
+                    if prune and bic_lower_bound(npars_other+ncoefficients+1,chi2_min,error_input) >= best_BIC:
+                        statuses[orders] = 'pruned'
                     else:
-                        polynomial_orders = np.array([order_1,order_2])
-                        current_model,rChi2,BIC,AIC,rms,beta = set_and_fit_model(starting_model,polynomial_orders,MODEL_INPUTS,time_input,flux_input,error_input,sys_priors,rms_cut,combination)
+                        to_fit.append(orders)
 
-                        if rChi2 < best_rChi2:
-                            best_rChi2 = rChi2
-                            best_rChi2_model = current_model.polynomial_orders
-                            best_rChi2_inputs = combination
+                for result in fit_candidates([(orders,starting_values(orders)) for orders in to_fit]):
+                    orders = result['polynomial_orders']
+                    results[orders] = result
+                    statuses[orders] = 'fitted'
+                    best_BIC = min(best_BIC,result['BIC'])
+                    # in case the fit of the most complex combination didn't fully converge
+                    chi2_min = min(chi2_min,result['chi2'],linear_polynomial_chi2(starting_model,result['values'],full_orders,model_inputs,time_input,flux_input,error_input))
 
-                        if BIC < best_BIC:
-                            best_BIC = BIC
-                            best_BIC_model = current_model.polynomial_orders
-                            best_BIC_inputs = combination
+                print('%d coefficients: %d fitted, %d pruned'%(ncoefficients+1,len(to_fit),len(level)-len(to_fit)))
 
-                        if AIC < best_AIC:
-                            best_AIC = AIC
-                            best_AIC_model = current_model.polynomial_orders
-                            best_AIC_inputs = combination
+            # the bound may have dropped since some combinations were pruned, in which case these are checked again
+            levels = OrderedDict()
+            for orders,status in statuses.items():
+                if status == 'pruned' and bic_lower_bound(npars_other+sum(orders)+1,chi2_min,error_input) < best_BIC:
+                    levels.setdefault(sum(orders),[]).append(orders)
 
-                        if rms < best_rms:
-                            best_rms = rms
-                            best_rms_model = current_model.polynomial_orders
-                            best_rms_inputs = combination
+        results[full_orders] = full_result
+        statuses[full_orders] = 'fitted'
 
-                        if beta < best_beta:
-                            best_beta = beta
-                            best_beta_model = current_model.polynomial_orders
-                            best_beta_inputs = combination
+    finally:
+        if nprocesses > 1:
+            pool.shutdown()
 
+    save_polynomial_combinations(results,statuses,reference,rms_cut,max_order,'white_light_parametric_model_fits/polynomial_combinations_tab.txt')
 
-            else:
-                polynomial_orders = np.array([order_1])
-                current_model,rChi2,BIC,AIC,rms,beta = set_and_fit_model(starting_model,polynomial_orders,MODEL_INPUTS,time_input,flux_input,error_input,sys_priors,rms_cut,combination)
-
-                if rChi2 < best_rChi2:
-                    best_rChi2 = rChi2
-                    best_rChi2_model = current_model.polynomial_orders
-                    best_rChi2_inputs = combination
-
-                if BIC < best_BIC:
-                    best_BIC = BIC
-                    best_BIC_model = current_model.polynomial_orders
-                    best_BIC_inputs = combination
-
-                if AIC < best_AIC:
-                    best_AIC = AIC
-                    best_AIC_model = current_model.polynomial_orders
-                    best_AIC_inputs = combination
-
-                if rms < best_rms:
-                    best_rms = rms
-                    best_rms_model = current_model.polynomial_orders
-                    best_rms_inputs = combination
-
-                if beta < best_beta:
-                    best_beta = beta
-                    best_beta_model = current_model.polynomial_orders
-                    best_beta_inputs = combination
-
-    # make it clear which is the best model by saving at the bottom of the table
-    results_tab = open('white_light_parametric_model_fits/successful_fits_results_tab.txt','a')
-    results_tab.write('\n\n**********\n')
-    results_tab.write('BEST REDUCED CHI2 = %.2f; BEST INPUTS USED = %s; BEST POLYNOMIAL ORDERS = %s\n'%(best_rChi2,best_rChi2_inputs,best_rChi2_model))
-    results_tab.write('\n\n**********\n')
-    results_tab.write('BEST BIC = %.2f; BEST INPUTS USED = %s; BEST BIC MODEL = %s\n'%(best_BIC,best_BIC_inputs,best_BIC_model))
-    results_tab.write('\n\n**********\n')
-    results_tab.write('BEST AIC = %.2f; BEST INPUTS USED = %s; BEST AIC MODEL = %s\n'%(best_AIC,best_AIC_inputs,best_AIC_model))
-    results_tab.write('\n\n**********\n')
-    results_tab.write('BEST RMS = %d; BEST INPUTS USED = %s; BEST RMS MODEL = %s\n'%(best_rms*1e6,best_rms_inputs,best_rms_model))
-    results_tab.write('\n\n**********\n')
-    results_tab.write('BEST RED NOISE BETA = %.4f; BEST INPUTS USED = %s; BEST BETA MODEL = %s\n'%(best_beta,best_beta_inputs,best_beta_model))
-    results_tab.close()
+    return list(results.values())
 
-    return
 
+def save_polynomial_combinations(results,statuses,reference,rms_cut,max_order,filename):
+    """Save the results of fit_all_polynomial_combinations to a single table, with one row per combination of polynomials. The rows give the polynomial order of every
+    input (0 = not used), whether the combination was fitted or pruned, whether it passed the RMS cut and its statistics (nan if pruned). The combination that
+    each fit was started from is also given. The reference (starting) model and the best combination for each statistic are given as comments. If any combination
+was pruned, only the best BIC is over all combinations, so the other best rows are labelled as being over the fitted models only.
 
-def save_results(fitted_model,time_input,flux_input,error_input,rms_cut,inputs_used):
-    """A function used by fit_all_polynomial_combinations to save the output from each combination."""
+    Inputs:
+    results - dictionary of the fitted results, keyed by the polynomial orders
+    statuses - dictionary of 'fitted' or 'pruned', keyed by the polynomial orders
+    reference - dictionary of the statistics of the reference model
+    rms_cut - the RMS above which a fit is considered to have failed
+    max_order - the maximum polynomial order considered
+    filename - the name of the table
 
-    rChi2 = fitted_model.reducedChisq(time_input,flux_input,error_input)
-    BIC = fitted_model.BIC(time_input,flux_input,error_input)
-    AIC = fitted_model.AIC(time_input,flux_input,error_input)
-    rms = fitted_model.rms(time_input,flux_input)
-    beta = fitted_model.red_noise_beta(time_input,flux_input,error_input)
+    Returns:
+    Nothing"""
 
-    # if the fit is successful and passes the chi squared cut save in successful fits output
-    if rms < rms_cut:
-        results_tab = open('white_light_parametric_model_fits/successful_fits_results_tab.txt','a')
-        success = True
-    # if unsuccessful, save to failed results table
-    else:
-        results_tab = open('white_light_parametric_model_fits/failed_fits_results_tab.txt','a')
-        success = False
-
-    polynomial_orders_used = fitted_model.polynomial_orders
-
-    results_tab.write('---\nInput vectors used = %s \n'%str(inputs_used))
-    results_tab.write('Polynomial orders used = %s \n'%str(polynomial_orders_used))
-    results_tab.write('Fitted coefficients = %s \n'%([fitted_model.pars['c%d'%i].currVal for i in range(1,fitted_model.polynomial_orders.sum()+2)]))
-    results_tab.write('Reduced chisquared = %.2f \n'%rChi2)
-    results_tab.write('Standard deviation of residuals = %d ppm \n'%(rms*1e6))
-    results_tab.write('BIC = %.2f \n'%BIC)
-    results_tab.write('AIC = %.2f \n'%AIC)
-    results_tab.write('RMS = %d \n'%(rms*1e6))
-    results_tab.write('Red noise Beta = %.4f \n'%beta)
-
-    results_tab.close()
-
-    # now generate and save plots for successful fits which pass the chi squared cut
-    # ~ if success:
-        # ~ pu.plot_single_model(fitted_model,time_input,flux_input,error_input,save_fig=True,deconstruct=True)
-        # ~ os.system("mv fitted_model.pdf white_light_parametric_model_fits/fitted_model_%s.pdf"%(str(fitted_model.polynomial_orders).join('.')))
+    statistics = ['rChi2','BIC','AIC','rms','beta']
+
+    tab = open(filename,'w')
+    tab.write("# Reference model: rChi2 = %.2f, BIC = %.2f, AIC = %.2f, RMS = %d ppm, red noise Beta = %.4f\n"%(reference['rChi2'],reference['BIC'],reference['AIC'],reference['rms']*1e6,reference['beta']))
+    tab.write("# Maximum polynomial order considered = %d\n"%max_order)
+    tab.write("# polynomial_orders status success ncoefficients rChi2 BIC AIC RMS(ppm) beta started_from\n")
+
+    for orders,status in sorted(statuses.items(),key=lambda item: (sum(item[0]),item[0])):
+        orders_string = ",".join([str(o) for o in orders])
+        if status == 'fitted':
+            r = results[orders]
+            parent = "starting_model" if r['parent'] is None else ",".join([str(o) for o in r['parent']])
+            tab.write("%s %s %d %d %.4f %.4f %.4f %d %.4f %s\n"%(orders_string,status,r['rms'] < rms_cut,sum(orders)+1,r['rChi2'],r['BIC'],r['AIC'],r['rms']*1e6,r['beta'],parent))
+        else:
+            tab.write("%s %s 0 %d nan nan nan nan nan -\n"%(orders_string,status,sum(orders)+1))
+
+    # pruning only guarantees that the best BIC is global, the other statistics of the pruned combinations are unknown
+    pruned = 'pruned' in statuses.values()
+
+    for statistic in statistics:
+        if len(results) > 0:
+            best = min(results.values(),key=lambda r: r[statistic])
+            value = "%d"%(best[statistic]*1e6) if statistic == 'rms' else "%.4f"%best[statistic]
+            label = " (over fitted models only)" if pruned and statistic != 'BIC' else ""
+            tab.write("# BEST %s%s = %s; POLYNOMIAL ORDERS = %s; COEFFICIENTS = %s\n"%(statistic,label,value,",".join([str(o) for o in best['polynomial_orders']]),list(best['coefficients'])))
+
+    tab.close()
     return
 
 
-def set_and_fit_model(starting_model,polynomial_orders,model_inputs,time_input,flux_input,error_input,sys_priors,rms_cut,inputs_used):
-    """A function used by fit_all_polynomial_combinations to generate and fit the new model for each combination of polynomial."""
+def set_and_fit_model(starting_model,polynomial_orders,model_inputs,time_input,flux_input,error_input,sys_priors,starting_values=None,optimiser="Nelder-Mead"):
+    """A function used by fit_all_polynomial_combinations to generate and fit the new model for each combination of polynomial.
+
+    Inputs:
+    starting_model -- a TransitModelGPPM object, whose parameters other than the polynomial coefficients are used
+    polynomial_orders -- the polynomial order of every model input (0 = not used)
+    model_inputs -- the ndarray of all basis vectors
+    time_input -- array of time
+    flux_input -- array of flux
+    error_input -- array of errors on flux measurements
+    sys_priors -- the priors on the system parameters. Can be set to None for no priors
+    starting_values -- dictionary of the values to start the fit from: 'values', the dictionary of the parameters other than the polynomial coefficients,
+                       'coefficients', the polynomial coefficients and 'parent', the polynomial orders these came from. Default=None, which starts from
+                       the starting model's values with an offset of 1 and coefficients of 1e-3
+    optimiser -- the algorithm used to fit the model, "Nelder-Mead" or "L-BFGS-B" (see TransitModelGPPM.optimise_params). Default="Nelder-Mead"
+
+    Returns:
+    result -- dictionary of the polynomial orders, the statistics of the fit, the fitted values and coefficients and the parent it was started from"""
+
+    polynomial_orders = tuple(polynomial_orders)
+    used = np.array(polynomial_orders) > 0
+    orders_used = np.array(polynomial_orders)[used]
+
+    if starting_values is None:
+        starting_values = {'parent':None,'values':{},'coefficients':np.hstack(([1.0],1e-3*np.ones(orders_used.sum())))}
+
     d = OrderedDict()
     for k,v in zip(starting_model.pars.keys(),starting_model.pars.values()):
         if k[0] != "c":
-            d[k] = v
+            d[k] = copy.deepcopy(v)
+            if k in starting_values['values']:
+                d[k].currVal = starting_values['values'][k]
 
-    d['c1'] = tmgp.Param(1.0)
-    for i in range(1,polynomial_orders.sum()+1):
-        d['c%d'%(i+1)] = tmgp.Param(1e-3)
+    for i,c in enumerate(starting_values['coefficients']):
+        d['c%d'%(i+1)] = tmgp.Param(c)
 
-    current_model = tmgp.TransitModelGPPM(d,model_inputs,None,error_input,time_input,None,False,False,starting_model.ld_std_priors,polynomial_orders,starting_model.ld_law)
+    current_model = tmgp.TransitModelGPPM(d,model_inputs[used],None,error_input,time_input,None,False,False,starting_model.ld_std_priors,orders_used,starting_model.ld_law)
 
-    fitted_model,_ = current_model.optimise_params(time_input,flux_input,error_input,full_model=True,sys_priors=sys_priors,verbose=False)
+    fitted_model,_ = current_model.optimise_params(time_input,flux_input,error_input,full_model=True,sys_priors=sys_priors,verbose=False,optimiser=optimiser)
+    chi2 = fitted_model.chisq(time_input,flux_input,error_input)
 
     # Rescale uncertainties to give rChi2 = 1 - this wipes out the usefulness of the chi2 but makes RMS, BIC, AIC and red noise beta more comparable
     rescaled_errors = error_input*np.sqrt(fitted_model.reducedChisq(time_input,flux_input,error_input))
 
     # Refit the data
-    fitted_model,_ = fitted_model.optimise_params(time_input,flux_input,rescaled_errors,full_model=True,sys_priors=sys_priors,verbose=False)
-
-    save_results(fitted_model,time_input,flux_input,rescaled_errors,rms_cut,inputs_used)
-
-    rChi2 = fitted_model.reducedChisq(time_input,flux_input,rescaled_errors)
-    BIC = fitted_model.BIC(time_input,flux_input,rescaled_errors)
-    AIC = fitted_model.AIC(time_input,flux_input,rescaled_errors)
-    rms = fitted_model.rms(time_input,flux_input,rescaled_errors)
-    beta = fitted_model.red_noise_beta(time_input,flux_input,rescaled_errors)
-
-    return current_model,rChi2,BIC,AIC,rms,beta
+    fitted_model,_ = fitted_model.optimise_params(time_input,flux_input,rescaled_errors,full_model=True,sys_priors=sys_priors,verbose=False,optimiser=optimiser)
+    chi2 = min(chi2,fitted_model.chisq(time_input,flux_input,error_input))
+
+    result = {'polynomial_orders':polynomial_orders,'parent':starting_values['parent'],'chi2':chi2,
+              'rChi2':fitted_model.reducedChisq(time_input,flux_input,rescaled_errors),
+              'BIC':fitted_model.BIC(time_input,flux_input,rescaled_errors),
+              'AIC':fitted_model.AIC(time_input,flux_input,rescaled_errors),
+              'rms':fitted_model.rms(time_input,flux_input,rescaled_errors),
+              'beta':fitted_model.red_noise_beta(time_input,flux_input,rescaled_errors),
+              'values':OrderedDict([(k,v.currVal) for k,v in fitted_model.pars.items() if k[0] != "c" and type(v) is tmgp.Param]),
+              'coefficients':model_coefficients(fitted_model)}
+
+    return result
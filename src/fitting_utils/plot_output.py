@@ -25,6 +25,7 @@ parser.add_argument('-pn','--photon_noise',help="Use this to not use rescaled er
 parser.add_argument('-wlc','--white_light_curve',help="Are we plotting a white light fit? If so, skip plotting the transmission spectrum",action="store_true")
 parser.add_argument('-cp','--close_plots',help="If wanting to not show the plots (i.e. only wanting to save them), use this option",action="store_true")
 parser.add_argument('-rebin','--rebin_data',help="If wanting to rebin the data for light curve plotting, specify how many bins here",type=int)
+parser.add_argument('-cc','--corner_chains',help="Use this to remake the corner plots from the saved production chains (prod_chain_wbXXXX.npy, needs save_chain = 1). These use all saved steps rather than the thinned samples used by gppm_fit.py",action="store_true")
 args = parser.parse_args()
 
 
@@ -57,6 +58,18 @@ if args.save_table:
 
 directory = os.getcwd()
 
+### Remake the corner plots from the saved production chains, which are memory mapped rather than read into memory
+if args.corner_chains:
+    for i,bin_number in enumerate(completed_bins):
+        chain_file = "prod_chain_wb%s.npy"%(str(bin_number).zfill(4))
+        if not os.path.exists(chain_file):
+            print("%s not found, was save_chain = 1?"%chain_file)
+            continue
+        med,up,low,mode = mc.recover_quartiles_single(chain_file,m[i].namelist,bin_number,verbose=False)
+        mc.make_corner_plot(mc.load_chain(chain_file)[:,1:-1],bin_number,m[i].namelist,mode,save_fig=args.save_fig)
+        if args.close_plots:
+            plt.close()
+
 if not args.white_light_curve and not args.photon_noise and args.start_bin is None and args.end_bin is None:
     ### Plot the transmission spectrum & the Rp/Rs error divided by photon noise
     trans_fig = pu.recover_transmission_spectrum(directory,save_fig=args.save_fig,plot_fig=True,bin_mask=args.mask_bins,print_RpErr_over_RMS=True,save_to_tab=args.save_table,iib=args.iib)
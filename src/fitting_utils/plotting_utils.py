@@ -360,7 +360,7 @@ def plot_models(model_list,time,flux_array,error_array,wvl_centre,rebin_data=Non
     return fig
 
 
-def plot_single_model(model,time,flux,error,rebin_data=None,save_fig=False,wavelength_bin=None,deconstruct=True,plot_residual_std=0,systematics_model_inputs=None):
+def plot_single_model(model,time,flux,error,rebin_data=None,save_fig=False,wavelength_bin=None,deconstruct=True,plot_residual_std=0,systematics_model_inputs=None,directory='.'):
     """
     Plot a single light curve with model.
 
@@ -375,6 +375,7 @@ def plot_single_model(model,time,flux,error,rebin_data=None,save_fig=False,wavel
     deconstruct_gp - True/False: use if wanting to plot the contributions of each kernel to the overall GP fit. Default=True. Note: this used to be more informative when not using a single amplitude for the GP. This could do with improving.
     plot_residual_std - This can be used to overplot the standard deviation on the residuals subplot, which is useful when clipping data based on this. Set this parameter to the number of standard deviations desired. Default=0
     systematics_model_inputs - the model inputs to feed to the systematics model
+    directory - the directory the figure is saved to. Default='.' (the current working directory)
 
     Returns:
     matplotlib figure object"""
@@ -542,9 +543,9 @@ def plot_single_model(model,time,flux,error,rebin_data=None,save_fig=False,wavel
 
         if rebin_data is None:
             # ~ plt.savefig('fitted_model%s.pdf'%wb,bbox_inches='tight')
-            plt.savefig('fitted_model%s.png'%wb,bbox_inches='tight',dpi=200)
+            plt.savefig('%s/fitted_model%s.png'%(directory,wb),bbox_inches='tight',dpi=200)
         else:
-            plt.savefig('fitted_model%s_rebin_%d.png'%(wb,rebin_data),bbox_inches='tight',dpi=200)
+            plt.savefig('%s/fitted_model%s_rebin_%d.png'%(directory,wb,rebin_data),bbox_inches='tight',dpi=200)
 
         plt.close()
 
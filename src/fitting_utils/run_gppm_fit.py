@@ -1,23 +1,166 @@
 import sys
 import os
+import glob
+import shutil
+import traceback
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib.pyplot as plt
 import Tiberius
+from global_utils import parseInput
+from Tiberius.src.fitting_utils import gppm_fit
 
-Tiberius_path = "/".join(sys.argv[0].split("/")[:-1])
-starting_bin = int(sys.argv[1])
-stopping_bin = int(sys.argv[2])
-
-for i in range(starting_bin,stopping_bin):
-	os.system("python %s/gppm_fit.py %d"%(Tiberius_path,i))
-
-os.system("python %s/plot_output.py -s -st -cp"%Tiberius_path)
-os.system("python %s/model_table_generator.py"%Tiberius_path)
-try:
-	os.system("mkdir tables")
-	os.system("mkdir plots")
-	os.system("mkdir pickled_objects")
-except:
-	pass
-os.system("mv *.pickle pickled_objects/")
-os.system("mv *.txt tables/")
-os.system("mv *.png plots/")
-os.system("mv *.pdf plots/")
+
+# The tables that every bin's fit appends its results to. Each bin's outputs are saved to its own sub-directory of bin_fits/ and these tables
+# are then combined in bin order, so that they are identical to those of bins fitted one after another.
+shared_tables = ["best_fit_parameters.txt","parameter_modes_prod.txt","burn_parameters.txt","prod_statistics.txt","burn_statistics.txt","LM_statistics.txt"]
+
+# The fitting inputs of each worker process, set once by init_bin_worker when the pool is started
+worker_input_dict = None
+worker_shared_inputs = None
+
+def init_bin_worker(input_dict,input_store):
+    """Initialise a worker process of the fitting pool by attaching to the input arrays saved once to input_store, which are memory mapped rather than copied to every worker"""
+    global worker_input_dict,worker_shared_inputs
+    worker_input_dict = input_dict
+    worker_shared_inputs = gppm_fit.attach_shared_inputs(input_dict,input_store)
+
+
+def fit_bin(wb):
+    """Fit a single wavelength bin, saving its outputs to its own sub-directory of bin_fits/ and the terminal output to gppm_fit.log in that directory.
+    The working directory of the worker is not changed. Any error raised by the fit is caught so that it doesn't stop the fits to the other bins.
+
+    Inputs:
+    wb - the wavelength bin, indexed from 0
+
+    Returns:
+    wb - the wavelength bin
+    error - None if the fit completed, otherwise the traceback of the error as a string"""
+
+    bin_directory = os.path.abspath(os.path.join("bin_fits","wb%s"%(str(wb+1).zfill(4))))
+    os.makedirs(bin_directory,exist_ok=True)
+
+    # remove the tables left by a previous failed fit to this bin, which the fit would otherwise append to
+    for name in shared_tables:
+        if os.path.exists(os.path.join(bin_directory,name)):
+            os.remove(os.path.join(bin_directory,name))
+
+    error = None
+
+    with open(os.path.join(bin_directory,"gppm_fit.log"),"w") as log, contextlib.redirect_stdout(log):
+        try:
+            gppm_fit.fit_light_curve(wb,worker_input_dict,worker_shared_inputs,output_directory=bin_directory)
+        except (Exception,SystemExit):
+            error = traceback.format_exc()
+            print(error)
+        finally:
+            plt.close("all")
+
+    return wb,error
+
+
+def collect_bin_outputs(wb):
+    """Move the outputs of a completed bin fit from its sub-directory into the current working directory, appending its rows to the shared tables.
+    The shared tables are started afresh by run_all_bins before any bin is fitted.
+
+    Inputs:
+    wb - the wavelength bin, indexed from 0
+
+    Returns:
+    Nothing"""
+
+    bin_directory = os.path.join("bin_fits","wb%s"%(str(wb+1).zfill(4)))
+
+    for f in sorted(glob.glob(os.path.join(bin_directory,"*"))):
+        name = os.path.basename(f)
+        if name == "gppm_fit.log":
+            continue
+        if name in shared_tables:
+            with open(name,"a") as table, open(f) as bin_table:
+                table.write(bin_table.read())
+            os.remove(f)
+        else:
+            shutil.move(f,name)
+    return
+
+
+def run_all_bins(starting_bin,stopping_bin,nprocesses=1):
+    """Fit the wavelength bins from starting_bin up to (but not including) stopping_bin, spreading the bins over a pool of nprocesses processes.
+    The input arrays are saved once to a store of .npy files (input_store in fitting_input.txt, default shared_inputs/), which the fits of all bins attach to
+    as memory maps, and the outputs are the same as running gppm_fit.py on each bin in turn. The store is kept and reused by later runs while the input files are unchanged.
+    If nprocesses > 1, show_plots is switched off. As for gppm_fit.py, the shared tables are started afresh if starting_bin = 0, even if the fit to the first bin fails,
+    and are appended to otherwise.
+
+    Inputs:
+    starting_bin - the first wavelength bin, indexed from 0
+    stopping_bin - the wavelength bin to stop at (not fitted)
+    nprocesses - the number of bins to fit at once. Default=1
+
+    Returns:
+    failed_bins - dictionary of the tracebacks of the bins whose fits failed, keyed by bin (indexed from 0)"""
+
+    input_dict = parseInput('fitting_input.txt')
+
+    try: # older input files won't define input_store
+        input_store = input_dict['input_store']
+    except KeyError:
+        input_store = None
+    if input_store is None:
+        input_store = "shared_inputs"
+
+    gppm_fit.publish_shared_inputs(input_dict,input_store)
+
+    if nprocesses > 1:
+        input_dict['show_plots'] = "0"
+
+    # remove the tables of a previous run, which would otherwise be appended to if the fit to the first bin fails. These are not created empty,
+    # since plot_output.py reads whichever of LM_statistics.txt and prod_statistics.txt exists
+    if starting_bin == 0:
+        for name in shared_tables:
+            if os.path.exists(name):
+                os.remove(name)
+
+    failed_bins = {}
+    bins = range(starting_bin,stopping_bin)
+
+    with ProcessPoolExecutor(nprocesses,initializer=init_bin_worker,initargs=(input_dict,input_store)) as pool:
+        # map returns the bins in order, so the tables are appended to in bin order as the fits complete
+        for wb,error in pool.map(fit_bin,bins):
+            if error is None:
+                collect_bin_outputs(wb)
+                print("Bin %d complete"%(wb+1))
+            else:
+                failed_bins[wb] = error
+                print("Bin %d failed, see bin_fits/wb%s/gppm_fit.log:\n%s"%(wb+1,str(wb+1).zfill(4),error))
+
+    if len(failed_bins) > 0:
+        print("\n%d of %d bins failed: %s"%(len(failed_bins),len(bins)," ".join(["%d"%(wb+1) for wb in failed_bins])))
+
+    return failed_bins
+
+
+if __name__ == "__main__":
+
+    Tiberius_path = "/".join(sys.argv[0].split("/")[:-1])
+    starting_bin = int(sys.argv[1])
+    stopping_bin = int(sys.argv[2])
+    try:
+        nprocesses = int(sys.argv[3])
+    except IndexError:
+        nprocesses = 1
+
+    run_all_bins(starting_bin,stopping_bin,nprocesses)
+
+    os.system("python %s/plot_output.py -s -st -cp"%Tiberius_path)
+    os.system("python %s/model_table_generator.py"%Tiberius_path)
+    try:
+        os.system("mkdir tables")
+        os.system("mkdir plots")
+        os.system("mkdir pickled_objects")
+    except:
+        pass
+    os.system("mv *.pickle pickled_objects/")
+    os.system("mv prod_chain_wb*.npy pickled_objects/")
+    os.system("mv *.txt tables/")
+    os.system("mv *.png plots/")
+    os.system("mv *.pdf plots/")
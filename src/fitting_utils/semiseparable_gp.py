@@ -0,0 +1,347 @@
+import numpy as np
+from math import exp,log,factorial
+
+# The kernels that SemiseparableGP can use. These are selected in kernel_classes with a _celerite suffix, e.g. "Matern32_celerite"
+semiseparable_kernels = ['Matern32','Exp']
+
+# The white noise variance used when no white noise is fitted, as for george, for the stability of the factorisation
+TINY = 1.25e-12
+
+
+class WhiteNoise(object):
+    """Mimics the white_noise model of george.GP, whose value is the log of the white noise variance"""
+    def __init__(self,value):
+        self.value = value
+
+    def get_value(self,x):
+        return self.value*np.ones(len(x))
+
+
+class SemiseparableGP(object):
+
+    def __init__(self,kernel_class,log_constant,log_metric,white_noise=None):
+
+        """
+        A GP with a single 1D Matern32 or Exp kernel, evaluated in O(N) operations with the semiseparable Cholesky factorisation of celerite (Foreman-Mackey et al. 2017),
+        without needing celerite installed. For sorted inputs t, these kernels can be written as K_nm = exp(-c (t_n - t_m)) * U_n.V_m for n >= m, with U and V having 1 (Exp)
+        or 2 (Matern32) columns, so the covariance matrix is factorised with a single pass through the data.
+
+        This has the same interface as the george.GP objects used by TransitModelGPPM: compute, lnlikelihood, grad_lnlikelihood, predict and get/set_parameter_vector,
+        with the parameter vector ordered as george's: [white noise (if used), log amplitude, log metric].
+
+        Inputs:
+        kernel_class - Matern32 or Exp, with the same definitions as george's Matern32Kernel and ExpKernel
+        log_constant - the log of the amplitude (variance) of the kernel, as for george's ConstantKernel
+        log_metric - the log of the squared length scale, as for the metric of george's kernels
+        white_noise - the log of the white noise variance. Default=None (no fitted white noise)
+
+        Returns:
+        SemiseparableGP object
+        """
+
+        if kernel_class not in semiseparable_kernels:
+            raise ValueError("SemiseparableGP can only use the %s kernels, not %s"%(", ".join(semiseparable_kernels),kernel_class))
+
+        self.kernel_class = kernel_class
+
+        self.fit_white_noise = white_noise is not None
+        if white_noise is None:
+            self.white_noise = WhiteNoise(np.log(TINY))
+        else:
+            self.white_noise = WhiteNoise(white_noise)
+
+        self.log_constant = log_constant
+        self.log_metric = log_metric
+        self.computed = False
+        self.factorised = False
+
+
+    @property
+    def kernel(self):
+        return "ConstantKernel(log_constant=%s) * %sKernel(log_metric=%s)"%(self.log_constant,self.kernel_class,self.log_metric)
+
+
+    def get_parameter_vector(self):
+        if self.fit_white_noise:
+            return np.array([self.white_noise.value,self.log_constant,self.log_metric])
+        return np.array([self.log_constant,self.log_metric])
+
+
+    def set_parameter_vector(self,p):
+        if self.fit_white_noise:
+            self.white_noise.value,self.log_constant,self.log_metric = p
+        else:
+            self.log_constant,self.log_metric = p
+        self.factorised = False
+
+
+    def compute(self,x,yerr=0.0):
+        """Set the inputs and flux errors of the GP and factorise its covariance matrix.
+
+        Inputs:
+        x - the 1D array of inputs, which don't need to be sorted
+        yerr - the errors on the data points. Default=0
+
+        Returns:
+        Nothing"""
+
+        self.x = np.ravel(x)
+        self.order = np.argsort(self.x,kind='stable')
+        self.t = self.x[self.order] - self.x[self.order][0]
+        self.yerr2 = ((np.zeros(len(self.x))+yerr)**2)[self.order]
+
+        self.computed = True
+        self.factorise()
+
+
+    def decay_rate(self):
+        """The rate c of the exponential decay of the kernel with the distance between inputs"""
+        length_scale = np.sqrt(np.exp(self.log_metric))
+        if self.kernel_class == 'Matern32':
+            return np.sqrt(3)/length_scale
+        return 1/length_scale
+
+
+    def kernel_value(self,tau):
+        """The kernel (without white noise) evaluated at distances tau"""
+        a = np.exp(self.log_constant)
+        ctau = self.decay_rate()*np.abs(tau)
+        if self.kernel_class == 'Matern32':
+            return a*(1+ctau)*np.exp(-ctau)
+        return a*np.exp(-ctau)
+
+
+    def factorise(self):
+        """The semiseparable Cholesky factorisation K = L diag(D) L^T, with L = I + tril(U W^T) (scaled by the exponential decays), which takes a single pass through the sorted data"""
+
+        if not self.computed:
+            raise RuntimeError("compute() must be called before the GP can be used")
+
+        a = exp(self.log_constant)
+        c = self.decay_rate()
+        self.noise = self.yerr2 + np.exp(self.white_noise.value)
+
+        # K_nm = exp(-c (t_n - t_m)) * (U_n0 V_m0 + U_n1 V_m1) for n >= m. Matern32: a (1 + c t_n - c t_m). Exp: a
+        if self.kernel_class == 'Matern32':
+            U0 = (a*(1+c*self.t)).tolist()
+            U1 = -a*c
+            V1 = self.t.tolist()
+        else:
+            U0 = [a]*len(self.t)
+            U1 = 0.0
+            V1 = [0.0]*len(self.t)
+
+        phi = np.exp(-c*np.diff(self.t,prepend=self.t[0])).tolist()
+        diagonal = (a+self.noise).tolist()
+
+        N = len(self.t)
+        D = [0.0]*N
+        W0 = [0.0]*N
+        W1 = [0.0]*N
+
+        S00 = S01 = S11 = 0.0
+        for n in range(N):
+            if n > 0:
+                p2 = phi[n]*phi[n]
+                S00 = p2*(S00 + D[n-1]*W0[n-1]*W0[n-1])
+                S01 = p2*(S01 + D[n-1]*W0[n-1]*W1[n-1])
+                S11 = p2*(S11 + D[n-1]*W1[n-1]*W1[n-1])
+
+            u0 = U0[n]
+            US0 = u0*S00 + U1*S01
+            US1 = u0*S01 + U1*S11
+            Dn = diagonal[n] - u0*US0 - U1*US1
+            if not Dn > 0:
+                raise np.linalg.LinAlgError("covariance matrix is not positive definite")
+            D[n] = Dn
+            W0[n] = (1.0 - US0)/Dn
+            W1[n] = (V1[n] - US1)/Dn
+
+        self.U0,self.U1,self.phi = U0,U1,phi
+        self.D,self.W0,self.W1 = D,W0,W1
+        self.logdet = np.sum(np.log(D))
+        self.factorised = True
+
+
+    def forward(self,y):
+        """Solve L z = y for y in sorted order"""
+
+        U0,U1,phi,W0,W1 = self.U0,self.U1,self.phi,self.W0,self.W1
+        z = [0.0]*len(y)
+        f0 = f1 = 0.0
+        for n,yn in enumerate(y):
+            if n > 0:
+                f0 = phi[n]*(f0 + W0[n-1]*z[n-1])
+                f1 = phi[n]*(f1 + W1[n-1]*z[n-1])
+            z[n] = yn - U0[n]*f0 - U1*f1
+        return z
+
+
+    def apply_inverse(self,y):
+        """Return K^-1 y, for y in the original order of the inputs. y can also be 2D (ninputs, ncolumns), as for george.GP.apply_inverse"""
+
+        if not self.factorised:
+            self.factorise()
+
+        if np.ndim(y) == 2:
+            return np.array([self.apply_inverse(column) for column in np.transpose(y)]).T
+
+        z = self.forward(y[self.order].tolist())
+        z = [zn/Dn for zn,Dn in zip(z,self.D)]
+
+        U0,U1,phi,W0,W1 = self.U0,self.U1,self.phi,self.W0,self.W1
+        N = len(z)
+        x = [0.0]*N
+        g0 = g1 = 0.0
+        for n in range(N-1,-1,-1):
+            if n < N-1:
+                g0 = phi[n+1]*(g0 + U0[n+1]*x[n+1])
+                g1 = phi[n+1]*(g1 + U1*x[n+1])
+            x[n] = z[n] - W0[n]*g0 - W1[n]*g1
+
+        alpha = np.empty(N)
+        alpha[self.order] = x
+        return alpha
+
+
+    def lnlikelihood(self,y,quiet=False):
+        """The ln likelihood of the data y (with the mean already subtracted), as for george.GP.lnlikelihood. If quiet, -inf is returned if the covariance matrix can't be factorised"""
+
+        try:
+            if not self.factorised:
+                self.factorise()
+        except np.linalg.LinAlgError:
+            if quiet:
+                return -np.inf
+            raise
+
+        z = np.array(self.forward(y[self.order].tolist()))
+        chi2 = np.sum(z**2/np.array(self.D))
+
+        return -0.5*(chi2 + self.logdet + len(y)*np.log(2*np.pi))
+
+
+    def grad_lnlikelihood(self,y,quiet=False,step=1e-6):
+        """The gradient of the ln likelihood with respect to the parameter vector, calculated by central differences"""
+
+        p0 = self.get_parameter_vector()
+        grad = np.zeros(len(p0))
+        for i in range(len(p0)):
+            p = p0.copy()
+            p[i] = p0[i] + step
+            self.set_parameter_vector(p)
+            upper = self.lnlikelihood(y,quiet)
+            p[i] = p0[i] - step
+            self.set_parameter_vector(p)
+            lower = self.lnlikelihood(y,quiet)
+            grad[i] = (upper-lower)/(2*step)
+
+        self.set_parameter_vector(p0)
+        return grad
+
+
+    def predict(self,y,t=None,return_cov=True,return_var=False,kernel=None):
+        """The GP prediction at the inputs it was computed with, as for george.GP.predict.
+
+        Inputs:
+        y - the data (with the mean already subtracted)
+        t - the inputs to predict at, which must be those the GP was computed with. Default=None (the computed inputs)
+        return_cov - True/False: also return the covariance matrix of the prediction. This is calculated with dense matrices, so takes O(N^3) operations. Default=True
+        return_var - True/False: also return the variance of the prediction, in O(N) operations (takes precedence over return_cov). Default=False
+        kernel - the kernel to predict with, which can only be this GP's kernel as there are no other components. Default=None
+
+        Returns:
+        mu - the mean prediction
+        var/cov - the variance or covariance of the prediction, if requested"""
+
+        if t is not None and not np.array_equal(np.ravel(t),self.x):
+            raise ValueError("SemiseparableGP can only predict at the inputs it was computed with")
+        if kernel is not None and kernel != self.kernel:
+            raise ValueError("SemiseparableGP can only predict with its own kernel")
+
+        if not self.factorised:
+            self.factorise()
+
+        # K_f K^-1 y = (K - noise) K^-1 y
+        noise = np.empty(len(self.x))
+        noise[self.order] = self.noise
+        mu = y - noise*self.apply_inverse(y)
+
+        if return_var:
+            var = np.empty(len(self.x))
+            var[self.order] = self.smoothed_variance()
+            return mu,var
+
+        if return_cov:
+            K_f = self.kernel_value(self.x[:,None]-self.x[None,:])
+            cov = K_f - np.dot(K_f,np.linalg.solve(K_f+np.diag(noise),K_f))
+            return mu,cov
+
+        return mu
+
+
+    def state_space_model(self):
+        """The state space form of the kernel, for the sorted inputs: the stationary covariance of the states and, for each step between inputs, the transition matrix
+        and process noise covariance. Matern32 has two states (the function and its derivative) and Exp has one.
+
+        Returns:
+        P - the stationary covariance (nstates, nstates)
+        Phi - the transition matrices (ninputs, nstates, nstates), the first of which is unused
+        Sigma - the process noise covariances (ninputs, nstates, nstates), the first of which is unused"""
+
+        a = np.exp(self.log_constant)
+        c = self.decay_rate()
+        dt = np.diff(self.t,prepend=self.t[0])
+        u = c*dt
+        decay = np.exp(-u)
+
+        if self.kernel_class == 'Exp':
+            return np.array([[a]]),decay[:,None,None],(-a*np.expm1(-2*u))[:,None,None]
+
+        P = np.array([[a,0],[0,a*c**2]])
+
+        Phi = np.empty((len(u),2,2))
+        Phi[:,0,0] = decay*(1+u)
+        Phi[:,0,1] = decay*dt
+        Phi[:,1,0] = -decay*c*u
+        Phi[:,1,1] = decay*(1-u)
+
+        # Sigma = P - Phi P Phi^T, written so that there's no loss of precision when u is small
+        series = np.sum([(2*u)**k/factorial(k) for k in range(3,25)],axis=0)
+        g = np.where(u < 0.5,series,np.expm1(2*u)-2*u-2*u**2)
+
+        Sigma = np.empty((len(u),2,2))
+        Sigma[:,0,0] = a*decay**2*g
+        Sigma[:,0,1] = Sigma[:,1,0] = 2*a*c*u**2*decay**2
+        Sigma[:,1,1] = a*c**2*decay**2*(np.expm1(2*u)+2*u-2*u**2)
+
+        return P,Phi,Sigma
+
+
+    def smoothed_variance(self):
+        """The variance of the GP prediction at each of the sorted inputs, from a Kalman filter and Rauch-Tung-Striebel smoother in O(N) operations"""
+
+        P,Phi,Sigma = self.state_space_model()
+        N = len(self.t)
+
+        predicted = np.empty((N,)+P.shape)
+        filtered = np.empty((N,)+P.shape)
+
+        covariance = P
+        for n in range(N):
+            if n > 0:
+                covariance = np.dot(Phi[n],np.dot(covariance,Phi[n].T)) + Sigma[n]
+            predicted[n] = covariance
+            gain = covariance[:,0]/(covariance[0,0]+self.noise[n])
+            covariance = covariance - np.outer(gain,covariance[0])
+            filtered[n] = covariance
+
+        smoothed = filtered[-1]
+        var = np.empty(N)
+        var[-1] = smoothed[0,0]
+        for n in range(N-2,-1,-1):
+            G = np.dot(filtered[n],np.linalg.solve(predicted[n+1],Phi[n+1]).T)
+            smoothed = filtered[n] + np.dot(G,np.dot(smoothed-predicted[n+1],G.T))
+            var[n] = smoothed[0,0]
+
+        return var
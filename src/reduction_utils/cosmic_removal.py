@@ -9,6 +9,7 @@ from astropy.convolution import Gaussian2DKernel, interpolate_replace_nans
 from scipy.ndimage import gaussian_filter
 import glob
 import pickle
+from astropy.io import fits
 
 def find_cosmic_frames(spectra,ref_frame,clip=3,mad=False,ignore_edges=0,mask=None,verbose=False):
     """A function that uses the standard or median absolute deviation of residuals from each spectrum - a reference spectrum to locate cosmic rays.
@@ -299,57 +300,65 @@ def not_cosmics(cosmic_flagged_frames,cosmic_flagged_pixels,not_cosmic_list):
     return cosmic_flagged_frames[mask],cosmic_flagged_pixels[mask]
 
 
+def neighbour_medians(frame,pixel_mask):
+    """Calculate the replacement value of every pixel from its nearest good neighbours along the row. For each pixel, the left (right) neighbour
+    is the pixel immediately to the left (right) if that's not flagged, otherwise the pixel two to the left (right) if that's not flagged.
+    The replacement value is the nanmedian of these (up to) two neighbours, i.e. their mean, the single available neighbour or NaN.
+    All pixels are done at once using shifted views of the frame and mask along the last axis, so this works on a single frame or a cube of frames.
+
+    Inputs:
+    frame - the frame (2D array) or cube of frames (3D array) of values
+    pixel_mask - the boolean bad pixel mask, broadcastable to the shape of frame
+
+    Returns:
+    medians - array of the same shape as frame containing the replacement value of every pixel"""
+
+    if np.issubdtype(frame.dtype,np.floating):
+        values = frame
+    else:
+        values = frame.astype(float)
+
+    good = ~np.broadcast_to(pixel_mask,frame.shape)
+    good_values = np.where(good,values,np.nan)
+
+    left = np.full_like(values,np.nan)
+    left[...,1:] = good_values[...,:-1]
+    left[...,2:] = np.where(good[...,1:-1],good_values[...,1:-1],good_values[...,:-2])
+
+    right = np.full_like(values,np.nan)
+    right[...,:-1] = good_values[...,1:]
+    right[...,:-2] = np.where(good[...,1:-1],good_values[...,1:-1],good_values[...,2:])
+
+    return np.where(np.isnan(left),right,np.where(np.isnan(right),left,(left+right)/2))
+
+
 def interp_bad_pixels(frame,pixel_mask,return_nans=False,replace_with_medians=False):
     """Interpolate over bad pixels in a frame using a 2D interpolation over neighbouring pixels.
 
     Inputs:
-    frame - the frame (2D array) of values
-    pixel_mask - the bad pixel mask (same shape as frame)
+    frame - the frame (2D array) of values. With replace_with_medians=True, this can also be a cube (nframes x nrows x ncols) of frames.
+    pixel_mask - the bad pixel mask (same shape as frame, or a single 2D mask for a cube of frames)
     returns_nans - True/False - if True return nans at bad pixel locations, otherwise interpolate over them. Default=False.
-    replace_with_medians - True/False - if True, replace the bad pixel with the median of the surrounding pixels, as opposed to interpolating with a Gaussian kernel
+    replace_with_medians - True/False - if True, replace the bad pixel with the median of the surrounding pixels (see neighbour_medians), as opposed to interpolating with a Gaussian kernel
 
     Returns:
     frame - with bad pixels interpolated over"""
 
+    if replace_with_medians:
+        bad_pixels = np.broadcast_to(np.asarray(pixel_mask).astype(bool),frame.shape)
+        frame[bad_pixels] = neighbour_medians(frame,bad_pixels)[bad_pixels]
+        return frame
+
+    if frame.ndim == 3:
+        if np.ndim(pixel_mask) == 2:
+            return np.array([interp_bad_pixels(f,pixel_mask,return_nans) for f in frame])
+        return np.array([interp_bad_pixels(f,m,return_nans) for f,m in zip(frame,pixel_mask)])
+
     nrows,ncols = frame.shape
     for i in range(nrows):
-        if replace_with_medians:
-            for j in range(ncols):
-                if pixel_mask[i][j]:
-                    surrounding_pixels = []
-
-                    if j > 0: # lett pixel
-                        if not pixel_mask[i][j-1]: # make sure we're not using a bad pixel
-                            surrounding_pixels.append(frame[i][j-1])
-                        else:
-                            if j > 1:
-                                if not pixel_mask[i][j-2]:
-                                    surrounding_pixels.append(frame[i][j-2])
-
-
-                    if j < ncols-1: # right pixel
-                        if not pixel_mask[i][j+1]: # make sure we're not using a bad pixel
-                            surrounding_pixels.append(frame[i][j+1])
-                        else:
-                            if j < ncols-2:
-                                if not pixel_mask[i][j+2]: # make sure we're not using a bad pixel
-                                    surrounding_pixels.append(frame[i][j+2])
-
-
-                    # if i > 0: # lower pixel
-                    #     if not pixel_mask[i-1][j]: # make sure we're not using a bad pixel
-                    #         surrounding_pixels.append(frame[i-1][j])
-                    #
-                    # if i < nrows-1: # upper pixel
-                    #     if not pixel_mask[i+1][j]: # make sure we're not using a bad pixel
-                    #         surrounding_pixels.append(frame[i+1][j])
-
-                    frame[i][j] = np.nanmedian(surrounding_pixels)
+        frame[i][pixel_mask[i]] = np.nan
 
-        else:
-            frame[i][pixel_mask[i]] = np.nan
-
-    if return_nans or replace_with_medians:
+    if return_nans:
         return frame
 
     # Now use astropy to convolve bad pixels with neighbouring values
@@ -617,7 +626,7 @@ def load_segments(file_type):
     return combined_arrays
 
 
-def extract_dq_flags(dq_cube, bits_to_mask=[0, 1, 10, 11]):
+def extract_dq_flags(dq_cube, bits_to_mask=[0, 1, 10, 11], chunk_size=None):
 
     """This function locates given bad pixel flags within the 2D DQ arrays associated with JWST fits files.
 
@@ -631,38 +640,41 @@ def extract_dq_flags(dq_cube, bits_to_mask=[0, 1, 10, 11]):
 
     The full set of flags can be found at https://jwst-pipeline.readthedocs.io/en/latest/jwst/references_general/references_general.html#:~:text=is%20strongly%20discouraged.-,Data%20Quality%20Flags,-Within%20science%20data)
 
+    The bits are combined into a single bitmask which is compared against all pixels at once with np.bitwise_and.
+
     Inputs:
-    dq_cube -- the ndarray of DQ flags from a JWST fits file (equivalent to the 'DQ' fits extentsion in said file)
+    dq_cube -- the ndarray of DQ flags from a JWST fits file (equivalent to the 'DQ' fits extentsion in said file), or the path to the fits file itself, in which case the DQ extension is read in chunks of integrations
     bits_to_mask -- the pixel flags that you want to mask. Default = [0,1,10,11]
+    chunk_size -- the number of integrations to process at a time. If dq_cube is a path, this defaults to 100 integrations so that the full DQ extension is never loaded into memory at once. Default = None (all integrations at once for an ndarray)
 
     Returns:
     new_dq_cube -- the new ndarray of pixel flags that only correspond to the bad pixels you're interested in.
     """
 
-    flags_time = np.where(dq_cube!=0)[0] # finding where the pixels have a data quality flag
-    flags_y = np.where(dq_cube!=0)[1]
-    flags_x = np.where(dq_cube!=0)[2]
-
-    new_dq_cube = np.zeros_like(dq_cube)
-
-    counter=0
-
-    for i in range(len(flags_time)):
-
-        print("working on integration %d"%(i+1))
-
-        hiti = flags_time[i]
-        hity = flags_y[i]
-        hitx = flags_x[i]
-
-        binary_sum = dq_cube[flags_time[i] , flags_y[i] , flags_x[i]]
-
-        bit_array = np.flip(np.array(list(np.binary_repr(binary_sum, width=32))).astype(int))
-
-        if np.any(bit_array[bits_to_mask] == 1):
-
-            new_dq_cube[hiti, hity, hitx] = 1
-
-            counter+=1
+    if isinstance(dq_cube, str):
+        fits_file = fits.open(dq_cube, memmap=False)
+        dq_data = fits_file["DQ"].section # only reads the requested integrations from disk
+        nints = fits_file["DQ"].shape[0]
+        new_dq_cube = np.zeros(fits_file["DQ"].shape, dtype=dq_data[0:1].dtype)
+        if chunk_size is None:
+            chunk_size = 100
+    else:
+        fits_file = None
+        dq_data = dq_cube
+        nints = len(dq_cube)
+        new_dq_cube = np.zeros_like(dq_cube)
+        if chunk_size is None:
+            chunk_size = nints
+
+    bitmask = 0
+    for bit in set(bits_to_mask):
+        bitmask |= 1 << int(bit)
+
+    for start in range(0, nints, chunk_size):
+        dq_chunk = np.asarray(dq_data[start:start+chunk_size])
+        new_dq_cube[start:start+chunk_size] = np.bitwise_and(dq_chunk, np.array(bitmask).astype(dq_chunk.dtype)) != 0
+
+    if fits_file is not None:
+        fits_file.close()
 
     return(new_dq_cube)
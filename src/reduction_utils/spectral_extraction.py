@@ -12,12 +12,20 @@ import matplotlib.pyplot as plt
 import time
 import pickle
 import os
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 from collections import Counter
 from Tiberius.src.global_utils import parseInput
 try:
     import astroscrappy
 except:
     print("astroscrappy not imported, automatic cosmic ray detection can't be performed with lacosmic")
+try:
+    import h5netcdf
+except:
+    print("h5netcdf not imported, extraction checkpoints can't be saved")
 import copy
 from cosmic_removal import interp_bad_pixels
 from wavelength_calibration import rebin_spec
@@ -42,9 +50,205 @@ def BIC(model,data,error,n):
     bic = chi2 + n
     return bic
 
-def find_spectral_trace(frame,guess_location,search_width,gaussian_width,trace_poly_order,trace_spline_sf,star=None,verbose=False,co_add_rows=0,instrument=None):
+def plot_trace_row(x,row,centre_guess,trace_centre,popt,star,i,delay):
+    """Plot the Gaussian fitted to a single row during the trace detection"""
+    plt.figure(figsize=(8,6))
+    plt.plot(x,row,'bo',ms=5,label='data')
+    plt.axvline(centre_guess,label='guessed centre',color='grey',ls='--')
+    plt.axvline(trace_centre,label='fitted centre',color='r',ls='--')
+    if popt is not None:
+        plt.plot(x,gauss(x,*popt),'g',label='fit')
+    plt.title('Trace detection, star %d'%(star+1))
+    plt.xlabel('X pixel')
+    plt.ylabel('Counts at row %d'%(i+1))
+    plt.legend(loc='upper left',numpoints=1)
+    if delay == -2:
+        plt.show()
+    else:
+        plt.show(block=False)
+        plt.pause(delay)
+        plt.close()
+
+
+def co_add_trace_rows(columns_of_interest,co_add_rows,last_rows_from=None):
+    """Replace every row of the search region with the median of co_add_rows surrounding rows, using the same windows as the row-by-row
+    loop in find_spectral_trace. The medians of all windows of equal length are calculated at once.
+
+    last_rows_from sets where the windows switch to the co_add_rows preceding each row (rows > last_rows_from-co_add_rows/2). Default=None, which uses
+    the number of columns as in find_spectral_trace. The extraction loop in extract_trace_flux uses the number of rows."""
+
+    nrows,ncols = np.shape(columns_of_interest)
+    row_array = np.arange(nrows)
+
+    if last_rows_from is None:
+        last_rows_from = ncols
+
+    window_start = np.where(row_array < co_add_rows/2,row_array,np.where(row_array > last_rows_from-co_add_rows/2,row_array-co_add_rows,row_array-co_add_rows//2))
+    window_end = np.where(row_array < co_add_rows/2,row_array+co_add_rows,np.where(row_array > last_rows_from-co_add_rows/2,row_array,row_array+co_add_rows//2))
+    window_length = window_end-window_start
+
+    co_added_rows = np.zeros((nrows,ncols))
+    within_frame = (window_start >= 0) & (window_end <= nrows) & (window_length > 0)
+
+    for length in np.unique(window_length[within_frame]):
+        use_rows = within_frame & (window_length == length)
+        windows = np.lib.stride_tricks.sliding_window_view(columns_of_interest,length,axis=0)
+        co_added_rows[use_rows] = np.nanmedian(windows[window_start[use_rows]],axis=-1)
+
+    # windows falling off the edge of the frame are treated exactly as the slices of the row-by-row loop
+    for i in row_array[~within_frame]:
+        co_added_rows[i] = np.nanmedian(columns_of_interest[window_start[i]:window_end[i]],axis=0)
+
+    return co_added_rows
+
+
+def fit_gaussians_batched(x,rows,p0,maxiter=100,tolerance=1e-10):
+    """Fit the Gaussian defined by gauss to every row of a 2D array at once, using a Levenberg-Marquardt iteration with an analytic Jacobian.
+    Each row is damped and checked for convergence independently. NaNs are ignored.
+
+    Inputs:
+    x - the x pixel locations of the columns
+    rows - the 2D array (nrows x ncols) of data to fit
+    p0 - the 2D array (nrows x 4) of starting parameters [amplitude,mean,std,offset]
+    maxiter - the maximum number of iterations. Default=100
+    tolerance - the fractional change in chi2 or the parameters below which a row has converged. Default=1e-10
+
+    Returns:
+    popt - the (nrows x 4) fitted parameters
+    converged - boolean array, False for rows that didn't converge and so need refitting individually"""
+
+    nrows = len(rows)
+    weights = np.isfinite(rows)
+    y = np.where(weights,rows,0)
+    x = x[np.newaxis,:]
+
+    def residuals(p):
+        return np.where(weights,y-gauss(x,p[:,0:1],p[:,1:2],p[:,2:3],p[:,3:4]),0)
+
+    popt = np.array(p0,dtype=float)
+    r = residuals(popt)
+    chi2 = np.sum(r**2,axis=1)
+    damping = np.ones(nrows)*1e-3
+    converged = np.zeros(nrows,dtype=bool)
+
+    with np.errstate(all='ignore'):
+        for iteration in range(maxiter):
+
+            fitting = ~converged & np.isfinite(chi2)
+            if not np.any(fitting):
+                break
+
+            amplitude,mean,std = popt[:,0:1],popt[:,1:2],popt[:,2:3]
+            dx = x-mean
+            exponential = np.exp(-dx**2/std**2)
+            jacobian = np.stack([exponential,amplitude*exponential*2*dx/std**2,amplitude*exponential*2*dx**2/std**3,np.ones_like(exponential)],axis=-1)*weights[:,:,np.newaxis]
+
+            JTJ = np.einsum('rci,rcj->rij',jacobian,jacobian)
+            JTr = np.einsum('rci,rc->ri',jacobian,r)
+            A = JTJ + damping[:,np.newaxis,np.newaxis]*(JTJ*np.eye(4)) + 1e-300*np.eye(4)
+            A[~fitting] = np.eye(4)
+            JTr[~fitting] = 0
+
+            try:
+                step = np.linalg.solve(A,JTr[:,:,np.newaxis])[:,:,0]
+            except np.linalg.LinAlgError:
+                step = np.einsum('rij,rj->ri',np.linalg.pinv(A),JTr)
+
+            new_popt = popt+step
+            new_r = residuals(new_popt)
+            new_chi2 = np.sum(new_r**2,axis=1)
+
+            improved = fitting & (new_chi2 < chi2)
+            small_step = fitting & np.all(np.fabs(step) <= tolerance*(np.fabs(popt)+tolerance),axis=1)
+            converged |= (improved & (chi2-new_chi2 <= tolerance*chi2)) | small_step
+
+            popt[improved] = new_popt[improved]
+            r[improved] = new_r[improved]
+            chi2[improved] = new_chi2[improved]
+            damping[improved] /= 10
+            damping[fitting & ~improved] *= 10
+
+    converged &= np.all(np.isfinite(popt),axis=1)
+
+    return popt,converged
+
+
+def fit_trace_rows_batched(columns_of_interest,search_left_edge,gaussian_width,co_add_rows,star,log,previous_fit=None):
+    """Fit a Gaussian to every row of the search region at once with fit_gaussians_batched. Rows for which the batched fit fails are refit
+    individually with curve_fit and, as in the row-by-row loop of find_spectral_trace, fits with an unsatisfactory amplitude are replaced by the argmax.
+
+    Inputs:
+    columns_of_interest - the search region of the frame
+    search_left_edge - the column of the frame at the left hand edge of the search region
+    gaussian_width - the starting width of the Gaussian
+    co_add_rows - the number of rows to co-add, 0 for no co-adding
+    star - the index of the star being traced
+    log - the open reduction log
+    previous_fit - the (nrows x 4) Gaussian parameters of the previous frame, used as the starting guesses where they're finite. Default=None
+
+    Returns:
+    trace_centre, fwhm, gauss_std, total_errors - the arrays returned by the row-by-row loop of find_spectral_trace
+    gaussian_parameters - the (nrows x 4) fitted Gaussian parameters, NaN for rejected fits"""
+
+    if co_add_rows != 0:
+        rows = co_add_trace_rows(columns_of_interest,co_add_rows)
+    else:
+        rows = np.asarray(columns_of_interest,dtype=float)
+
+    nrows,ncols = np.shape(rows)
+    x = np.arange(ncols)+search_left_edge
+
+    centre_guess = x[np.nanargmax(rows,axis=1)]
+    amplitude = np.nanmax(rows,axis=1)
+    amplitude_offset = np.nanmin(rows,axis=1)
+
+    p0 = np.array([amplitude,centre_guess,np.ones(nrows)*gaussian_width,amplitude_offset]).T
+    if previous_fit is not None:
+        warm_start = np.all(np.isfinite(previous_fit),axis=1)
+        p0[warm_start] = previous_fit[warm_start]
+
+    gaussian_parameters,converged = fit_gaussians_batched(x,rows,p0)
+    fit_failed = np.zeros(nrows,dtype=bool)
+
+    for i in np.where(~converged)[0]:
+        finite = np.isfinite(rows[i])
+        try:
+            gaussian_parameters[i],_ = optimize.curve_fit(gauss,x[finite],rows[i][finite],p0=[amplitude[i],centre_guess[i],gaussian_width,amplitude_offset[i]])
+        except:
+            fit_failed[i] = True
+
+    # Make sure fitted amplitude (with offset) is not less than 25% of the guess amplitude.
+    accepted = ~fit_failed & (np.fabs(gaussian_parameters[:,0] + gaussian_parameters[:,3] - amplitude) < amplitude * 0.75)
+
+    for i in np.where(~accepted)[0]:
+        if fit_failed[i]:
+            print('--- Gaussian fit failed at row %d, appending argmax for trace %d'%(i+1,star+1))
+            log.write('--- Gaussian fit failed at row %d, appending argmax for trace %d \n'%(i+1,star+1))
+        else:
+            print('--- Unsatisfactory fit, appending argmax at row %d for trace %d'%(i+1,star+1))
+            log.write('--- Unsatisfactory fit, appending argmax at row %d for trace %d \n'%(i+1,star+1))
+
+    trace_centre = np.where(accepted,gaussian_parameters[:,1],centre_guess)
+    fwhm = np.where(accepted,gaussian_parameters[:,2]*2*np.sqrt(2*np.log(2)),np.nan) ### save width of gaussian as FWHM after applying conversion
+    gauss_std = np.where(accepted,np.fabs(gaussian_parameters[:,2]),0) # 0 will be replaced by the mean of surrounding rows in extract_trace_flux
+    total_errors = (~accepted).astype(int)
+
+    gaussian_parameters[~accepted] = np.nan
+
+    return trace_centre,fwhm,gauss_std,total_errors,gaussian_parameters
+
+
+def find_spectral_trace(frame,guess_location,search_width,gaussian_width,trace_poly_order,trace_spline_sf,star=None,verbose=False,co_add_rows=0,instrument=None,previous_fit=None):
     """The function used to extract the location of a spectral trace either with a Gaussian or the argmax and then
-    fits a nth order polynomial to these locations"""
+    fits a nth order polynomial to these locations. For all instruments other than Keck/NIRSPEC the Gaussians are fitted to all rows at once
+    by fit_trace_rows_batched, which can be warm-started from the Gaussians fitted to the previous frame (previous_fit).
+
+    Returns:
+    fitted_positions - the fitted location of the trace in every row
+    delay - the plotting delay to be used by extract_trace_flux
+    fwhm - the median FWHM of the trace
+    gauss_std - the standard deviation of the Gaussian fitted to every row
+    gaussian_parameters - the (nrows x 4) Gaussian parameters fitted to every row, NaN where the fit was rejected, to warm-start the next frame. None for Keck/NIRSPEC."""
 
 
     if "JWST" in instrument: # we need to extract only the first array since the frame is an array of (flux_frame,error_frame)
@@ -97,97 +301,107 @@ def find_spectral_trace(frame,guess_location,search_width,gaussian_width,trace_p
 
     log = open('reduction_output.log','a')
 
-    for i,row in enumerate(columns_of_interest):
+    if instrument != "Keck/NIRSPEC":
+        # fit all rows at once, warm-starting from the previous frame's Gaussians if given
+        trace_centre,fwhm,gauss_std,total_errors,gaussian_parameters = fit_trace_rows_batched(columns_of_interest,search_left_edge,gaussian_width,co_add_rows,star,log,previous_fit)
 
-        if co_add_rows != 0:
-            if i < co_add_rows/2:
-                row = np.nanmedian(columns_of_interest[i:i+co_add_rows],axis=0)
-            elif i > ncols-co_add_rows/2:
-                row = np.nanmedian(columns_of_interest[i-co_add_rows:i],axis=0)
-            else:
-                row = np.nanmedian(columns_of_interest[i-co_add_rows//2:i+co_add_rows//2],axis=0)
+        if plot_row < nrows:
+            if total_errors[plot_row] > 0 and not override_force_verbose:
+                force_verbose = True
+                delay = 5 # delay in seconds
 
-        x = np.arange(ncols)[np.isfinite(row)]+search_left_edge
-        row = row[np.isfinite(row)]
+            if verbose or force_verbose:
+                if co_add_rows != 0:
+                    row = co_add_trace_rows(columns_of_interest,co_add_rows)[plot_row]
+                else:
+                    row = columns_of_interest[plot_row]
+                x = np.arange(ncols)[np.isfinite(row)]+search_left_edge
+                row = row[np.isfinite(row)]
+                if np.all(np.isfinite(gaussian_parameters[plot_row])):
+                    popt1 = gaussian_parameters[plot_row]
+                else:
+                    popt1 = None
+                plot_trace_row(x,row,x[np.argmax(row)],trace_centre[plot_row],popt1,star,plot_row,delay)
+                force_verbose = False
 
-        if instrument == "Keck/NIRSPEC":
-            # clip out negative frame from A-B
-            row_residuals_1 = row - np.median(row)
-            keep_index_1 = row_residuals_1 >= -5*mad(row_residuals_1)
-            x = x[keep_index_1]
-            row = row[keep_index_1]
+    else:
+        gaussian_parameters = None
 
-            # Now use a median filter to clip out cosmic rays which are sharp positive features
-            row_median_filter = MF(row,5)
-            row_residuals_2 = row - row_median_filter
-            keep_index_2 = ((row_residuals_2 >= -5*mad(row_residuals_2)) & (row_residuals_2 <= 5*mad(row_residuals_2)))
-            x = x[keep_index_2]
-            row = row[keep_index_2]
+        for i,row in enumerate(columns_of_interest):
 
-        nerrors = 0 # running count of errors
+            if co_add_rows != 0:
+                if i < co_add_rows/2:
+                    row = np.nanmedian(columns_of_interest[i:i+co_add_rows],axis=0)
+                elif i > ncols-co_add_rows/2:
+                    row = np.nanmedian(columns_of_interest[i-co_add_rows:i],axis=0)
+                else:
+                    row = np.nanmedian(columns_of_interest[i-co_add_rows//2:i+co_add_rows//2],axis=0)
 
-        centre_guess = peak_counts_location = x[np.argmax(row)]
-        amplitude = np.nanmax(row)
-        amplitude_offset = np.nanmin(row)
+            x = np.arange(ncols)[np.isfinite(row)]+search_left_edge
+            row = row[np.isfinite(row)]
 
-        try:
-            popt1,pcov1 = optimize.curve_fit(gauss,x,row,p0=[amplitude,centre_guess,gaussian_width,amplitude_offset])
+            if instrument == "Keck/NIRSPEC":
+                # clip out negative frame from A-B
+                row_residuals_1 = row - np.median(row)
+                keep_index_1 = row_residuals_1 >= -5*mad(row_residuals_1)
+                x = x[keep_index_1]
+                row = row[keep_index_1]
 
-            # Make sure fitted amplitude (with offset) is not less than 25% of the guess amplitude. - note for ACAM this number was 0.3 (70%).
-            # print(search_left_edge,search_right_edge,popt1[1])
-            if np.fabs(popt1[0] + popt1[-1] - amplitude) < amplitude * 0.75:
-                TC = popt1[1] # trace centre
-                trace_centre.append(TC)
-                fwhm.append(popt1[2]*2*np.sqrt(2*np.log(2))) ### save width of gaussian as FWHM after applying conversion
-                gauss_std.append(abs(popt1[2]))
+                # Now use a median filter to clip out cosmic rays which are sharp positive features
+                row_median_filter = MF(row,5)
+                row_residuals_2 = row - row_median_filter
+                keep_index_2 = ((row_residuals_2 >= -5*mad(row_residuals_2)) & (row_residuals_2 <= 5*mad(row_residuals_2)))
+                x = x[keep_index_2]
+                row = row[keep_index_2]
 
+            nerrors = 0 # running count of errors
 
-            else:
-                print('--- Unsatisfactory fit, appending argmax at row %d for trace %d'%(i+1,star+1))
-                log.write('--- Unsatisfactory fit, appending argmax at row %d for trace %d \n'%(i+1,star+1))
+            centre_guess = peak_counts_location = x[np.argmax(row)]
+            amplitude = np.nanmax(row)
+            amplitude_offset = np.nanmin(row)
+
+            popt1 = None
+
+            try:
+                popt1,pcov1 = optimize.curve_fit(gauss,x,row,p0=[amplitude,centre_guess,gaussian_width,amplitude_offset])
+
+                # Make sure fitted amplitude (with offset) is not less than 25% of the guess amplitude. - note for ACAM this number was 0.3 (70%).
+                # print(search_left_edge,search_right_edge,popt1[1])
+                if np.fabs(popt1[0] + popt1[-1] - amplitude) < amplitude * 0.75:
+                    TC = popt1[1] # trace centre
+                    trace_centre.append(TC)
+                    fwhm.append(popt1[2]*2*np.sqrt(2*np.log(2))) ### save width of gaussian as FWHM after applying conversion
+                    gauss_std.append(abs(popt1[2]))
+
+
+                else:
+                    print('--- Unsatisfactory fit, appending argmax at row %d for trace %d'%(i+1,star+1))
+                    log.write('--- Unsatisfactory fit, appending argmax at row %d for trace %d \n'%(i+1,star+1))
+                    TC = centre_guess
+                    trace_centre.append(TC)
+                    nerrors += 1
+                    gauss_std.append(0) # append 0, this will be replaced by the mean of surrounding rows in extract_trace_flux
+                    fwhm.append(np.nan)
+
+
+            except:
+                print('--- Gaussian fit failed at row %d, appending argmax for trace %d'%(i+1,star+1))
+                log.write('--- Gaussian fit failed at row %d, appending argmax for trace %d \n'%(i+1,star+1))
                 TC = centre_guess
                 trace_centre.append(TC)
                 nerrors += 1
                 gauss_std.append(0) # append 0, this will be replaced by the mean of surrounding rows in extract_trace_flux
                 fwhm.append(np.nan)
 
+            total_errors.append(nerrors)
 
-        except:
-            print('--- Gaussian fit failed at row %d, appending argmax for trace %d'%(i+1,star+1))
-            log.write('--- Gaussian fit failed at row %d, appending argmax for trace %d \n'%(i+1,star+1))
-            TC = centre_guess
-            trace_centre.append(TC)
-            nerrors += 1
-            gauss_std.append(0) # append 0, this will be replaced by the mean of surrounding rows in extract_trace_flux
-            fwhm.append(np.nan)
-
-        total_errors.append(nerrors)
-
-        if nerrors > 0 and i == plot_row and not override_force_verbose:
-            force_verbose = True
-            delay = 5 # delay in seconds
+            if nerrors > 0 and i == plot_row and not override_force_verbose:
+                force_verbose = True
+                delay = 5 # delay in seconds
 
-        if verbose and i == plot_row or force_verbose:
-            plt.figure(figsize=(8,6))
-            plt.plot(x,row,'bo',ms=5,label='data')
-            plt.axvline(centre_guess,label='guessed centre',color='grey',ls='--')
-            plt.axvline(TC,label='fitted centre',color='r',ls='--')
-            try:
-                plt.plot(x,gauss(x,*popt1),'g',label='fit')
-            except:
-                pass
-            plt.title('Trace detection, star %d'%(star+1))
-            plt.xlabel('X pixel')
-            plt.ylabel('Counts at row %d'%(i+1))
-            plt.legend(loc='upper left',numpoints=1)
-            if delay == -2:
-                plt.show()
-            else:
-                plt.show(block=False)
-                plt.pause(delay)
-                plt.close()
-
-            force_verbose = False
+            if verbose and i == plot_row or force_verbose:
+                plot_trace_row(x,row,centre_guess,TC,popt1,star,i,delay)
+                force_verbose = False
 
     log.close()
 
@@ -313,7 +527,54 @@ def find_spectral_trace(frame,guess_location,search_width,gaussian_width,trace_p
 
     fwhm = np.array(fwhm)
 
-    return fitted_positions, delay, np.median(fwhm[np.isfinite(fwhm)]), np.array(gauss_std)
+    return fitted_positions, delay, np.median(fwhm[np.isfinite(fwhm)]), np.array(gauss_std), gaussian_parameters
+
+
+def trace_profile(frame,guess_location,search_width,instrument):
+    """The median spatial profile of a trace across all rows of the search region. Comparing this between frames gives a cheap measure of the shift of the trace.
+
+    Inputs:
+    frame - the 2D frame (or JWST array of flux and error frames)
+    guess_location - the approximate location of the trace
+    search_width - the half-width of the search region around guess_location
+    instrument - the instrument name
+
+    Returns:
+    profile - the median of the search region along the dispersion axis"""
+
+    if "JWST" in instrument:
+        frame = frame[0]
+
+    left_edge = max(guess_location-search_width,0)
+    right_edge = min(guess_location+search_width,np.shape(frame)[1])
+
+    return np.nanmedian(frame[:,left_edge:right_edge],axis=0)
+
+
+def measure_trace_shift(profile,reference_profile):
+    """Measure the shift in pixels of a spatial profile relative to a reference profile from the peak of their cross-correlation,
+    refined to sub-pixel precision by fitting a parabola to the three points around the peak.
+
+    Inputs:
+    profile - the spatial profile of the trace in the current frame, from trace_profile
+    reference_profile - the spatial profile of the trace in the frame where the trace was last fitted
+
+    Returns:
+    shift - the shift in pixels, positive if the trace has moved to higher pixel numbers"""
+
+    profile = np.nan_to_num(profile-np.nanmean(profile))
+    reference_profile = np.nan_to_num(reference_profile-np.nanmean(reference_profile))
+
+    cross_correlation = np.correlate(profile,reference_profile,mode='full')
+    peak = np.argmax(cross_correlation)
+
+    sub_pixel_offset = 0
+    if 0 < peak < len(cross_correlation)-1:
+        curvature = cross_correlation[peak-1]-2*cross_correlation[peak]+cross_correlation[peak+1]
+        if curvature != 0:
+            sub_pixel_offset = 0.5*(cross_correlation[peak-1]-cross_correlation[peak+1])/curvature
+
+    return peak-(len(reference_profile)-1)+sub_pixel_offset
 
 
 def extract_trace_flux(frame,trace,aperture_width,background_offset,background_width,pre_flat_frame,poly_bg_order,am,exposure_time,verbose,star,mask,instrument,row_min,gauss_std,readout_speed,co_add_rows,rectify_frame,oversampling_factor,gain_file,readnoise_file):
@@ -523,6 +784,29 @@ def extract_trace_flux(frame,trace,aperture_width,background_offset,background_w
 
     log = open('reduction_output.log','a')
 
+    if not verbose:
+        # extract all rows at once, which avoids the per-row overhead of the loop below
+        if gauss_std is not None:
+            aperture_log = open('aperture_log.log','a')
+            for i in range(nrows):
+                aperture_log.write("Trace %d, row %d, Gauss std = %f, aperture width = %f \n"%(star+1,i,gauss_std[i],aperture_width_array[i]))
+            aperture_log.close()
+
+        if "JWST" not in instrument:
+            error_frame = None
+
+        batched_output = extract_rows_batched(frame,pre_flat_frame,error_frame,trace,aperture_width,background_offset,background_width,buffer_pixels,poly_bg_order,mask,instrument,oversampling_factor,gain,readnoise,scintillation,
+                                              co_add_rows,dark_current,exposure_time)
+
+        report_background_overlaps(batched_output['lh_overlap'],batched_output['rh_overlap'],star,log)
+        log.close()
+
+        if "JWST" in instrument:
+            return batched_output['flux'],batched_output['error'],batched_output['sky_avg']
+        else:
+            return batched_output['flux'],batched_output['error'],batched_output['sky_avg'],batched_output['sky_left'],batched_output['sky_right'],batched_output['flux_base_level_left'],batched_output['flux_base_level_right'],\
+                   batched_output['max_counts'],batched_output['error_from_readnoise'],batched_output['error_from_scintillation'],batched_output['error_from_source'],batched_output['bkg_poly_orders_used'],batched_output['raw_star_flux']
+
     for i, row in enumerate(frame):
 
         if gauss_std is not None:
@@ -841,6 +1125,292 @@ def extract_trace_flux(frame,trace,aperture_width,background_offset,background_w
             plt.close()
 
     # Now print how many times the background aperture overlapped with the buffer pixels
+    report_background_overlaps(lh_overlap,rh_overlap,star,log)
+
+    log.close()
+
+    if "JWST" in instrument: # only return the key arrays since the data files are so large and consume too much memory
+        return np.array(flux),np.array(error),np.array(sky_avg)
+    else:
+        return np.array(flux),np.array(error),np.array(sky_avg),np.array(sky_left),np.array(sky_right),np.array(flux_base_level_left),np.array(flux_base_level_right),np.array(max_counts),np.array(error_from_readnoise),\
+               np.array(error_from_scintillation),np.array(error_from_source),np.array(bkg_poly_orders_used),np.array(raw_star_flux)
+
+def window_sums(values,left,right):
+    """Sum each row of a 2D array between the columns left (inclusive) and right (exclusive) using the difference of cumulative sums.
+    Windows that contain NaNs return NaN, as for a sum performed row-by-row.
+
+    Inputs:
+    values - the 2D array (nrows x ncols) to be summed
+    left - array of the left hand (inclusive) column of the window of each row
+    right - array of the right hand (exclusive) column of the window of each row
+
+    Returns:
+    window_sum - the sum within the window of each row"""
+
+    nrows,ncols = values.shape
+    rows = np.arange(nrows)
+
+    left = np.clip(left,0,ncols)
+    right = np.clip(right,left,ncols)
+
+    nonfinite = ~np.isfinite(values)
+
+    cumulative_values = np.zeros((nrows,ncols+1))
+    cumulative_values[:,1:] = np.cumsum(np.where(nonfinite,0,values),axis=1)
+
+    cumulative_nonfinite = np.zeros((nrows,ncols+1),dtype=int)
+    cumulative_nonfinite[:,1:] = np.cumsum(nonfinite,axis=1)
+
+    window_sum = cumulative_values[rows,right] - cumulative_values[rows,left]
+
+    # the few windows containing NaNs or infs are summed directly so that they behave exactly as in the row-by-row extraction
+    for i in np.where(cumulative_nonfinite[rows,right] - cumulative_nonfinite[rows,left] > 0)[0]:
+        window_sum[i] = np.sum(values[i][left[i]:right[i]])
+
+    return window_sum
+
+
+def window_medians(values,window):
+    """Take the median of each row of a 2D array within a boolean window. Windows that contain NaNs return NaN, as for np.median."""
+
+    windowed_values = np.where(window,values,np.nan)
+    window_median = np.nanmedian(windowed_values,axis=1)
+    window_median[np.any(window & np.isnan(values),axis=1)] = np.nan
+    return window_median
+
+
+def fit_background_polynomials(x,keep_idx,y_keep,order):
+    """Fit a polynomial of the given order to the kept background pixels of every row at once, via the normal equations.
+
+    Inputs:
+    x - the 2D array of the (centred and scaled) column locations of each row
+    keep_idx - the 2D boolean array of the background pixels used in the fit
+    y_keep - the 2D array of the background, 0 where not used
+    order - the order of the polynomial
+
+    Returns:
+    background_fit - the polynomial of each row evaluated at every column"""
+
+    ncoeffs = order+1
+    x_power = keep_idx.astype(float)
+    moments = []
+    weighted_y = []
+    for k in range(2*ncoeffs-1):
+        moments.append(np.sum(x_power,axis=1))
+        if k < ncoeffs:
+            weighted_y.append(np.sum(x_power*y_keep,axis=1))
+        x_power = x_power*x
+
+    moments = np.array(moments).T
+    design = moments[:,np.add.outer(np.arange(ncoeffs),np.arange(ncoeffs))]
+    coefficients = np.einsum('rij,rj->ri',np.linalg.pinv(design),np.array(weighted_y).T)
+
+    # evaluate the polynomials with Horner's method
+    background_fit = np.zeros_like(x)
+    for k in range(ncoeffs-1,-1,-1):
+        background_fit = background_fit*x + coefficients[:,k][:,np.newaxis]
+
+    return background_fit
+
+
+def extract_rows_batched(frame,pre_flat_frame,error_frame,trace,aperture_width,background_offset,background_width,buffer_pixels,poly_bg_order,mask,instrument,oversampling_factor,gain,readnoise,scintillation,co_add_rows=0,dark_current=0,exposure_time=0):
+    """The batched equivalent of the row-by-row loop within extract_trace_flux. This fits the background and sums the aperture of all rows of a frame
+    at once using 2D boolean windows, batched least-squares solves of the background polynomials and cumulative sums across the aperture.
+    This is used by extract_trace_flux whenever no plotting is requested.
+
+    Inputs:
+    frame - the 2D frame in electrons
+    pre_flat_frame - the 2D frame in electrons before flat fielding
+    error_frame - the 2D JWST error frame in electrons. None for ground-based data.
+    trace - the integer location of the trace in each row
+    aperture_width - the integer aperture width, either a single value or one value per row
+    background_offset - the offset in pixels between the aperture and the background regions
+    background_width - the width in pixels of the background regions, or 1 to use the whole width of the window
+    buffer_pixels - the number of pixels to ignore at either edge of the window. For Keck/NIRSPEC this is set row by row from the brightness of the edge columns.
+    poly_bg_order - the order of the background polynomial. 0 = no background subtraction, -1 = median background, -2 = the order from 1-4 with the lowest BIC in each row
+    mask - array of the locations of masked columns relative to the trace. None if not masking.
+    instrument - the instrument name
+    oversampling_factor - the factor by which the rows have been oversampled
+    gain - the gain, single value or 2D array
+    readnoise - the readnoise, single value or 2D array
+    scintillation - the scintillation noise
+    co_add_rows - the number of rows whose median is used to fit the background of each row, 0 for no co-adding. Default=0
+    dark_current - the dark current in electrons per pixel per hour, only used for Keck/NIRSPEC. Default=0
+    exposure_time - the exposure time in seconds, only used for the dark current. Default=0
+
+    Returns:
+    batched_output - dictionary of the arrays returned by extract_trace_flux, plus the lists of background overlaps with the buffer pixels ('lh_overlap','rh_overlap')"""
+
+    nrows,ncols = frame.shape
+    rows = np.arange(nrows)
+    columns = np.arange(ncols)[np.newaxis,:]
+
+    aperture_width = np.ones(nrows,dtype=int)*aperture_width
+    half_aperture = aperture_width//2
+
+    # Check Keck/NIRSPEC's buffer pixels, since the spatial mapping can lead to bright columns at either edge of the image
+    # Note: this assumes spectra have been rotated so that they're on the right-hand side of each image
+    if instrument == "Keck/NIRSPEC":
+        with np.errstate(invalid='ignore'):
+            bright_left = frame[:,0] > 1000
+            bright_right = frame[:,-1] > 1000
+        for i in rows[bright_left | bright_right]:
+            if bright_left[i]:
+                print("using 8 buffer pixels to the left, row %d=%f"%(i,frame[i,0]))
+            if bright_right[i]:
+                print("using 8 buffer pixels to the right, row %d=%f"%(i,frame[i,-1]))
+        buffer_pixels_left = np.where(bright_left,8*oversampling_factor,0)
+        buffer_pixels_right = np.where(bright_right,8*oversampling_factor,0)
+    else:
+        buffer_pixels_left = buffer_pixels_right = buffer_pixels
+
+    aperture_left_hand_edge = np.maximum(trace-half_aperture,buffer_pixels_left)
+    aperture_right_hand_edge = np.minimum(trace+half_aperture,ncols-buffer_pixels_right)
+
+    left_bkg_right_hand_edge = aperture_left_hand_edge - background_offset
+    right_bkg_left_hand_edge = aperture_right_hand_edge + background_offset
+
+    if background_width == 1: # we're using whole width of the window
+        left_bkg_left_hand_edge = np.ones(nrows,dtype=int)*buffer_pixels_left
+        right_bkg_right_hand_edge = np.ones(nrows,dtype=int)*(ncols-buffer_pixels_right)
+
+        # check background width is not too narrow (less than 10 pixels on either side)
+        left_bkg_width = left_bkg_right_hand_edge - left_bkg_left_hand_edge
+        lh_overlap = list(left_bkg_width[left_bkg_width < 10])
+        rh_overlap = list(left_bkg_width[right_bkg_right_hand_edge - right_bkg_left_hand_edge < 10])
+
+    else:
+        # Replace the outer edges of the background with hard edges if the chosen locations fall too close to the edge of the window
+        left_bkg_left_hand_edge = trace-half_aperture-background_offset-background_width
+        lh_overlap = list((buffer_pixels_left-left_bkg_left_hand_edge)[left_bkg_left_hand_edge <= buffer_pixels_left])
+        left_bkg_left_hand_edge = np.maximum(left_bkg_left_hand_edge,buffer_pixels_left)
+
+        right_bkg_right_hand_edge = trace+half_aperture+background_offset+background_width
+        rh_overlap = list((right_bkg_right_hand_edge-(ncols-buffer_pixels_right))[right_bkg_right_hand_edge >= ncols-buffer_pixels_right])
+        right_bkg_right_hand_edge = np.minimum(right_bkg_right_hand_edge,ncols-buffer_pixels_right)
+
+    left_bkg_window = (columns >= left_bkg_left_hand_edge[:,np.newaxis]) & (columns < left_bkg_right_hand_edge[:,np.newaxis])
+    right_bkg_window = (columns >= right_bkg_left_hand_edge[:,np.newaxis]) & (columns < right_bkg_right_hand_edge[:,np.newaxis])
+    bkg_window = left_bkg_window | right_bkg_window
+
+    if mask is not None: # Applying mask to stars
+        masked_regions = trace[:,np.newaxis] + mask[np.newaxis,:]
+        masked_rows = np.repeat(rows,len(mask)).reshape(nrows,len(mask))
+        on_chip = (masked_regions >= 0) & (masked_regions < ncols)
+        bkg_window[masked_rows[on_chip],masked_regions[on_chip]] = False
+
+    # the background of each row is fitted to the median of the co_add_rows surrounding rows, with the same windows as the row-by-row loop
+    if co_add_rows > 0:
+        background_rows = co_add_trace_rows(frame,co_add_rows,nrows)
+    else:
+        background_rows = frame
+
+    # Clip outliers (possible cosmics)
+    y = np.where(bkg_window,background_rows,np.nan)
+    y_median = np.nanmedian(y,axis=1)[:,np.newaxis]
+    y_std = np.nanstd(y,axis=1)[:,np.newaxis]
+    keep_idx = (y <= y_median+3*y_std) & (y >= y_median-3*y_std)
+
+    # Clip out-of-order background for Keck/NIRSPEC (defined as 0s)
+    if instrument == "Keck/NIRSPEC":
+        keep_idx = keep_idx & np.isfinite(y) & (abs(y) >= 1e-2)
+
+    nkeep = np.sum(keep_idx,axis=1)
+    y_keep = np.where(keep_idx,background_rows,0)
+
+    if poly_bg_order == 0: # don't perform background subtraction
+        background_fit = np.zeros_like(frame)
+        bkg_poly_orders_used = []
+
+    elif poly_bg_order == -1: # use the median of the background only, don't perform a fit
+        background_fit = np.ones_like(frame)*np.nanmedian(np.where(keep_idx,background_rows,np.nan),axis=1)[:,np.newaxis]
+        bkg_poly_orders_used = []
+
+    else: # polynomials solved for all rows at once
+        # the columns are centred and scaled to [-1,1] across the background region of each row to keep the normal equations well conditioned
+        x_centre = 0.5*(left_bkg_left_hand_edge+right_bkg_right_hand_edge)
+        x_scale = np.maximum(0.5*(right_bkg_right_hand_edge-left_bkg_left_hand_edge),1)
+        x = (columns-x_centre[:,np.newaxis])/x_scale[:,np.newaxis]
+
+        if poly_bg_order == -2: # select the order with the lowest BIC in each row, keeping the lowest order unless a higher order is strictly better as the loop does
+            for order in range(1,5):
+                order_fit = fit_background_polynomials(x,keep_idx,y_keep,order)
+
+                with np.errstate(invalid='ignore',divide='ignore'):
+                    residuals = np.where(keep_idx,(order_fit-background_rows)/np.sqrt(np.where(keep_idx,background_rows,1)),0)
+                order_BIC = np.sum(residuals*residuals,axis=1) + order*nkeep
+
+                if order == 1:
+                    background_fit = order_fit
+                    best_BIC = order_BIC
+                    bkg_poly_orders_used = np.ones(nrows,dtype=int)
+                else:
+                    better = order_BIC < best_BIC
+                    background_fit = np.where(better[:,np.newaxis],order_fit,background_fit)
+                    best_BIC = np.where(better,order_BIC,best_BIC)
+                    bkg_poly_orders_used[better] = order
+
+        else: # polynomial with user-defined order
+            background_fit = fit_background_polynomials(x,keep_idx,y_keep,poly_bg_order)
+            bkg_poly_orders_used = [poly_bg_order]*nrows
+
+    background_subtracted = frame - background_fit
+
+    with np.errstate(invalid='ignore',divide='ignore'):
+
+        # Now saving the clipped sky regions
+        sky_avg = np.sum(y_keep,axis=1)/nkeep/oversampling_factor
+        keep_left = keep_idx & (columns <= left_bkg_right_hand_edge[:,np.newaxis])
+        keep_right = keep_idx & (columns >= right_bkg_left_hand_edge[:,np.newaxis])
+        sky_left = np.sum(np.where(keep_left,background_rows,0),axis=1)/np.sum(keep_left,axis=1)/oversampling_factor
+        sky_right = np.sum(np.where(keep_right,background_rows,0),axis=1)/np.sum(keep_right,axis=1)/oversampling_factor
+
+        # the background-subtracted flux is only summed within the background-fitted region
+        flux = window_sums(background_subtracted,np.maximum(aperture_left_hand_edge,left_bkg_left_hand_edge),np.minimum(aperture_right_hand_edge,right_bkg_right_hand_edge))/oversampling_factor
+        star_counts = window_sums(frame,aperture_left_hand_edge,aperture_right_hand_edge)
+        raw_flux = window_sums(pre_flat_frame,aperture_left_hand_edge,aperture_right_hand_edge)/oversampling_factor # In units of e-
+
+        # Error calculation used http://www.ucolick.org/~bolte/AY257/s_n.pdf as a reference
+        # Note: this neglects the error in the flat field
+        if instrument == "Keck/NIRSPEC": # we include dark current but not scintillation
+            error = np.sqrt(star_counts/oversampling_factor + (aperture_width/oversampling_factor)*readnoise**2 + dark_current*(aperture_width/oversampling_factor)*exposure_time/3600.)
+        elif "JWST" in instrument: # we're using the error frame
+            error = np.sqrt(window_sums((error_frame/oversampling_factor)**2,aperture_left_hand_edge,aperture_right_hand_edge))
+        else: # I'm assuming we're looking at ACAM/EFOSC data and we're including scintillation but not dark current
+            error = np.sqrt(star_counts/oversampling_factor + (aperture_width/oversampling_factor)*readnoise**2 + scintillation**2)
+        error[star_counts <= 0] = np.nan
+
+        batched_output = {'flux':flux,'error':error,'sky_avg':sky_avg,'lh_overlap':lh_overlap,'rh_overlap':rh_overlap}
+
+        if "JWST" not in instrument:
+            # as for the built-in max of the loop, a row is nan only if the first pixel of its aperture is nan, while nans elsewhere in the aperture are skipped
+            aperture_window = (columns >= aperture_left_hand_edge[:,np.newaxis]) & (columns < aperture_right_hand_edge[:,np.newaxis])
+            counts = frame/gain/oversampling_factor # need to convert back to ADU, hence division by gain
+            max_counts = np.max(np.where(aperture_window & ~np.isnan(counts),counts,-np.inf),axis=1)
+            max_counts[np.isnan(counts[rows,np.clip(aperture_left_hand_edge,0,ncols-1)])] = np.nan
+            batched_output['max_counts'] = max_counts
+
+            if len(np.shape(readnoise)) > 1:
+                batched_output['error_from_readnoise'] = window_sums(readnoise/oversampling_factor,aperture_left_hand_edge,aperture_right_hand_edge)/raw_flux
+            else:
+                batched_output['error_from_readnoise'] = aperture_width*readnoise/raw_flux
+
+            batched_output['error_from_scintillation'] = np.ones(nrows)*scintillation
+            batched_output['error_from_source'] = np.where(raw_flux > 0,np.sqrt(raw_flux)/raw_flux,np.nan)
+
+            batched_output['sky_left'] = sky_left
+            batched_output['sky_right'] = sky_right
+            batched_output['flux_base_level_left'] = window_medians(background_subtracted,left_bkg_window)/oversampling_factor
+            batched_output['flux_base_level_right'] = window_medians(background_subtracted,right_bkg_window)/oversampling_factor
+            batched_output['bkg_poly_orders_used'] = np.array(bkg_poly_orders_used)
+            batched_output['raw_star_flux'] = star_counts/oversampling_factor
+
+    return batched_output
+
+
+def report_background_overlaps(lh_overlap,rh_overlap,star,log):
+    """Print and log how many times the background aperture overlapped with the buffer pixels"""
+
     if len(lh_overlap) != 0:
         print("For trace %d..."%(star+1))
         lh_counted = Counter(lh_overlap)
@@ -855,18 +1425,667 @@ def extract_trace_flux(frame,trace,aperture_width,background_offset,background_w
             print("Right hand edge overlaps buffer pixels by %d pixels for %d rows"%(k,rh_counted[k]))
             log.write("Right hand edge overlaps buffer pixels by %d pixels for %d rows"%(k,rh_counted[k]))
 
-    log.close()
 
-    if "JWST" in instrument: # only return the key arrays since the data files are so large and consume too much memory
-        return np.array(flux),np.array(error),np.array(sky_avg)
-    else:
-        return np.array(flux),np.array(error),np.array(sky_avg),np.array(sky_left),np.array(sky_right),np.array(flux_base_level_left),np.array(flux_base_level_right),np.array(max_counts),np.array(error_from_readnoise),\
-               np.array(error_from_scintillation),np.array(error_from_source),np.array(bkg_poly_orders_used),np.array(raw_star_flux)
+def extract_frame(i,fits_file,frame_setup,verbose=False):
+
+    """The function that reduces a single science frame: the bias and flat correction, pixel masking, rotation and resampling,
+    followed by the tracing and flux extraction of every star. This is called for every frame by extract_all_frame_fluxes, either
+    serially or by the pool of worker processes.
+
+    Inputs:
+    i - the index of the frame within the science list
+    fits_file - the opened .fits file of this frame, or for JWST the JWSTSegmentReader which streams the integrations of the segments
+    frame_setup - the dictionary of calibration frames, masks and extraction parameters set up by extract_all_frame_fluxes
+    verbose - the plotting level, as defined in extraction_input.txt
+
+    Returns:
+    frame_output - a dictionary containing the frame's time stamp ('obs_time'), exposure time ('exposure_time'), airmass ('airmass'),
+    the Keck/NIRSPEC mirror temperature ('m1temp'), the lacosmic-flagged pixels ('cosmic_pixels') and a list of (trace, fwhm, extracted_arrays)
+    tuples for each extracted star ('stars'), where extracted_arrays are the arrays returned by extract_trace_flux"""
+
+    master_bias = frame_setup['master_bias']
+    master_flat = frame_setup['master_flat']
+    bad_pixel_mask = frame_setup['bad_pixel_mask']
+    cosmic_pixel_mask = frame_setup['cosmic_pixel_mask']
+    use_mask = frame_setup['use_mask']
+    gain_file = frame_setup['gain_file']
+    readnoise_file = frame_setup['readnoise_file']
+    oversampling_factor = frame_setup['oversampling_factor']
+
+    rotate_frame = frame_setup['rotate_frame']
+    row_min = frame_setup['row_min']
+    row_max = frame_setup['row_max']
+    instrument = frame_setup['instrument']
+    readout_speed = frame_setup['readout_speed']
+    nwindows = frame_setup['nwindows']
+
+    guess_location = frame_setup['guess_locations']
+    search_width = frame_setup['search_width']
+    gaussian_width = frame_setup['gaussian_width']
+    trace_poly_order = frame_setup['trace_poly_order']
+    trace_spline_sf = frame_setup['trace_spline_sf']
+    co_add_rows = frame_setup['co_add_rows']
+    trace_refit_interval = frame_setup['trace_refit_interval']
+    trace_drift_tolerance = frame_setup['trace_drift_tolerance']
+
+    aperture_width = frame_setup['aperture_width']
+    background_offset = frame_setup['background_offset']
+    background_width = frame_setup['background_width']
+    poly_bg_order = frame_setup['poly_bg_order']
+    rectify_frame = frame_setup['rectify_frame']
+    nstars = frame_setup['nstars']
+    masks = frame_setup['masks']
+    NIRSPEC_order = frame_setup['NIRSPEC_order']
+    use_lacosmic = frame_setup['use_lacosmic']
+    ACAM_linearity_correction = frame_setup['ACAM_linearity_correction']
+    gaussian_defined_aperture = frame_setup['gaussian_defined_aperture']
+
+    frame_output = {'obs_time':None,'exposure_time':None,'airmass':None,'m1temp':None,'cosmic_pixels':None,'stars':[]}
+
+    for window in range(1,nwindows+1):
+
+        if master_bias is None and "JWST" not in instrument:
+            if instrument == 'ACAM':
+                master_bias = np.zeros_like(fits_file[window].data)
+            else:
+                master_bias = np.zeros_like(fits_file[window-1].data)
+
+        if nwindows > 1:
+            bias = master_bias[window-1]
+        else:
+            bias = master_bias
+
+        if nwindows > 1 and master_flat is not None:
+            flat = master_flat[window-1]
+        else:
+            flat = master_flat
+
+        if window == 1:
+
+            if instrument == "ACAM":
+                obs_time = fits_file[0].header['MJD-OBS']
+                exposure_time = fits_file[0].header['EXPTIME']
+                am = fits_file[0].header['AIRMASS']
+
+            elif instrument == "EFOSC":
+                obs_time = fits_file[0].header['MJD-OBS']
+                exposure_time = fits_file[0].header['EXPTIME']
+                am = fits_file[0].header['HIERARCH ESO TEL AIRM START']
+
+            elif "JWST" in instrument:
+                sci,err,obs_time,exposure_time = fits_file.read_integration(i)
+                am = 0
+
+            elif instrument == "Keck/NIRSPEC":
+                exposure_time = fits_file[0].header["ITIME"] / 1e3
+                obs_date = fits_file[0].header["DATE-OBS"]
+                obs_start = Time(obs_date + "T" + fits_file[0].header["UTSTART"])
+                obs_mid = obs_start + TimeDelta(exposure_time/2,format='sec')
+                obs_time = obs_mid.mjd
+                am = fits_file[0].header["AIRMASS"]
+                frame_output['m1temp'] = fits_file[0].header["SPEC1TMP"]
+
+            else:
+                obs_time = 0
+                exposure_time = 0
+                am = 0
+
+            frame_output['obs_time'] = obs_time
+            frame_output['exposure_time'] = exposure_time
+            frame_output['airmass'] = am
+
+        if instrument == 'ACAM':
+            frame = fits_file[window].data - bias
+        elif "JWST" in instrument: # we're not performing a bias correction as this is done in jwst stage0
+            frame = np.array([sci,err])
+        else:
+            frame = fits_file[window-1].data - bias
+
+        uncorrected_frame = frame.astype(float)
+
+        if master_flat is not None and "JWST" not in instrument: # this doesn't apply for jwst data as this is done in jwst stage0
+            if instrument == 'ACAM':
+                frame = (fits_file[window].data - bias) / flat
+            else:
+                frame = (fits_file[window-1].data - bias) / flat
+
+        # replace inf with nan
+        if "JWST" in instrument:
+            if np.any(~np.isfinite(frame[0])):
+                frame[0][~np.isfinite(frame[0])] = np.nan
+        else:
+            if np.any(~np.isfinite(frame)):
+                frame[~np.isfinite(frame)] = np.nan
+
+
+        if use_mask:
+            if bad_pixel_mask is not None:
+                if len(bad_pixel_mask.shape) > 2:
+                    bad_pixel_mask = bad_pixel_mask[i]
+            if bad_pixel_mask is not None and cosmic_pixel_mask is None:
+                pixel_mask = bad_pixel_mask
+            if bad_pixel_mask is None and cosmic_pixel_mask is not None:
+                pixel_mask = cosmic_pixel_mask[i]
+            if bad_pixel_mask is not None and cosmic_pixel_mask is not None:
+                pixel_mask = bad_pixel_mask + cosmic_pixel_mask[i]
+
+            if verbose != -1 and verbose != 0 and i == 0 or verbose != -1 and verbose != 0 and cosmic_pixel_mask is not None:
+                plt.figure()
+                plt.imshow(pixel_mask, interpolation='none',aspect="auto")
+                plt.title("Pixel mask, frame %d"%i)
+                plt.ylabel("Pixel column")
+                plt.xlabel("Pixel row")
+                if verbose == -2:
+                    plt.show()
+                if verbose > 0:
+                    plt.show(block=False)
+                    plt.pause(verbose)
+                    plt.close()
+
+            original_frame = frame.copy()
+            # for JWST, this replaces the bad pixels of the flux and error frames at once
+            frame = interp_bad_pixels(frame,pixel_mask,replace_with_medians=True)
+
+            if verbose != -1 and verbose != 0 and i == 0 or verbose != -1 and verbose != 0 and cosmic_pixel_mask is not None:
+                plt.figure()
+
+                plt.subplot(211)
+                if "JWST" in instrument:
+                    vmin,vmax = np.nanpercentile(original_frame[0],[10,70])
+                    plt.imshow(original_frame[0],vmin=vmin,vmax=vmax,aspect="auto")
+                # elif instrument == "Keck/NIRSPEC":
+                #     vmin,vmax = 0,500
+                else:
+                    vmin,vmax = np.nanpercentile(original_frame,[10,70])
+                    plt.imshow(original_frame,vmin=vmin,vmax=vmax,aspect="auto")
+                plt.title("Pre-pixel-masked frame")
+                plt.xticks(visible=False)
+                # ~ plt.xlabel("Pixel column")
+                plt.ylabel("Pixel row")
+
+
+                plt.subplot(212)
+                if "JWST" in instrument:
+                    vmin,vmax = np.nanpercentile(frame[0],[10,70])
+                    plt.imshow(frame[0],vmin=vmin,vmax=vmax,aspect="auto")
+                # elif instrument == "Keck/NIRSPEC":
+                #     vmin,vmax = 0,500
+                else:
+                    vmin,vmax = np.nanpercentile(frame,[10,70])
+                    plt.imshow(frame,vmin=vmin,vmax=vmax,aspect="auto")
+
+                plt.title("Post-pixel-masked frame")
+                plt.xlabel("Pixel column")
+                plt.ylabel("Pixel row")
+
+                if verbose == -2:
+                    plt.show()
+                if verbose > 0:
+                    plt.show(block=False)
+                    plt.pause(verbose)
+                    plt.close()
+
+        else:
+            pixel_mask=None
+
+
+        if NIRSPEC_order is not None:
+            if i == 0 and verbose:
+                v = verbose
+            else:
+                v = False
+
+            frame = KO.mask_NIRSPEC_data(frame,NIRSPEC_order,v)
+
+
+        #if use_lacosmic and instrument == 'ACAM':
+            #frame,_ = lacosmic.lacosmic(frame,0.5,15,15,effective_gain=1.9,readnoise=7)
+        if use_lacosmic and instrument == "Keck/NIRSPEC" and cosmic_pixel_mask is None:
+            cosmic_search_frame = copy.deepcopy(frame)
+            cosmic_search_frame[~np.isfinite(cosmic_search_frame)] = 0
+            cosmic_search_frame[cosmic_search_frame < 0] = 0
+
+            # frame[~np.isfinite(frame)] = 0
+            # frame[frame < 0] = 0
+            cosmic_pixels,_ = astroscrappy.detect_cosmics(cosmic_search_frame[row_min:row_max], gain=3.01,readnoise=11.56, \
+                                                      satlevel=np.inf, inmask=pixel_mask[row_min:row_max], sepmed=False, \
+                                                      cleantype='medmask', fsmode='median',verbose=True,sigclip=5,objlim=10,niter=8)
+            # frame[frame == 0] = np.nan
+            frame[row_min:row_max] = interp_bad_pixels(frame[row_min:row_max],cosmic_pixels)
+
+            if verbose != -1 and verbose != 0:
+                plt.figure(figsize=(4,12))
+                plt.imshow(cosmic_pixels,aspect="auto")
+                plt.title("Lacosmic-flagged cosmic pixels")
+                if verbose == -2:
+                    plt.show()
+                if verbose > 0:
+                    plt.show(block=False)
+                    plt.pause(verbose)
+                    plt.close()
+
+            frame_output['cosmic_pixels'] = cosmic_pixels
+
+        if rotate_frame:
+            if "JWST" in instrument:
+                frame = np.array([np.flip(frame[0].T,axis=1),np.flip(frame[1].T,axis=1)])
+                uncorrected_frame = np.array([np.flip(uncorrected_frame[0].T,axis=1),np.flip(uncorrected_frame[1].T,axis=1)])
+            else:
+                frame = np.flip(frame.T,axis=1)
+                uncorrected_frame = np.flip(uncorrected_frame.T,axis=1)
+
+        if "JWST" in instrument:
+            frame = np.array([frame[0][row_min:row_max].astype(float),frame[1][row_min:row_max].astype(float)])
+            uncorrected_frame = np.array([uncorrected_frame[0][row_min:row_max],uncorrected_frame[1][row_min:row_max]])
+        else:
+            frame = frame[row_min:row_max].astype(float)
+            uncorrected_frame = uncorrected_frame[row_min:row_max]
+
+        if oversampling_factor > 1:
+            # nrows,ncols = frame.shape
+            if "JWST" in instrument:
+                frame = np.array([resample_frame(frame[0],oversampling_factor,verbose=verbose),resample_frame(frame[1],oversampling_factor)])
+                uncorrected_frame = np.array([resample_frame(uncorrected_frame[0],oversampling_factor),resample_frame(uncorrected_frame[1],oversampling_factor)])
+            else:
+                frame = resample_frame(frame,oversampling_factor,verbose=verbose)
+                uncorrected_frame = resample_frame(uncorrected_frame,oversampling_factor)
+            # oversampling_factor = ((ncols-1)*oversampling+1)/ncols
+
+
+        if ACAM_linearity_correction and instrument == 'ACAM':
+            frame = ((-0.007/65000)*frame + 1)*frame # from ACAM webpages
+
+        if nwindows == 1:
+            loop_range = range(nstars)
+        else:
+            loop_range = range(1)
+
+        for star_number in loop_range:
+
+            if nwindows > 1:
+                star_number += window - 1
+
+            if search_width[star_number] > 0:
+                block = i//frame_setup['frame_block_size']
+
+                # reuse the cached trace if it was fitted within the last trace_refit_interval frames of this block and the trace hasn't drifted
+                cached_trace = frame_setup['trace_cache'].get(star_number)
+                trace_shift = None
+                if cached_trace is not None and cached_trace['frame']//frame_setup['frame_block_size'] == block and i-cached_trace['frame'] < trace_refit_interval:
+                    trace_shift = measure_trace_shift(trace_profile(frame,guess_location[star_number],search_width[star_number],instrument),cached_trace['profile'])
+                    if abs(trace_shift) > trace_drift_tolerance:
+                        print("Trace %d has shifted by %.3f pixels, refitting the trace"%(star_number+1,trace_shift))
+                        trace_shift = None
+
+                if trace_shift is not None:
+                    trace = cached_trace['fitted_positions'] + trace_shift
+                    fwhm = cached_trace['fwhm']
+                    gauss_std = cached_trace['gauss_std']
+                    force_verbose = verbose
+
+                else:
+                    # warm-start the Gaussian fits from the last frame fitted within this block of frames
+                    previous_fit = frame_setup['trace_fits'].get(star_number)
+                    if previous_fit is not None and previous_fit[0]//frame_setup['frame_block_size'] == block:
+                        previous_fit = previous_fit[1]
+                    else:
+                        previous_fit = None
+
+                    trace, force_verbose, fwhm, gauss_std, gaussian_parameters = find_spectral_trace(frame,guess_location[star_number],search_width[star_number],gaussian_width,trace_poly_order,trace_spline_sf,star_number,verbose,co_add_rows,instrument,previous_fit)
+                    frame_setup['trace_fits'][star_number] = (i,gaussian_parameters)
+
+                    if trace_refit_interval > 1:
+                        frame_setup['trace_cache'][star_number] = {'frame':i,'fitted_positions':trace,'fwhm':fwhm,'gauss_std':gauss_std,\
+                                                                   'profile':trace_profile(frame,guess_location[star_number],search_width[star_number],instrument)}
+            else:
+                trace = np.ones(row_max-row_min)*guess_location[star_number]
+                fwhm = gauss_std = np.ones(row_max-row_min)
+                force_verbose = verbose
+
+            if gaussian_defined_aperture:
+
+                # Smooth the FWHMs with a quadratic polynomial
+                gauss_std_poly = np.poly1d(np.polyfit(np.arange(0,row_max-row_min),gauss_std,trace_poly_order))
+                gauss_std_smooth = gauss_std_poly(np.arange(0,row_max-row_min))
+
+                # refit with outliers clipped
+                gauss_std_residuals = gauss_std - gauss_std_poly(np.arange(0,row_max-row_min))
+                gauss_std_keep_idx = abs(gauss_std_residuals) <= 4*np.std(gauss_std_residuals)
 
-def extract_all_frame_fluxes(science_list,master_bias,master_flat,trace_dict,window_dict,extraction_dict,verbose=False,bad_pixel_mask=None,cosmic_pixel_mask=None,oversampling_factor=1,gain_file=None,readnoise_file=None):
+                gauss_std_poly = np.poly1d(np.polyfit(np.arange(0,row_max-row_min)[gauss_std_keep_idx],gauss_std[gauss_std_keep_idx],trace_poly_order))
+                gauss_std_smooth = gauss_std_poly(np.arange(0,row_max-row_min))
+
+                if verbose != -1 and verbose != 0:
+                    plt.figure()
+                    plt.plot(np.arange(row_min,row_max),gauss_std,label="Std dev of trace")
+                    plt.plot(np.arange(row_min,row_max)[~gauss_std_keep_idx],gauss_std[~gauss_std_keep_idx],"rx",label="Clipped outlier")
+                    plt.plot(np.arange(row_min,row_max),gauss_std_smooth,label="Smoothed with polynomial (order = %d)"%trace_poly_order)
+                    plt.xlabel("Pixel number")
+                    plt.ylabel("Standard deviation (pixels)")
+                    plt.title("Gaussian-defined aperture widths")
+                    if verbose == -2:
+                        plt.show()
+                    if verbose > 0:
+                        plt.show(block=False)
+                        plt.pause(verbose)
+                        plt.close()
+
+                trace_std = gauss_std_smooth*2*np.sqrt(2*np.log(2))
+
+            else:
+                trace_std = None
+
+            if "JWST" in instrument: # only return the key arrays since the data files are so large and consume too much memory
+                extracted_arrays = extract_trace_flux(frame,trace,aperture_width[star_number],background_offset[star_number],\
+                                                                                                background_width[star_number],uncorrected_frame[0],poly_bg_order[star_number],am,\
+                                                                                                exposure_time,force_verbose,star_number,masks['mask%d'%(star_number+1)],instrument,row_min,trace_std,readout_speed,co_add_rows,rectify_frame,oversampling_factor,\
+                                                                                                gain_file,readnoise_file)
+
+            else:
+                extracted_arrays = extract_trace_flux(frame,trace,aperture_width[star_number],background_offset[star_number],\
+                                                                            background_width[star_number],uncorrected_frame,poly_bg_order[star_number],am,\
+                                                                            exposure_time,force_verbose,star_number,masks['mask%d'%(star_number+1)],instrument,row_min,trace_std,readout_speed,co_add_rows,rectify_frame,oversampling_factor,\
+                                                                            gain_file,readnoise_file)
+
+                plt.close("all")
+
+            frame_output['stars'].append((trace,fwhm,extracted_arrays))
+
+    return frame_output
+
+
+class JWSTSegmentReader(object):
+    """Stream the integrations of the JWST segments (.fits files) in chunks of consecutive integrations, rather than holding every SCI and
+    ERR cube in memory at once. Only the headers and INT_TIMES tables are read up front. The SCI and ERR integrations are read chunk_size
+    at a time and, if prefetch is True, the next chunk is read on a background thread while the current chunk is being extracted. A segment
+    is closed once the reader moves on to a later segment, so the memory used scales with the chunk size and not with the size of the visit.
+
+    Inputs:
+    segment_list - the list of JWST segments (.fits files) in time order
+    chunk_size - the number of integrations read from a segment at once
+    prefetch - True/False - read the chunk following the current one on a background thread"""
+
+    def __init__(self,segment_list,chunk_size=20,prefetch=True):
+
+        self.segment_list = list(segment_list)
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+
+        # read the number of integrations from the SCI header so that the cubes are not loaded
+        self.int_mid_times = []
+        self.exposure_times = []
+        nints = []
+        for s in self.segment_list:
+            with fits.open(s,memmap=False) as fits_file:
+                nints.append(fits_file["SCI"].header["NAXIS3"])
+                self.int_mid_times.append(np.array(fits_file["INT_TIMES"].data["int_mid_BJD_TDB"]))
+                self.exposure_times.append(fits_file[0].header["EFFINTTM"])
+        self.nints = np.cumsum(nints)
+        self.total_nints = self.nints[-1]
+
+        self.open_segment = None
+        self.open_fits_file = None
+        self.current_chunk = None
+        self.current_data = None
+        self.next_chunk = None
+        self.next_data = None
+        self.executor = None
+        self.lock = threading.Lock() # the file reads of the main and the background threads must not interleave
+
+    def locate_integration(self,i):
+        """Convert the index of an integration within the full time series into the index of the segment which contains it
+        and the index of the integration within that segment.
+
+        Inputs:
+        i - the index of the integration within the full time series
+
+        Returns:
+        segment - the index of the segment
+        index - the index of the integration within the segment"""
+
+        segment = np.digitize(i,self.nints)
+        # the previous i-nints[segment] gave a negative index, which only picked the right integration through numpy's wrap-around indexing.
+        # The chunked reads need the positive index to find the chunk, so this counts from the end of the previous segment instead
+        if segment > 0:
+            index = i-self.nints[segment-1]
+        else:
+            index = i
+        return segment,index
+
+    def following_chunk(self,chunk):
+        """Return the (segment, chunk number) that follows the given chunk, or None at the end of the visit"""
+        segment,chunk_number = chunk
+        segment_nints = self.nints[segment]-(self.nints[segment-1] if segment > 0 else 0)
+        if (chunk_number+1)*self.chunk_size < segment_nints:
+            return (segment,chunk_number+1)
+        if segment+1 < len(self.segment_list):
+            return (segment+1,0)
+        return None
+
+    def read_chunk(self,chunk):
+        """Read the SCI and ERR integrations of a chunk. Moving on to a later segment closes the previous one.
+
+        Inputs:
+        chunk - tuple of (segment index, chunk number within the segment)
+
+        Returns:
+        sci - the SCI integrations of the chunk
+        err - the ERR integrations of the chunk"""
+
+        segment,chunk_number = chunk
+        with self.lock:
+            if segment != self.open_segment:
+                if self.open_fits_file is not None:
+                    self.open_fits_file.close()
+                self.open_fits_file = fits.open(self.segment_list[segment],memmap=False)
+                self.open_segment = segment
+            start = chunk_number*self.chunk_size
+            sci = self.open_fits_file["SCI"].section[start:start+self.chunk_size]
+            err = self.open_fits_file["ERR"].section[start:start+self.chunk_size]
+        return sci,err
+
+    def read_integration(self,i):
+        """Return the flux and error frames, mid-time and exposure time of an integration, reading (or collecting the prefetched) chunk
+        which contains it if it is not the current chunk.
+
+        Inputs:
+        i - the index of the integration within the full time series
+
+        Returns:
+        sci - the 2D flux frame
+        err - the 2D error frame
+        obs_time - the BJD_TDB at the middle of the integration
+        exposure_time - the effective integration time of the segment"""
+
+        segment,index = self.locate_integration(i)
+        chunk = (segment,index//self.chunk_size)
+
+        if chunk != self.current_chunk:
+            if chunk == self.next_chunk:
+                self.current_data = self.next_data.result()
+            else:
+                if self.next_data is not None:
+                    self.next_data.result() # don't leave a read running on a segment which is about to be closed
+                self.current_data = self.read_chunk(chunk)
+            self.current_chunk = chunk
+            self.next_chunk = None
+            self.next_data = None
+
+            if self.prefetch:
+                next_chunk = self.following_chunk(chunk)
+                if next_chunk is not None:
+                    if self.executor is None:
+                        self.executor = ThreadPoolExecutor(max_workers=1)
+                    self.next_chunk = next_chunk
+                    self.next_data = self.executor.submit(self.read_chunk,next_chunk)
+
+        sci,err = self.current_data
+        index_in_chunk = index % self.chunk_size
+        return sci[index_in_chunk],err[index_in_chunk],self.int_mid_times[segment][index],self.exposure_times[segment]
+
+    def close(self):
+        """Stop the background thread and close the open segment"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        if self.open_fits_file is not None:
+            self.open_fits_file.close()
+            self.open_fits_file = None
+            self.open_segment = None
+        self.current_chunk = self.current_data = self.next_chunk = self.next_data = None
+
+
+# Frames are processed in blocks of (at least) this many consecutive frames: the trace fits are only warm-started and the cached traces only reused
+# within a block, and the worker pool is handed one block at a time, so that serial and parallel extractions fit the same traces
+frame_block_size = 20
+
+# The frame_setup dictionary of each worker process, set once by init_frame_worker when the pool is started
+worker_frame_setup = None
+
+def init_frame_worker(frame_setup):
+    """Initialise a worker process of the extraction pool so that the calibration frames, masks and extraction parameters are only sent once per worker.
+    For JWST, each worker streams the segments with its own reader. The next chunk is not prefetched since a worker's next block of frames
+    is not the one following its current block."""
+    global worker_frame_setup
+    worker_frame_setup = frame_setup
+    if "JWST" in frame_setup['instrument']:
+        worker_frame_setup['jwst_reader'] = JWSTSegmentReader(frame_setup['jwst_segments'],frame_setup['frame_block_size'],prefetch=False)
+
+
+def extract_frame_worker(frame_info):
+    """The function executed by each worker process of the extraction pool. This opens the science frame (or passes on the JWST reader)
+    and returns the output of extract_frame. Plotting is switched off within the workers.
+
+    Inputs:
+    frame_info - tuple of (frame index, frame name)
+
+    Returns:
+    frame_output - the dictionary returned by extract_frame"""
+
+    i,f = frame_info
+
+    if "JWST" in worker_frame_setup['instrument']:
+        return extract_frame(i,worker_frame_setup['jwst_reader'],worker_frame_setup,verbose=-1)
+
+    fits_file = fits.open(f,memmap=False)
+    frame_output = extract_frame(i,fits_file,worker_frame_setup,verbose=-1)
+    fits_file.close()
+    return frame_output
+
+
+def flatten_frame_output(frame_output):
+    """Convert the dictionary returned by extract_frame into a flat dictionary of named arrays, as stored in the extraction checkpoint"""
+
+    flat_output = {'obs_time':frame_output['obs_time'],'exposure_time':frame_output['exposure_time'],'airmass':frame_output['airmass']}
+
+    for key in ['m1temp','cosmic_pixels']:
+        if frame_output[key] is not None:
+            flat_output[key] = frame_output[key]
+
+    for star_number,(trace,fwhm,extracted_arrays) in enumerate(frame_output['stars']):
+        flat_output['star%d_trace'%(star_number+1)] = trace
+        flat_output['star%d_fwhm'%(star_number+1)] = fwhm
+        for j,array in enumerate(extracted_arrays):
+            flat_output['star%d_extracted%d'%(star_number+1,j)] = array
+
+    return flat_output
+
+
+def science_list_hash(science_list):
+    """A short fingerprint of the list of frames, used to check that a checkpoint belongs to the extraction being resumed"""
+    return hashlib.sha1("\n".join(science_list).encode()).hexdigest()
+
+
+def save_checkpoint(checkpoint_file,frame_outputs,first_frame,science_list):
+    """Append the outputs of consecutive frames to the extraction checkpoint, creating the file if needed. Each quantity is stored as a variable
+    with an unlimited 'frame' dimension so that the file can be appended to. The number of completed frames is only updated once every variable
+    has been written, so a crash midway through saving leaves a usable checkpoint.
+
+    Inputs:
+    checkpoint_file - the path to the checkpoint (.h5) file
+    frame_outputs - the list of dictionaries returned by extract_frame for the frames being saved
+    first_frame - the index of the first of these frames within the science list
+    science_list - the list of all frames being extracted
+
+    Returns:
+    Nothing, the frames are appended to checkpoint_file"""
+
+    nframes = first_frame+len(frame_outputs)
+
+    columns = {}
+    for frame_output in frame_outputs:
+        for name,value in flatten_frame_output(frame_output).items():
+            columns.setdefault(name,[]).append(value)
+
+    with h5netcdf.File(checkpoint_file,'a',invalid_netcdf=True) as store:
+
+        if 'frame' not in store.dimensions:
+            store.dimensions['frame'] = None
+            store.attrs['science_list_hash'] = science_list_hash(science_list)
+            store.attrs['nframes_complete'] = 0
+
+        store.resize_dimension('frame',nframes)
+
+        for name,values in columns.items():
+            values = np.array(values)
+            if name not in store.variables:
+                dimensions = ['%s_dim%d'%(name,d) for d in range(1,values.ndim)]
+                for dimension,size in zip(dimensions,values.shape[1:]):
+                    store.dimensions[dimension] = size
+                store.create_variable(name,tuple(['frame']+dimensions),values.dtype)
+            store.variables[name][first_frame:nframes] = values
+
+        store.attrs['nframes_complete'] = nframes
+
+    return
+
+
+def load_checkpoint(checkpoint_file,science_list):
+    """Load the frame outputs saved in an extraction checkpoint, so that an interrupted extraction can be resumed.
+
+    Inputs:
+    checkpoint_file - the path to the checkpoint (.h5) file
+    science_list - the list of all frames being extracted
+
+    Returns:
+    frame_outputs - the list of dictionaries, as returned by extract_frame, of the frames completed so far. This is empty if there is no checkpoint."""
+
+    if not os.path.isfile(checkpoint_file):
+        return []
+
+    with h5netcdf.File(checkpoint_file,'r') as store:
+        if store.attrs['science_list_hash'] != science_list_hash(science_list):
+            raise ValueError('%s was saved for a different list of science frames. Delete it or set overwrite = 1 to start a new extraction.'%checkpoint_file)
+        nframes = int(store.attrs['nframes_complete'])
+        columns = {name:variable[:nframes] for name,variable in store.variables.items()}
+
+    nstars = len([name for name in columns if name.endswith('_trace')])
+    nextracted = len([name for name in columns if name.startswith('star1_extracted')])
+
+    frame_outputs = []
+    for i in range(nframes):
+        frame_output = {'obs_time':columns['obs_time'][i],'exposure_time':columns['exposure_time'][i],'airmass':columns['airmass'][i],'m1temp':None,'cosmic_pixels':None,'stars':[]}
+        for key in ['m1temp','cosmic_pixels']:
+            if key in columns:
+                frame_output[key] = columns[key][i]
+        for star_number in range(1,nstars+1):
+            extracted_arrays = tuple(columns['star%d_extracted%d'%(star_number,j)][i] for j in range(nextracted))
+            frame_output['stars'].append((columns['star%d_trace'%star_number][i],columns['star%d_fwhm'%star_number][i],extracted_arrays))
+        frame_outputs.append(frame_output)
+
+    return frame_outputs
+
+
+def extract_all_frame_fluxes(science_list,master_bias,master_flat,trace_dict,window_dict,extraction_dict,verbose=False,bad_pixel_mask=None,cosmic_pixel_mask=None,oversampling_factor=1,gain_file=None,readnoise_file=None,nworkers=1,checkpoint_interval=0):
 
     """The funtion that loops through all science frames,finding the trace locations, extracting the flux, and saving the final
-    output."""
+    output. If nworkers > 1, the frames are farmed out to a pool of nworkers processes and the outputs are collected in time order.
+    The workers don't plot, so the saved arrays agree with those of the serial extraction to within floating point rounding (a serial
+    extraction that plots uses the row-by-row loop of extract_trace_flux rather than extract_rows_batched).
+
+    If checkpoint_interval > 0, the outputs of the frames are appended to pickled_objects/extraction_checkpoint.h5 every checkpoint_interval
+    frames (rounded up to a whole number of frame blocks). If this checkpoint already exists, the extraction resumes after the last saved frame
+    and the final pickles are the same as those of an uninterrupted extraction."""
 
     # if verbose:
     #     if verbose == -1:
@@ -921,40 +2140,38 @@ def extract_all_frame_fluxes(science_list,master_bias,master_flat,trace_dict,win
     airmass = []
     exposure_time_array = []
 
-    guess_location = trace_dict['guess_locations']
-    search_width = trace_dict['search_width']
-    gaussian_width = trace_dict['gaussian_width']
     trace_poly_order = trace_dict['trace_poly_order']
     trace_spline_sf = trace_dict['trace_spline_sf']
     if trace_spline_sf > 0 and trace_poly_order > 0:
         raise ValueError('Cannot use both a spline and polynomial fit to the trace, one of these must be set to zero in extraction input.')
 
-    co_add_rows = trace_dict['co_add_rows']
-
     instrument = window_dict['instrument']
-    readout_speed = window_dict['readout_speed']
-    nwindows = window_dict['nwindows']
-
 
-    aperture_width = extraction_dict['aperture_width']
-    background_offset = extraction_dict['background_offset']
-    background_width = extraction_dict['background_width']
     poly_bg_order = extraction_dict['poly_bg_order']
-    rectify_frame = extraction_dict['rectify_frame']
-
     nstars = extraction_dict['nstars']
-    masks = extraction_dict['masks']
     try:
         NIRSPEC_order = extraction_dict["NIRSPEC_order"]
     except:
         NIRSPEC_order = None
     use_lacosmic = extraction_dict['use_lacosmic']
-    ACAM_linearity_correction = extraction_dict['ACAM_linearity_correction']
     gaussian_defined_aperture = extraction_dict['gaussian_defined_aperture']
     if gaussian_defined_aperture:
         aperture_log = open('aperture_log.log','w')
         aperture_log.close()
 
+    # everything needed to reduce a single frame, shared by the serial loop and the worker processes
+    frame_setup = {'master_bias':master_bias,'master_flat':master_flat,'bad_pixel_mask':bad_pixel_mask,'cosmic_pixel_mask':cosmic_pixel_mask,\
+                   'use_mask':use_mask,'gain_file':gain_file,'readnoise_file':readnoise_file,'oversampling_factor':oversampling_factor}
+    frame_setup.update(trace_dict)
+    frame_setup.update(window_dict)
+    frame_setup.update(extraction_dict)
+    frame_setup['NIRSPEC_order'] = NIRSPEC_order
+    frame_setup['trace_refit_interval'] = trace_dict.get('trace_refit_interval',1)
+    frame_setup['trace_drift_tolerance'] = trace_dict.get('trace_drift_tolerance',0)
+    frame_setup['frame_block_size'] = max(frame_block_size,frame_setup['trace_refit_interval'])
+    frame_setup['trace_fits'] = {} # the Gaussians fitted to the trace of each star in the most recently fitted frame, used to warm-start the next fit
+    frame_setup['trace_cache'] = {} # the most recently fitted trace of each star, reused for up to trace_refit_interval frames
+
     stellar_fluxes = []
     stellar_errors = []
     sky_lefts = []
@@ -979,345 +2196,126 @@ def extract_all_frame_fluxes(science_list,master_bias,master_flat,trace_dict,win
     log.close()
 
     if "JWST" in instrument:
-        fits_files = [fits.open(s,memmap=False) for s in science_list]
-        nints = np.cumsum([f["SCI"].data.shape[0] for f in fits_files])
-        total_nints = nints[-1]
-        science_list = ["Integration %s"%i for i in range(total_nints)]
-
-    for i,f in enumerate(science_list):
-
-        print(f, '[%.1f%% complete, %d mins since start]'%((i+1)*100./len(science_list),(time.time()-start_time)/60))
-        log = open('reduction_output.log','a')
-        log.write('%s [%.1f%% complete, %d mins since start] \n'%(f,(i+1)*100./len(science_list),(time.time()-start_time)/60))
-        log.close()
-
-        if gaussian_defined_aperture:
-            aperture_log = open('aperture_log.log','a')
-            aperture_log.write('%s \n'%(f))
-            aperture_log.close()
-
-        if "JWST" not in instrument:
-            fits_file = fits.open(f,memmap=False)
+        # the integrations are streamed from the segments one block of frames at a time, rather than loading every segment up front
+        frame_setup['jwst_segments'] = science_list
+        if nworkers > 1:
+            jwst_reader = None
+            total_nints = JWSTSegmentReader(science_list).total_nints
         else:
-            jwst_fits_counter = np.digitize(i,nints)
-            if jwst_fits_counter > 0:
-                jwst_index_counter = i-nints[jwst_fits_counter]
-            else:
-                jwst_index_counter = i
-            fits_file = fits_files[jwst_fits_counter]
-
-        for window in range(1,nwindows+1):
-
-            if master_bias is None and "JWST" not in instrument:
-                if instrument == 'ACAM':
-                    master_bias = np.zeros_like(fits_file[window].data)
-                else:
-                    master_bias = np.zeros_like(fits_file[window-1].data)
-
-            if nwindows > 1:
-                bias = master_bias[window-1]
-            else:
-                bias = master_bias
-
-            if nwindows > 1 and master_flat is not None:
-                flat = master_flat[window-1]
-            else:
-                flat = master_flat
-
-            if window == 1:
-
-                if instrument == "ACAM":
-                    obs_time_array.append(fits_file[0].header['MJD-OBS'])
-                    exposure_time = fits_file[0].header['EXPTIME']
-                    exposure_time_array.append(exposure_time)
-                    am = fits_file[0].header['AIRMASS']
-                    airmass.append(am)
-
-                elif instrument == "EFOSC":
-                    obs_time_array.append(fits_file[0].header['MJD-OBS'])
-                    exposure_time = fits_file[0].header['EXPTIME']
-                    exposure_time_array.append(exposure_time)
-                    am = fits_file[0].header['HIERARCH ESO TEL AIRM START']
-                    airmass.append(am)
-
-                elif "JWST" in instrument:
-                    obs_time_array.append(fits_file["INT_TIMES"].data["int_mid_BJD_TDB"][jwst_index_counter])
-                    exposure_time = fits_file[0].header["EFFINTTM"]
-                    exposure_time_array.append(exposure_time)
-                    am = 0
-                    airmass.append(0)
-
-                elif instrument == "Keck/NIRSPEC":
-                    exposure_time = fits_file[0].header["ITIME"] / 1e3
-                    exposure_time_array.append(exposure_time)
-                    obs_date = fits_file[0].header["DATE-OBS"]
-                    obs_start = Time(obs_date + "T" + fits_file[0].header["UTSTART"])
-                    obs_mid = obs_start + TimeDelta(exposure_time/2,format='sec')
-                    obs_time_array.append(obs_mid.mjd)
-                    am = fits_file[0].header["AIRMASS"]
-                    airmass.append(am)
-                    m1temp = fits_file[0].header["SPEC1TMP"]
-                    try: # saving m1temp to text file to save propagating through as a numpy array
-                        new_tab = open("m1temp.txt","a")
-                    except:
-                        new_tab = open("m1temp.txt","w")
-                    new_tab.write("%f \n"%(m1temp))
-                    new_tab.close()
-
-                else:
-                    obs_time_array.append(0)
-                    exposure_time = 0
-                    exposure_time_array.append(0)
-                    am = 0
-                    airmass.append(0)
-
-            if instrument == 'ACAM':
-                frame = fits_file[window].data - bias
-            elif "JWST" in instrument: # we're not performing a bias correction as this is done in jwst stage0
-                frame = np.array([fits_file["SCI"].data[jwst_index_counter],fits_file["ERR"].data[jwst_index_counter]])
-            else:
-                frame = fits_file[window-1].data - bias
-
-            uncorrected_frame = frame.astype(float)
-
-            if master_flat is not None and "JWST" not in instrument: # this doesn't apply for jwst data as this is done in jwst stage0
-                if instrument == 'ACAM':
-                    frame = (fits_file[window].data - bias) / flat
-                else:
-                    frame = (fits_file[window-1].data - bias) / flat
-
-            # replace inf with nan
-            if "JWST" in instrument:
-                if np.any(~np.isfinite(frame[0])):
-                    frame[0][~np.isfinite(frame[0])] = np.nan
-            else:
-                if np.any(~np.isfinite(frame)):
-                    frame[~np.isfinite(frame)] = np.nan
-
-
-            if use_mask:
-                if bad_pixel_mask is not None:
-                    if len(bad_pixel_mask.shape) > 2:
-                        bad_pixel_mask = bad_pixel_mask[i]
-                if bad_pixel_mask is not None and cosmic_pixel_mask is None:
-                    pixel_mask = bad_pixel_mask
-                if bad_pixel_mask is None and cosmic_pixel_mask is not None:
-                    pixel_mask = cosmic_pixel_mask[i]
-                if bad_pixel_mask is not None and cosmic_pixel_mask is not None:
-                    pixel_mask = bad_pixel_mask + cosmic_pixel_mask[i]
-
-                if verbose != -1 and verbose != 0 and i == 0 or verbose != -1 and verbose != 0 and cosmic_pixel_mask is not None:
-                    plt.figure()
-                    plt.imshow(pixel_mask, interpolation='none',aspect="auto")
-                    plt.title("Pixel mask, frame %d"%i)
-                    plt.ylabel("Pixel column")
-                    plt.xlabel("Pixel row")
-                    if verbose == -2:
-                        plt.show()
-                    if verbose > 0:
-                        plt.show(block=False)
-                        plt.pause(verbose)
-                        plt.close()
-
-                original_frame = frame.copy()
-                if "JWST" in instrument:
-                    frame = np.array([interp_bad_pixels(frame[0],pixel_mask,replace_with_medians=True),interp_bad_pixels(frame[1],pixel_mask,replace_with_medians=True)])
-                else:
-                    frame = interp_bad_pixels(frame,pixel_mask,replace_with_medians=True)
+            jwst_reader = JWSTSegmentReader(science_list,frame_setup['frame_block_size'])
+            total_nints = jwst_reader.total_nints
+        science_list = ["Integration %s"%i for i in range(total_nints)]
 
-                if verbose != -1 and verbose != 0 and i == 0 or verbose != -1 and verbose != 0 and cosmic_pixel_mask is not None:
-                    plt.figure()
+    checkpoint_file = "pickled_objects/extraction_checkpoint.h5"
+    checkpoint_frames = list(frame_setup.get('jwst_segments',[]))+list(science_list)
+    if checkpoint_interval > 0:
+        # the checkpoints fall on the boundaries of the frame blocks so that a resumed extraction warm-starts the trace fits exactly as the uninterrupted one
+        checkpoint_interval = int(np.ceil(checkpoint_interval/frame_setup['frame_block_size']))*frame_setup['frame_block_size']
+        try:
+            os.mkdir("pickled_objects")
+        except:
+            pass
+        saved_outputs = load_checkpoint(checkpoint_file,checkpoint_frames)
+        if len(saved_outputs) > 0:
+            print("...resuming from frame %d of %s"%(len(saved_outputs),checkpoint_file))
+            if saved_outputs[0]['m1temp'] is not None: # m1temp.txt may contain frames extracted after the last checkpoint
+                np.savetxt("m1temp.txt",[frame_output['m1temp'] for frame_output in saved_outputs],fmt="%f ")
+    else:
+        saved_outputs = []
+    unsaved_outputs = []
+    start_frame = len(saved_outputs)
+
+    if nworkers > 1 and start_frame < len(science_list):
+        print("Extracting %d frames with %d worker processes, plotting is switched off"%(len(science_list),nworkers))
+        pool = multiprocessing.Pool(nworkers,initializer=init_frame_worker,initargs=(frame_setup,))
+        # imap returns the frame outputs in the same order as the science list
+        frame_outputs = pool.imap(extract_frame_worker,list(enumerate(science_list))[start_frame:],chunksize=frame_setup['frame_block_size'])
+    else:
+        pool = None
 
-                    plt.subplot(211)
-                    if "JWST" in instrument:
-                        vmin,vmax = np.nanpercentile(original_frame[0],[10,70])
-                        plt.imshow(original_frame[0],vmin=vmin,vmax=vmax,aspect="auto")
-                    # elif instrument == "Keck/NIRSPEC":
-                    #     vmin,vmax = 0,500
-                    else:
-                        vmin,vmax = np.nanpercentile(original_frame,[10,70])
-                        plt.imshow(original_frame,vmin=vmin,vmax=vmax,aspect="auto")
-                    plt.title("Pre-pixel-masked frame")
-                    plt.xticks(visible=False)
-                    # ~ plt.xlabel("Pixel column")
-                    plt.ylabel("Pixel row")
-
-
-                    plt.subplot(212)
-                    if "JWST" in instrument:
-                        vmin,vmax = np.nanpercentile(frame[0],[10,70])
-                        plt.imshow(frame[0],vmin=vmin,vmax=vmax,aspect="auto")
-                    # elif instrument == "Keck/NIRSPEC":
-                    #     vmin,vmax = 0,500
-                    else:
-                        vmin,vmax = np.nanpercentile(frame,[10,70])
-                        plt.imshow(frame,vmin=vmin,vmax=vmax,aspect="auto")
+    for i,f in enumerate(science_list):
 
-                    plt.title("Post-pixel-masked frame")
-                    plt.xlabel("Pixel column")
-                    plt.ylabel("Pixel row")
+        if i < start_frame:
+            frame_output = saved_outputs[i]
 
-                    if verbose == -2:
-                        plt.show()
-                    if verbose > 0:
-                        plt.show(block=False)
-                        plt.pause(verbose)
-                        plt.close()
+        elif pool is None:
+            if gaussian_defined_aperture:
+                aperture_log = open('aperture_log.log','a')
+                aperture_log.write('%s \n'%(f))
+                aperture_log.close()
 
+            if "JWST" not in instrument:
+                fits_file = fits.open(f,memmap=False)
             else:
-                pixel_mask=None
-
+                fits_file = jwst_reader
 
-            if NIRSPEC_order is not None:
-                if i == 0 and verbose:
-                    v = verbose
-                else:
-                    v = False
+            frame_output = extract_frame(i,fits_file,frame_setup,verbose)
 
-                frame = KO.mask_NIRSPEC_data(frame,NIRSPEC_order,v)
+            if "JWST" not in instrument:
+                fits_file.close()
 
+        else:
+            frame_output = next(frame_outputs)
+
+        if i >= start_frame:
+            print(f, '[%.1f%% complete, %d mins since start]'%((i+1)*100./len(science_list),(time.time()-start_time)/60))
+            log = open('reduction_output.log','a')
+            log.write('%s [%.1f%% complete, %d mins since start] \n'%(f,(i+1)*100./len(science_list),(time.time()-start_time)/60))
+            log.close()
+
+            if checkpoint_interval > 0:
+                unsaved_outputs.append(frame_output)
+                if (i+1) % checkpoint_interval == 0 or i+1 == len(science_list):
+                    save_checkpoint(checkpoint_file,unsaved_outputs,i+1-len(unsaved_outputs),checkpoint_frames)
+                    unsaved_outputs = []
+
+        obs_time_array.append(frame_output['obs_time'])
+        exposure_time_array.append(frame_output['exposure_time'])
+        airmass.append(frame_output['airmass'])
+
+        if frame_output['m1temp'] is not None and i >= start_frame:
+            try: # saving m1temp to text file to save propagating through as a numpy array
+                new_tab = open("m1temp.txt","a")
+            except:
+                new_tab = open("m1temp.txt","w")
+            new_tab.write("%f \n"%(frame_output['m1temp']))
+            new_tab.close()
 
-            #if use_lacosmic and instrument == 'ACAM':
-                #frame,_ = lacosmic.lacosmic(frame,0.5,15,15,effective_gain=1.9,readnoise=7)
-            if use_lacosmic and instrument == "Keck/NIRSPEC" and cosmic_pixel_mask is None:
-                cosmic_search_frame = copy.deepcopy(frame)
-                cosmic_search_frame[~np.isfinite(cosmic_search_frame)] = 0
-                cosmic_search_frame[cosmic_search_frame < 0] = 0
-
-                # frame[~np.isfinite(frame)] = 0
-                # frame[frame < 0] = 0
-                cosmic_pixels,_ = astroscrappy.detect_cosmics(cosmic_search_frame[row_min:row_max], gain=3.01,readnoise=11.56, \
-                                                          satlevel=np.inf, inmask=pixel_mask[row_min:row_max], sepmed=False, \
-                                                          cleantype='medmask', fsmode='median',verbose=True,sigclip=5,objlim=10,niter=8)
-                # frame[frame == 0] = np.nan
-                frame[row_min:row_max] = interp_bad_pixels(frame[row_min:row_max],cosmic_pixels)
-
-                if verbose != -1 and verbose != 0:
-                    plt.figure(figsize=(4,12))
-                    plt.imshow(cosmic_pixels,aspect="auto")
-                    plt.title("Lacosmic-flagged cosmic pixels")
-                    if verbose == -2:
-                        plt.show()
-                    if verbose > 0:
-                        plt.show(block=False)
-                        plt.pause(verbose)
-                        plt.close()
-
-                cosmic_masked_pixels.append(cosmic_pixels)
+        if frame_output['cosmic_pixels'] is not None:
+            cosmic_masked_pixels.append(frame_output['cosmic_pixels'])
 
-            if rotate_frame:
-                if "JWST" in instrument:
-                    frame = np.array([np.flip(frame[0].T,axis=1),np.flip(frame[1].T,axis=1)])
-                    uncorrected_frame = np.array([np.flip(uncorrected_frame[0].T,axis=1),np.flip(uncorrected_frame[1].T,axis=1)])
-                else:
-                    frame = np.flip(frame.T,axis=1)
-                    uncorrected_frame = np.flip(uncorrected_frame.T,axis=1)
+        for trace,fwhm,extracted_arrays in frame_output['stars']:
 
             if "JWST" in instrument:
-                frame = np.array([frame[0][row_min:row_max].astype(float),frame[1][row_min:row_max].astype(float)])
-                uncorrected_frame = np.array([uncorrected_frame[0][row_min:row_max],uncorrected_frame[1][row_min:row_max]])
-            else:
-                frame = frame[row_min:row_max].astype(float)
-                uncorrected_frame = uncorrected_frame[row_min:row_max]
-
-            if oversampling_factor > 1:
-                # nrows,ncols = frame.shape
-                if "JWST" in instrument:
-                    frame = np.array([resample_frame(frame[0],oversampling_factor,verbose=verbose),resample_frame(frame[1],oversampling_factor)])
-                    uncorrected_frame = np.array([resample_frame(uncorrected_frame[0],oversampling_factor),resample_frame(uncorrected_frame[1],oversampling_factor)])
-                else:
-                    frame = resample_frame(frame,oversampling_factor,verbose=verbose)
-                    uncorrected_frame = resample_frame(uncorrected_frame,oversampling_factor)
-                # oversampling_factor = ((ncols-1)*oversampling+1)/ncols
+                flux,error,sky_avg = extracted_arrays
 
-
-            if ACAM_linearity_correction and instrument == 'ACAM':
-                frame = ((-0.007/65000)*frame + 1)*frame # from ACAM webpages
-
-            if nwindows == 1:
-                loop_range = range(nstars)
             else:
-                loop_range = range(1)
-
-            for star_number in loop_range:
-
-                if nwindows > 1:
-                    star_number += window - 1
-
-                if search_width[star_number] > 0:
-                    trace, force_verbose, fwhm, gauss_std = find_spectral_trace(frame,guess_location[star_number],search_width[star_number],gaussian_width,trace_poly_order,trace_spline_sf,star_number,verbose,co_add_rows,instrument)
-                else:
-                    trace = np.ones(row_max-row_min)*guess_location[star_number]
-                    fwhm = gauss_std = np.ones(row_max-row_min)
-                    force_verbose = verbose
-
-                if gaussian_defined_aperture:
-
-                    # Smooth the FWHMs with a quadratic polynomial
-                    gauss_std_poly = np.poly1d(np.polyfit(np.arange(0,row_max-row_min),gauss_std,trace_poly_order))
-                    gauss_std_smooth = gauss_std_poly(np.arange(0,row_max-row_min))
-
-                    # refit with outliers clipped
-                    gauss_std_residuals = gauss_std - gauss_std_poly(np.arange(0,row_max-row_min))
-                    gauss_std_keep_idx = abs(gauss_std_residuals) <= 4*np.std(gauss_std_residuals)
-
-                    gauss_std_poly = np.poly1d(np.polyfit(np.arange(0,row_max-row_min)[gauss_std_keep_idx],gauss_std[gauss_std_keep_idx],trace_poly_order))
-                    gauss_std_smooth = gauss_std_poly(np.arange(0,row_max-row_min))
-
-                    if verbose != -1 and verbose != 0:
-                        plt.figure()
-                        plt.plot(np.arange(row_min,row_max),gauss_std,label="Std dev of trace")
-                        plt.plot(np.arange(row_min,row_max)[~gauss_std_keep_idx],gauss_std[~gauss_std_keep_idx],"rx",label="Clipped outlier")
-                        plt.plot(np.arange(row_min,row_max),gauss_std_smooth,label="Smoothed with polynomial (order = %d)"%trace_poly_order)
-                        plt.xlabel("Pixel number")
-                        plt.ylabel("Standard deviation (pixels)")
-                        plt.title("Gaussian-defined aperture widths")
-                        if verbose == -2:
-                            plt.show()
-                        if verbose > 0:
-                            plt.show(block=False)
-                            plt.pause(verbose)
-                            plt.close()
-
-                    trace_std = gauss_std_smooth*2*np.sqrt(2*np.log(2))
-
-                else:
-                    trace_std = None
-
-                if "JWST" in instrument: # only return the key arrays since the data files are so large and consume too much memory
-                    flux,error,sky_avg = extract_trace_flux(frame,trace,aperture_width[star_number],background_offset[star_number],\
-                                                                                                    background_width[star_number],uncorrected_frame[0],poly_bg_order[star_number],am,\
-                                                                                                    exposure_time,force_verbose,star_number,masks['mask%d'%(star_number+1)],instrument,row_min,trace_std,readout_speed,co_add_rows,rectify_frame,oversampling_factor,\
-                                                                                                    gain_file,readnoise_file)
-
-                else:
-                    flux,error,sky_avg,sky_left,sky_right,base_left,base_right,max_counts,rn_error,scin_error,pois_error,bkg_poly_order,raw_star_flux = extract_trace_flux(frame,trace,aperture_width[star_number],background_offset[star_number],\
-                                                                                background_width[star_number],uncorrected_frame,poly_bg_order[star_number],am,\
-                                                                                exposure_time,force_verbose,star_number,masks['mask%d'%(star_number+1)],instrument,row_min,trace_std,readout_speed,co_add_rows,rectify_frame,oversampling_factor,\
-                                                                                gain_file,readnoise_file)
-
-                    plt.close("all")
-
-                    sky_lefts.append(sky_left)
-                    sky_rights.append(sky_right)
-                    # sky_polys.append(sky_poly)
-                    base_lefts.append(base_left)
-                    base_rights.append(base_right)
-                    MAX_COUNTS.append(max_counts)
-                    scintillation_error.append(scin_error)
-                    readnoise_error.append(rn_error)
-                    poisson_noise.append(pois_error)
-                    background_poly_order_used.append(bkg_poly_order)
-                    raw_stellar_fluxes.append(raw_star_flux)
-
-                stellar_fluxes.append(flux)
-                stellar_errors.append(error)
-                sky_avgs.append(sky_avg)
-                traces.append(trace)
-                FWHM.append(fwhm)
-
-        if "JWST" not in instrument:
-            fits_file.close()
+                flux,error,sky_avg,sky_left,sky_right,base_left,base_right,max_counts,rn_error,scin_error,pois_error,bkg_poly_order,raw_star_flux = extracted_arrays
+
+                sky_lefts.append(sky_left)
+                sky_rights.append(sky_right)
+                # sky_polys.append(sky_poly)
+                base_lefts.append(base_left)
+                base_rights.append(base_right)
+                MAX_COUNTS.append(max_counts)
+                scintillation_error.append(scin_error)
+                readnoise_error.append(rn_error)
+                poisson_noise.append(pois_error)
+                background_poly_order_used.append(bkg_poly_order)
+                raw_stellar_fluxes.append(raw_star_flux)
+
+            stellar_fluxes.append(flux)
+            stellar_errors.append(error)
+            sky_avgs.append(sky_avg)
+            traces.append(trace)
+            FWHM.append(fwhm)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if "JWST" in instrument and jwst_reader is not None:
+        jwst_reader.close()
 
     try:
         os.mkdir("pickled_objects")
@@ -1498,11 +2496,32 @@ def main(input_file='extraction_input.txt'):
 
     overwrite = bool(int(input_dict['overwrite']))
 
+    try: # the number of processes over which to spread the extraction of the frames. Older input files won't define this
+        nworkers = int(input_dict['nworkers'])
+    except (KeyError,TypeError):
+        nworkers = 1
+
+    try: # how often to checkpoint the extracted frames so that a crashed extraction can be resumed. Older input files won't define this
+        checkpoint_interval = int(input_dict['checkpoint_interval'])
+    except (KeyError,TypeError):
+        checkpoint_interval = 0
+
+    if overwrite and os.path.isfile("pickled_objects/extraction_checkpoint.h5"):
+        os.remove("pickled_objects/extraction_checkpoint.h5")
+
 
     trace_location_dict = {'guess_locations':trace_guess_locations,'search_width':trace_search_widths,\
                             'gaussian_width':int(input_dict['trace_gaussian_width'])*oversampling_factor,'trace_poly_order':int(input_dict['trace_poly_order']),\
                             'trace_spline_sf':float(input_dict['trace_spline_sf']),'co_add_rows':int(input_dict['co_add_rows'])}
 
+    # reuse of the trace between frames. Older input files won't define these, in which case the trace is fitted in every frame
+    try:
+        trace_location_dict['trace_refit_interval'] = int(input_dict['trace_refit_interval'])
+        trace_location_dict['trace_drift_tolerance'] = float(input_dict['trace_drift_tolerance'])*oversampling_factor
+    except (KeyError,TypeError):
+        trace_location_dict['trace_refit_interval'] = 1
+        trace_location_dict['trace_drift_tolerance'] = 0
+
     window_info_dict = {'instrument':input_dict['instrument'],'nwindows':int(input_dict['nwindows']),'row_min':int(input_dict['row_min']),'row_max':int(input_dict['row_max']),\
                         'readout_speed':input_dict['readout_speed'],"rotate_frame":bool(int(input_dict["rotate_frame"]))}
 
@@ -1525,7 +2544,7 @@ def main(input_file='extraction_input.txt'):
         ref_frame = input_dict['science_list']
         science_files = file_names[file_names.index(ref_frame):]
 
-    if not overwrite and os.path.isfile('white_light.txt'):
+    if not overwrite and checkpoint_interval == 0 and os.path.isfile('white_light.txt'):
         test = np.loadtxt('white_light.txt')
         n = len(test[:,0])
         print("...loading from frame %d"%n)
@@ -1543,7 +2562,7 @@ def main(input_file='extraction_input.txt'):
     else:
         gain_file = readnoise_file = None
 
-    sf,se,time = extract_all_frame_fluxes(science_files,bias,flat,trace_location_dict,window_info_dict,extraction_params_dict,verbose=v,bad_pixel_mask=bad_pixel_mask,cosmic_pixel_mask=cosmic_pixel_mask,oversampling_factor=oversampling_factor,gain_file=gain_file,readnoise_file=readnoise_file)
+    sf,se,time = extract_all_frame_fluxes(science_files,bias,flat,trace_location_dict,window_info_dict,extraction_params_dict,verbose=v,bad_pixel_mask=bad_pixel_mask,cosmic_pixel_mask=cosmic_pixel_mask,oversampling_factor=oversampling_factor,gain_file=gain_file,readnoise_file=readnoise_file,nworkers=nworkers,checkpoint_interval=checkpoint_interval)
 
     if input_dict["instrument"] == "Keck/NIRSPEC":
         f_norm = np.array([f/np.nanmean(f) for f in sf])
@@ -1554,7 +2573,7 @@ def main(input_file='extraction_input.txt'):
         log.write("\n\nStandard deviation of residual spectra = %f\n"%(np.nanstd(residual_spectra)))
 
     # ~ if nstars > 1:
-    generate_wl_curve(sf,se,time,nstars,overwrite)
+    generate_wl_curve(sf,se,time,nstars,overwrite or checkpoint_interval > 0)
     return
 
 
@@ -1646,4 +2665,5 @@ def resample_frame(data,oversampling=10,xmin=0,verbose=False):
     return data_resampled
 
 
-main()
+if __name__ == "__main__":
+    main()
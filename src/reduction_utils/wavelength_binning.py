@@ -4,11 +4,11 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import pickle
-from scipy import stats, signal
+from scipy import stats, signal, sparse
 import os
 import pandas as pd
-import pysynphot.binning as astrobin
 import warnings as warn
+from functools import lru_cache
 from Tiberius.src.reduction_utils import wavelength_calibration as wc
 
 ### define the alkali metal lines, air wavelengths
@@ -249,12 +249,7 @@ def bin_ancillary_data(data,wavelength_solution,bins,n_tukey_points=0):
         if n_tukey_points > 0:
 
             nidx = len(np.where(digitized == i)[0])
-            Tukey = float(n_tukey_points)/nidx
-            dummy_bin_vals = np.zeros((len(data),nidx+2))
-            dummy_bin_vals[:,1:-1] = data[:,digitized == i]
-
-            tukey_bin_vals = dummy_bin_vals*signal.tukey(nidx+2,Tukey)
-            bin_vals = tukey_bin_vals[:,1:-1].mean(axis=1)
+            bin_vals = (data[:,digitized == i]*tukey_weights(nidx,n_tukey_points)).mean(axis=1)
 
         else:
             bin_vals = data[:,digitized==i].mean(axis=1)
@@ -264,214 +259,217 @@ def bin_ancillary_data(data,wavelength_solution,bins,n_tukey_points=0):
     return np.array(binned_data)
 
 
-def wvl_bin_data(flux1,err1,flux2,err2,wvl_solution,bins,ancillary_data=None,weighted=False,n_tukey_points=0,wvl_solution_2=None):
-
-    """A function to bin the spectra of the target and comparison to make spectroscopic light curves for each by summing the flux within the defined wavelength bins.
-    The target's light curves are divided by the comparison's light curves to correct for telluric extinction.
+@lru_cache(maxsize=None)
+def tukey_weights(npoints,n_tukey_points):
+    """A function that returns the Tukey window weights of the points within a bin, which are cached as there are only a few different numbers of points per bin.
+    The window is 2 points longer than the bin, so that the points weighted as 0 by the window fall outside the bin and none of the bin's points are 0 weighted.
 
     Inputs:
-    flux1 - ndarray of spectra of the target
-    err1 - ndarray of errors of the target
-    flux2 - ndarray of spectra of the comparison
-    err2 - ndarray of errors of the comparison
-    wvl_solution - the wavelength solution which is used to bin the data. This is assuming that both the target and the comparison have been resampled onto the same x-axis.
-                   My tests show that this provides much better light curves than using separate wavelength solutions
-    bins - the list of bin edges of the light curves, in Angstroms
-    ancillary_data - a dictionary of ancillary data to bin (typically ancillary_data = {"xpos":xpos,"sky":sky})
-    weighted - True/False - define whether we want to perform a weighted (by the flux errors) sum or not. Default=False as I have found this often produce better light curves (less noise)
-    n_tukey_points - If wanting to use Tukey bins, set this parameter to the number of points to fall within the Tukey smoothed edges per bin.
-                     This downweights those points falling at the edges of bins. I often find this to lead to noisier light curves. Default=0 (no Tukey window is used)
-     wvl_solution_2 - can pass second wavelength solution for second object if the stars have not been resampled onto the same wavelength grid
+    npoints - the number of points within the bin
+    n_tukey_points - the number of points to fall within the Tukey smoothed edges of the bin
 
     Returns:
-    flux_ratio - the differential (target/comparison) spectroscopic light curves
-    err_ratio - the flux errors in the differential light curves
-    binned_flux1 - the target's spectroscopic light curves
-    binned_err1 - the flux errors in the target's spectroscopic light curves
-    binned_flux2 - the comparison's spectroscopic light curves
-    binned_err2 - the flux errors in the comparison's spectroscopic light curves
-    binned_ancillary - a dictionary of the binned ancillary data
-    photon_noise_star1 - the photon noise for each bin for the target
-    photon_noise_star2 - the photon noise for each bin for the comparison
-    SN_1 - the mean of the S/N array (sqrt(flux)) for each wavelength bin for star 1
-    SN_2 - the mean of the S/N array (sqrt(flux)) for each wavelength bin for star 2
-
+    weights - the (read-only) array of the npoints weights
     """
+    weights = signal.windows.tukey(npoints+2,float(n_tukey_points)/npoints)[1:-1]
+    weights.flags.writeable = False
+    return weights
 
-    nbins = len(bins)
-    nframes = len(flux1)
 
-    binned_flux1 = []
-    binned_err1 = []
+def wvl_bin_map(wvl_solution,bins,n_tukey_points=0):
+    """A function that finds which wavelength bin every pixel falls in, so that the spectra of all frames can be binned at once with sum_in_bins.
 
-    binned_flux2 = []
-    binned_err2 = []
+    Inputs:
+    wvl_solution - the wavelength solution, either 1D if this is shared by all frames or with shape (nframes, npixels) for a separate solution for each frame
+    bins - the list of bin edges, in Angstroms
+    n_tukey_points - If wanting to use Tukey bins, set this parameter to the number of points to fall within the Tukey smoothed edges per bin. Default=0 (no Tukey window is used)
 
-    binned_ancillary_data = {}
-    if ancillary_data is not None:
-        for k in ancillary_data.keys():
-            binned_ancillary_data[k] = []
+    Returns:
+    bin_map - dictionary of 'pixels', the indices of the (flattened) pixels that fall within the bins ordered by bin (and by pixel within each bin), 'starts', the index within 'pixels'
+              of the first pixel of each bin, 'counts', the number of pixels in each bin with shape (nbins) or (nframes, nbins) and 'weights', the Tukey window weight of each pixel
+              in 'pixels' (None if n_tukey_points = 0). For a separate solution for each frame, 'operator' is the sparse matrix with shape (nframes*npixels, nframes*nbins) of the
+              weights of each pixel in each bin, which sums the flattened spectra of all frames into their bins in a single product
+    """
 
-    photon_noise_star1 = []
-    photon_noise_star2 = []
+    nbins = len(bins)-1
+    wvl_solution = np.atleast_2d(wvl_solution)
+    nframes,npixels = wvl_solution.shape
+
+    # the bin of each pixel, where bins[j] <= wvl_solution < bins[j+1], and its bin counted over all frames
+    bin_index = np.searchsorted(bins,wvl_solution,side='right')-1
+    in_bins = ((bin_index >= 0) & (bin_index < nbins)).ravel()
+    frame_bin_index = (bin_index + nbins*np.arange(nframes)[:,None]).ravel()
+
+    # a stable sort keeps the pixels of each bin in their original order, which the Tukey windows rely on
+    pixels = np.where(in_bins)[0]
+    pixels = pixels[np.argsort(frame_bin_index[pixels],kind='stable')]
+    pixel_bins = frame_bin_index[pixels]
+    counts = np.bincount(pixel_bins,minlength=nframes*nbins)
+    starts = np.cumsum(counts)-counts
+
+    if n_tukey_points != 0:
+        # the weight of each pixel is set by its position within its bin and the number of pixels in the bin
+        position = np.arange(len(pixels))-starts[pixel_bins]
+        npoints = counts[pixel_bins]
+        weights = np.zeros(len(pixels))
+        for n in np.unique(npoints):
+            weights[npoints == n] = tukey_weights(n,n_tukey_points)[position[npoints == n]]
+    else:
+        weights = None
 
-    SN_1 = []
-    SN_2 = []
+    if nframes == 1:
+        return {'pixels':pixels,'starts':starts,'counts':counts,'weights':weights}
 
-    # make wavelength solution at least 2D to allow for separate wavelength solutions for each frame
-    if len(wvl_solution.shape) == 1:
-        wvl_solution = np.ones_like(flux1) * wvl_solution
+    operator = sparse.csr_matrix((np.ones(len(pixels)) if weights is None else weights,(pixels,pixel_bins)),shape=(nframes*npixels,nframes*nbins))
 
-    # allow for second wavelength solution if the stars have not been resampled
-    if wvl_solution_2 is not None:
-        if len(wvl_solution_2.shape) == 1:
-            wvl_solution_2 = np.ones_like(flux2) * wvl_solution_2
+    return {'pixels':pixels,'starts':starts,'counts':counts.reshape(nframes,nbins),'weights':weights,'operator':operator}
 
-    # outer loop: loop through all frames (1D spectra)
-    for i in range(nframes):
 
-        current_flux1 = []
-        current_flux2 = []
+def sum_in_bins(data,bin_map,power=1,ignore_nans=False):
+    """A function that sums the pixels of every frame within each wavelength bin, using the bin map from wvl_bin_map. Each pixel is multiplied by its Tukey weight to the given
+    power, e.g. power=1 for the Tukey windowed flux, power=2 for the variance or power=0 for no weighting.
 
-        current_err1 = []
-        current_err2 = []
+    Inputs:
+    data - ndarray of shape (nframes, npixels) of the values to sum
+    bin_map - the dictionary returned by wvl_bin_map
+    power - the power of the Tukey weights to multiply the data by. Default=1
+    ignore_nans - True/False - treat NaNs as zero, as np.nansum does. Default=False
 
-        if ancillary_data is not None:
-            current_ancil = {}
-            for k in ancillary_data.keys():
-                current_ancil[k] = []
+    Returns:
+    binned_sums - ndarray of shape (nframes, nbins), which is zero for bins that contain no pixels
+    """
 
-        current_photon_noise_1 = []
-        current_photon_noise_2 = []
+    data = np.atleast_2d(data)
+    nbins = bin_map['counts'].shape[-1]
 
-        current_SN_1 = []
-        current_SN_2 = []
+    if 'operator' in bin_map: # a separate wavelength solution for each frame
 
-        # inner loop: loop through all bins
-        for j in range(0,nbins-1):
+        operator = bin_map['operator']
+        if bin_map['weights'] is not None and power != 1:
+            operator = operator.copy()
+            operator.data = operator.data**power
 
-            idx = (wvl_solution[i] >= bins[j]) & (wvl_solution[i] < bins[j+1])
-            nidx = len(np.where(flux1[i][idx])[0])
+        flat_data = data.ravel()
+        if ignore_nans and np.isnan(flat_data).any():
+            flat_data = np.where(np.isnan(flat_data),0,flat_data)
 
-            if wvl_solution_2 is not None:
-                idx2 = (wvl_solution_2[i] >= bins[j]) & (wvl_solution_2[i] < bins[j+1])
-                nidx2 = len(np.where(flux2[i][idx2])[0])
-            else:
-                idx2 = idx
-                nidx2 = nidx
+        return (flat_data @ operator).reshape(len(data),nbins)
 
-            if n_tukey_points != 0:
+    pixels = bin_map['pixels']
+    if len(pixels) > 0 and pixels[-1]-pixels[0] == len(pixels)-1: # the pixels are in order with no gaps (a monotonic wavelength solution), so can be sliced rather than copied
+        ordered_data = data[:,pixels[0]:pixels[-1]+1]
+    else:
+        ordered_data = data[:,pixels]
 
-                Tukey1 = float(n_tukey_points)/nidx
-                Tukey2 = float(n_tukey_points)/nidx2
+    if bin_map['weights'] is not None and power != 0:
+        ordered_data = ordered_data*bin_map['weights']**power
 
-                # Create dummy array, 2 points longer than our array so that points weighted as 0 by Tukey window fall outside our desired array and thereofre none of our points are 0 weighted
-                dummy_bin1_vals = np.zeros(nidx+2)
-                dummy_e1_vals = np.zeros(nidx+2)
+    if ignore_nans and np.isnan(ordered_data).any():
+        ordered_data = np.where(np.isnan(ordered_data),0,ordered_data)
 
-                # replace the values between the first and last dummy points with the actual data
-                dummy_bin1_vals[1:-1] = flux1[i][idx]
-                dummy_e1_vals[1:-1] = err1[i][idx]
+    # reduceat sums each bin up to the start of the next, so empty bins are left out
+    filled = bin_map['counts'] > 0
+    if np.all(filled):
+        return np.add.reduceat(ordered_data,bin_map['starts'],axis=1)
 
-                tukey_bin1_vals = dummy_bin1_vals*signal.tukey(nidx+2,Tukey1)
-                bin_1_vals = tukey_bin1_vals[1:-1]
+    binned_sums = np.zeros((len(data),nbins))
+    if np.any(filled):
+        binned_sums[:,filled] = np.add.reduceat(ordered_data,bin_map['starts'][filled],axis=1)
 
-                tukey_e1_vals = dummy_e1_vals*signal.tukey(nidx+2,Tukey1)
-                bin_e1_vals = tukey_e1_vals[1:-1]
+    return binned_sums
 
-                if flux2 is not None:
-                    dummy_bin2_vals = np.zeros(nidx2+2)
-                    dummy_e2_vals = np.zeros(nidx2+2)
 
-                    dummy_bin2_vals[1:-1] = flux2[i][idx2]
-                    dummy_e2_vals[1:-1] = err2[i][idx2]
+def wvl_bin_data(flux1,err1,flux2,err2,wvl_solution,bins,ancillary_data=None,weighted=False,n_tukey_points=0,wvl_solution_2=None):
 
-                    tukey_bin2_vals = dummy_bin2_vals*signal.tukey(nidx2+2,Tukey2)
-                    bin_2_vals = tukey_bin2_vals[1:-1]
+    """A function to bin the spectra of the target and comparison to make spectroscopic light curves for each by summing the flux within the defined wavelength bins.
+    The target's light curves are divided by the comparison's light curves to correct for telluric extinction.
 
-                    tukey_e2_vals = dummy_e2_vals*signal.tukey(nidx2+2,Tukey2)
-                    bin_e2_vals = tukey_e2_vals[1:-1]
+    Inputs:
+    flux1 - ndarray of spectra of the target
+    err1 - ndarray of errors of the target
+    flux2 - ndarray of spectra of the comparison
+    err2 - ndarray of errors of the comparison
+    wvl_solution - the wavelength solution which is used to bin the data. This is assuming that both the target and the comparison have been resampled onto the same x-axis.
+                   My tests show that this provides much better light curves than using separate wavelength solutions
+    bins - the list of bin edges of the light curves, in Angstroms
+    ancillary_data - a dictionary of ancillary data to bin (typically ancillary_data = {"xpos":xpos,"sky":sky})
+    weighted - True/False - define whether we want to perform a weighted (by the flux errors) sum or not. Default=False as I have found this often produce better light curves (less noise)
+    n_tukey_points - If wanting to use Tukey bins, set this parameter to the number of points to fall within the Tukey smoothed edges per bin.
+                     This downweights those points falling at the edges of bins. I often find this to lead to noisier light curves. Default=0 (no Tukey window is used)
+     wvl_solution_2 - can pass second wavelength solution for second object if the stars have not been resampled onto the same wavelength grid
 
-                if ancillary_data is not None:
+    Returns:
+    flux_ratio - the differential (target/comparison) spectroscopic light curves
+    err_ratio - the flux errors in the differential light curves
+    binned_flux1 - the target's spectroscopic light curves
+    binned_err1 - the flux errors in the target's spectroscopic light curves
+    binned_flux2 - the comparison's spectroscopic light curves
+    binned_err2 - the flux errors in the comparison's spectroscopic light curves
+    binned_ancillary - a dictionary of the binned ancillary data
+    photon_noise_star1 - the photon noise for each bin for the target
+    photon_noise_star2 - the photon noise for each bin for the comparison
+    SN_1 - the mean of the S/N array (sqrt(flux)) for each wavelength bin for star 1
+    SN_2 - the mean of the S/N array (sqrt(flux)) for each wavelength bin for star 2
 
-                    bin_ancillary = {}
-                    for k in ancillary_data.keys():
-                        dummy_ancil_vals = np.zeros(nidx+2)
-                        dummy_ancil_vals[1:-1] = ancillary_data[k][i][idx]
-                        tukey_ancil_vals = dummy_ancil_vals*signal.tukey(nidx+2,Tukey1)
-                        bin_ancillary[k] = tukey_ancil_vals[1:-1]
+    """
 
+    # when all frames share the same wavelength solution, the bin of every pixel only needs finding once. Otherwise, the bins are found for every pixel of every frame
+    if len(wvl_solution.shape) > 1 and np.all(wvl_solution == wvl_solution[0]):
+        wvl_solution = wvl_solution[0]
+    if wvl_solution_2 is not None and len(wvl_solution_2.shape) > 1 and np.all(wvl_solution_2 == wvl_solution_2[0]):
+        wvl_solution_2 = wvl_solution_2[0]
 
-            else:
-                bin_1_vals = flux1[i][idx]
-                bin_e1_vals = err1[i][idx]
+    # the two solutions need the same form so that both stars are binned in the same way
+    if wvl_solution_2 is not None and len(wvl_solution.shape) != len(wvl_solution_2.shape):
+        wvl_solution = np.broadcast_to(wvl_solution,np.shape(flux1))
+        wvl_solution_2 = np.broadcast_to(wvl_solution_2,np.shape(flux2))
 
-                if flux2 is not None:
-                    bin_2_vals = flux2[i][idx2]
-                    bin_e2_vals = err2[i][idx2]
+    bin_map1 = wvl_bin_map(wvl_solution,bins,n_tukey_points)
+    if wvl_solution_2 is not None:
+        bin_map2 = wvl_bin_map(wvl_solution_2,bins,n_tukey_points)
+    else:
+        bin_map2 = bin_map1
 
-                if ancillary_data is not None:
-                    bin_ancillary = {}
-                    for k in ancillary_data.keys():
-                        bin_ancillary[k] = ancillary_data[k][i][idx]
+    # empty bins give NaNs (and are zero for the unweighted sums)
+    with np.errstate(divide='ignore',invalid='ignore'):
 
-            if ancillary_data is not None:
-                for k in ancillary_data.keys():
-                    current_ancil[k].append(nan_mean(bin_ancillary[k]))
+        sqrt_flux1 = np.sqrt(flux1)
+        photon_noise_star1 = sum_in_bins(1/sqrt_flux1,bin_map1,power=0)/bin_map1['counts']
+        SN_1 = sum_in_bins(sqrt_flux1,bin_map1,power=0.5)/bin_map1['counts']
 
-            current_photon_noise_1.append(np.mean(1/np.sqrt(flux1[i][idx])))
-            current_SN_1.append(np.sqrt(bin_1_vals).mean())
+        if weighted:
+            # the weights are 1/(Tukey weight*error)**2
+            sum_weights1 = sum_in_bins(1.0/err1**2,bin_map1,power=-2)
+            binned_flux1 = sum_in_bins(flux1/err1**2,bin_map1,power=-1)/sum_weights1
+            binned_err1 = np.sqrt(1.0/sum_weights1)
+        else:
+            binned_flux1 = sum_in_bins(flux1,bin_map1,ignore_nans=True)
+            binned_err1 = np.sqrt(sum_in_bins(err1**2,bin_map1,power=2,ignore_nans=True))
 
-            if flux2 is not None:
-                current_photon_noise_2.append(np.mean(1/np.sqrt(flux2[i][idx2])))
-                current_SN_2.append(np.sqrt(bin_2_vals).mean())
+        if flux2 is not None:
+            sqrt_flux2 = np.sqrt(flux2)
+            photon_noise_star2 = sum_in_bins(1/sqrt_flux2,bin_map2,power=0)/bin_map2['counts']
+            SN_2 = sum_in_bins(sqrt_flux2,bin_map2,power=0.5)/bin_map2['counts']
 
             if weighted:
-
-                weights1 = 1.0/bin_e1_vals**2
-                current_flux1.append( np.sum(weights1*bin_1_vals) / np.sum(weights1) )
-                current_err1.append( np.sqrt(1.0/np.sum(weights1) ) )
-
-                if flux2 is not None:
-                    weights2 = 1.0/bin_e2_vals**2
-                    current_flux2.append( np.sum(weights2*bin_2_vals) / np.sum(weights2) )
-                    current_err2.append( np.sqrt(1.0/np.sum(weights2) ) )
-
+                sum_weights2 = sum_in_bins(1.0/err2**2,bin_map2,power=-2)
+                binned_flux2 = sum_in_bins(flux2/err2**2,bin_map2,power=-1)/sum_weights2
+                binned_err2 = np.sqrt(1.0/sum_weights2)
             else:
-                current_flux1.append(np.nansum(bin_1_vals))
-                current_err1.append(np.sqrt(np.nansum(bin_e1_vals**2)) )
-
-                if flux2 is not None:
-                    current_flux2.append(np.nansum(bin_2_vals))
-                    current_err2.append(np.sqrt(np.nansum(bin_e2_vals**2)) )
-
-        photon_noise_star1.append(current_photon_noise_1)
-        binned_flux1.append(np.array(current_flux1))
-        binned_err1.append(np.array(current_err1))
-
-        if flux2 is not None:
-            photon_noise_star2.append(current_photon_noise_2)
-            binned_flux2.append(np.array(current_flux2))
-            binned_err2.append(np.array(current_err2))
-
+                binned_flux2 = sum_in_bins(flux2,bin_map2,ignore_nans=True)
+                binned_err2 = np.sqrt(sum_in_bins(err2**2,bin_map2,power=2,ignore_nans=True))
 
+        # the mean of the finite (Tukey weighted) values in each bin, as nan_mean
+        binned_ancillary_data = {}
         if ancillary_data is not None:
             for k in ancillary_data.keys():
-                binned_ancillary_data[k].append(np.array(current_ancil[k]))
-
-        SN_1.append(np.array(current_SN_1))
-
-        if flux2 is not None:
-            SN_2.append(np.array(current_SN_2))
-
-
-    binned_flux1 = np.array(binned_flux1)
-    binned_err1 = np.array(binned_err1)
+                finite = np.isfinite(ancillary_data[k])
+                if np.all(finite):
+                    binned_ancillary_data[k] = sum_in_bins(ancillary_data[k],bin_map1)/bin_map1['counts']
+                else:
+                    binned_ancillary_data[k] = sum_in_bins(np.where(finite,ancillary_data[k],0),bin_map1)/sum_in_bins(finite,bin_map1,power=0)
 
     if flux2 is not None:
-        binned_flux2 = np.array(binned_flux2)
-        binned_err2 = np.array(binned_err2)
-
         flux_ratio = (binned_flux1/binned_flux2)
         err_ratio = np.sqrt((binned_err1/binned_flux1)**2 + (binned_err2/binned_flux2)**2)*flux_ratio
     else:
@@ -479,7 +477,7 @@ def wvl_bin_data(flux1,err1,flux2,err2,wvl_solution,bins,ancillary_data=None,wei
         err_ratio = binned_err1
 
     ancillary_data_norm = {}
-    for k in ancillary_data.keys():
+    for k in binned_ancillary_data.keys():
         ancil = np.transpose(binned_ancillary_data[k])
         ancil_norm = [(i - i.mean())/i.std() for i in ancil]
         ancillary_data_norm[k] = np.array(ancil_norm)
@@ -858,143 +856,34 @@ def wvl_bin_data_different_wvl_solutions(flux1,err1,flux2,err2,wvl_solutions, bi
     photon_noise_star2 - the photon noise for each bin for the comparison
     """
 
-    nbins = len(bins)
-    nframes = len(flux1)
-
-    binned_flux1 = []
-    binned_err1 = []
-
-    binned_flux2 = []
-    binned_err2 = []
-
-    binned_xpos = []
-    binned_sky = []
-
-    photon_noise_star1 = []
-    photon_noise_star2 = []
-
-    # outer loop: loop through all frames (1D spectra)
-    for i in range(nframes):
-
-        current_flux1 = []
-        current_flux2 = []
-
-        current_err1 = []
-        current_err2 = []
-
-        current_xpos = []
-        current_sky = []
-
-        current_photon_noise_1 = []
-        current_photon_noise_2 = []
-
-        current_wvl_solution = wvl_solutions[i]
-
-        # inner loop: loop through all bins
-        for j in range(0,nbins-1):
-
-            idx = (current_wvl_solution >= bins[j]) & (current_wvl_solution < bins[j+1])
-            nidx = len(np.where(flux1[i][idx])[0])
-
-            if n_tukey_points != 0:
-
-                Tukey1 = float(n_tukey_points)/nidx
-
-                # Create dummy array, 2 points longer than our array so that points weighted as 0 by Tukey window fall outside our desired array and thereofre none of our points are 0 weighted
-                dummy_bin1_vals = np.zeros(nidx+2)
-                dummy_e1_vals = np.zeros(nidx+2)
-
-                # replace the values between the first and last dummy points with the actual data
-                dummy_bin1_vals[1:-1] = flux1[i][idx]
-                dummy_e1_vals[1:-1] = err1[i][idx]
-
-                tukey_bin1_vals = dummy_bin1_vals*signal.tukey(nidx+2,Tukey1)
-                bin_1_vals = tukey_bin1_vals[1:-1]
-
-                tukey_e1_vals = dummy_e1_vals*signal.tukey(nidx+2,Tukey1)
-                bin_e1_vals = tukey_e1_vals[1:-1]
-
-                dummy_bin2_vals = np.zeros(nidx+2)
-                dummy_e2_vals = np.zeros(nidx+2)
-
-                dummy_bin2_vals[1:-1] = flux2[i][idx]
-                dummy_e2_vals[1:-1] = err2[i][idx]
-
-                tukey_bin2_vals = dummy_bin2_vals*signal.tukey(nidx+2,Tukey1)
-                bin_2_vals = tukey_bin2_vals[1:-1]
+    bin_map = wvl_bin_map(wvl_solutions,bins,n_tukey_points)
 
-                tukey_e2_vals = dummy_e2_vals*signal.tukey(nidx+2,Tukey1)
-                bin_e2_vals = tukey_e2_vals[1:-1]
+    # empty bins give NaNs (and are zero for the unweighted sums)
+    with np.errstate(divide='ignore',invalid='ignore'):
 
-                dummy_xpos_vals = np.zeros(nidx+2)
-                dummy_sky_vals = np.zeros(nidx+2)
+        photon_noise_star1 = sum_in_bins(1/np.sqrt(flux1),bin_map,power=0)/bin_map['counts']
+        photon_noise_star2 = sum_in_bins(1/np.sqrt(flux2),bin_map,power=0)/bin_map['counts']
 
-                dummy_xpos_vals[1:-1] = xpos[i][idx]
-                dummy_sky_vals[1:-1] = sky[i][idx]
-
-                tukey_xpos_vals = dummy_xpos_vals*signal.tukey(nidx+2,Tukey1)
-                tukey_sky_vals = dummy_sky_vals*signal.tukey(nidx+2,Tukey1)
-
-                bin_xpos = tukey_xpos_vals[1:-1]
-                bin_sky = tukey_sky_vals[1:-1]
-
-
-            else:
-                bin_1_vals = flux1[i][idx]
-                bin_e1_vals = err1[i][idx]
-
-                bin_2_vals = flux2[i][idx]
-                bin_e2_vals = err2[i][idx]
-
-                bin_xpos = xpos[i][idx]
-                bin_sky = sky[i][idx]
-
-            current_xpos.append(bin_xpos.mean())
-            current_sky.append(bin_sky.mean())
-
-            current_photon_noise_1.append(np.mean(1/np.sqrt(flux1[i][idx])))
-            current_photon_noise_2.append(np.mean(1/np.sqrt(flux2[i][idx])))
-
-            if weighted:
-
-                weights1 = 1.0/bin_e1_vals**2
-                weights2 = 1.0/bin_e2_vals**2
-
-                # replace inf values if using Tukey
-                #weights1[weights1 == np.inf] = 0
-                #weights2[weights2 == np.inf] = 0
-
-                current_flux1.append( np.sum(weights1*bin_1_vals) / np.sum(weights1) )
-                current_flux2.append( np.sum(weights2*bin_2_vals) / np.sum(weights2) )
-
-                current_err1.append( np.sqrt(1.0/np.sum(weights1) ) )
-                current_err2.append( np.sqrt(1.0/np.sum(weights2) ) )
-
-            else:
-                current_flux1.append(bin_1_vals.sum())
-                current_flux2.append(bin_2_vals.sum())
-
-                current_err1.append(np.sqrt(np.sum(bin_e1_vals**2)) )
-                current_err2.append(np.sqrt(np.sum(bin_e2_vals**2)) )
-
-        photon_noise_star1.append(current_photon_noise_1)
-        photon_noise_star2.append(current_photon_noise_2)
-
-        binned_flux1.append(np.array(current_flux1))
-        binned_flux2.append(np.array(current_flux2))
+        if weighted:
+            # the weights are 1/(Tukey weight*error)**2
+            sum_weights1 = sum_in_bins(1.0/err1**2,bin_map,power=-2)
+            sum_weights2 = sum_in_bins(1.0/err2**2,bin_map,power=-2)
 
-        binned_err1.append(np.array(current_err1))
-        binned_err2.append(np.array(current_err2))
+            binned_flux1 = sum_in_bins(flux1/err1**2,bin_map,power=-1)/sum_weights1
+            binned_flux2 = sum_in_bins(flux2/err2**2,bin_map,power=-1)/sum_weights2
 
-        binned_xpos.append(np.array(current_xpos))
-        binned_sky.append(np.array(current_sky))
+            binned_err1 = np.sqrt(1.0/sum_weights1)
+            binned_err2 = np.sqrt(1.0/sum_weights2)
 
+        else:
+            binned_flux1 = sum_in_bins(flux1,bin_map)
+            binned_flux2 = sum_in_bins(flux2,bin_map)
 
-    binned_flux1 = np.array(binned_flux1)
-    binned_err1 = np.array(binned_err1)
+            binned_err1 = np.sqrt(sum_in_bins(err1**2,bin_map,power=2))
+            binned_err2 = np.sqrt(sum_in_bins(err2**2,bin_map,power=2))
 
-    binned_flux2 = np.array(binned_flux2)
-    binned_err2 = np.array(binned_err2)
+        binned_xpos = sum_in_bins(xpos,bin_map)/bin_map['counts']
+        binned_sky = sum_in_bins(sky,bin_map)/bin_map['counts']
 
     flux_ratio = (binned_flux1/binned_flux2)
     err_ratio = np.sqrt((binned_err1/binned_flux1)**2 + (binned_err2/binned_flux2)**2)*flux_ratio
@@ -1040,148 +929,35 @@ def wvl_bin_data_indivdual_wvl_solutions(flux1,err1,flux2,err2,wvl_solution1, wv
     photon_noise_star2 - the photon noise for each bin for the comparison
     """
 
-    nbins = len(bins)
-    nframes = len(flux1)
+    bin_map1 = wvl_bin_map(wvl_solution1,bins,n_tukey_points)
+    bin_map2 = wvl_bin_map(wvl_solution2,bins,n_tukey_points)
 
-    binned_flux1 = []
-    binned_err1 = []
+    # empty bins give NaNs (and are zero for the unweighted sums)
+    with np.errstate(divide='ignore',invalid='ignore'):
 
-    binned_flux2 = []
-    binned_err2 = []
+        photon_noise_star1 = sum_in_bins(1/np.sqrt(flux1),bin_map1,power=0)/bin_map1['counts']
+        photon_noise_star2 = sum_in_bins(1/np.sqrt(flux2),bin_map2,power=0)/bin_map2['counts']
 
-    binned_xpos = []
-    binned_sky = []
-
-    photon_noise_star1 = []
-    photon_noise_star2 = []
-
-    # outer loop: loop through all frames (1D spectra)
-    for i in range(nframes):
-
-        current_flux1 = []
-        current_flux2 = []
-
-        current_err1 = []
-        current_err2 = []
-
-        current_xpos = []
-        current_sky = []
-
-        current_photon_noise_1 = []
-        current_photon_noise_2 = []
-
-        current_wvl_solution1 = wvl_solution1[i]
-        current_wvl_solution2 = wvl_solution2[i]
-
-        # inner loop: loop through all bins
-        for j in range(0,nbins-1):
-
-            idx1 = (current_wvl_solution1 >= bins[j]) & (current_wvl_solution1 < bins[j+1])
-            nidx1 = len(np.where(flux1[i][idx1])[0])
-            idx2 = (current_wvl_solution2 >= bins[j]) & (current_wvl_solution2 < bins[j+1])
-            nidx2 = len(np.where(flux2[i][idx2])[0])
-            #print(idx1, idx2)
-
-            if n_tukey_points != 0:
-
-                Tukey1 = float(n_tukey_points)/nidx1
-
-                # Create dummy array, 2 points longer than our array so that points weighted as 0 by Tukey window fall outside our desired array and thereofre none of our points are 0 weighted
-                dummy_bin1_vals = np.zeros(nidx1+2)
-                dummy_e1_vals = np.zeros(nidx1+2)
-
-                # replace the values between the first and last dummy points with the actual data
-                dummy_bin1_vals[1:-1] = flux1[i][idx1]
-                dummy_e1_vals[1:-1] = err1[i][idx1]
-
-                tukey_bin1_vals = dummy_bin1_vals*signal.tukey(nidx1+2,Tukey1)
-                bin_1_vals = tukey_bin1_vals[1:-1]
-
-                tukey_e1_vals = dummy_e1_vals*signal.tukey(nidx1+2,Tukey1)
-                bin_e1_vals = tukey_e1_vals[1:-1]
-
-                dummy_bin2_vals = np.zeros(nidx2+2)
-                dummy_e2_vals = np.zeros(nidx2+2)
-
-                dummy_bin2_vals[1:-1] = flux2[i][idx2]
-                dummy_e2_vals[1:-1] = err2[i][idx2]
-
-                tukey_bin2_vals = dummy_bin2_vals*signal.tukey(nidx2+2,Tukey1)
-                bin_2_vals = tukey_bin2_vals[1:-1]
-
-                tukey_e2_vals = dummy_e2_vals*signal.tukey(nidx2+2,Tukey1)
-                bin_e2_vals = tukey_e2_vals[1:-1]
-
-                dummy_xpos_vals = np.zeros(nidx1+2)
-                dummy_sky_vals = np.zeros(nidx1+2)
-
-                dummy_xpos_vals[1:-1] = xpos[i][idx1]
-                dummy_sky_vals[1:-1] = sky[i][idx1]
-
-                tukey_xpos_vals = dummy_xpos_vals*signal.tukey(nidx1+2,Tukey1)
-                tukey_sky_vals = dummy_sky_vals*signal.tukey(nidx1+2,Tukey1)
-
-                bin_xpos = tukey_xpos_vals[1:-1]
-                bin_sky = tukey_sky_vals[1:-1]
-
-
-            else:
-                bin_1_vals = flux1[i][idx1]
-                bin_e1_vals = err1[i][idx1]
-
-                bin_2_vals = flux2[i][idx2]
-                bin_e2_vals = err2[i][idx2]
-
-                bin_xpos = xpos[i][idx1]
-                bin_sky = sky[i][idx1]
-
-            current_xpos.append(bin_xpos.mean())
-            current_sky.append(bin_sky.mean())
-
-            current_photon_noise_1.append(np.mean(1/np.sqrt(flux1[i][idx1])))
-            current_photon_noise_2.append(np.mean(1/np.sqrt(flux2[i][idx2])))
-
-            if weighted:
-
-                weights1 = 1.0/bin_e1_vals**2
-                weights2 = 1.0/bin_e2_vals**2
-
-                # replace inf values if using Tukey
-                #weights1[weights1 == np.inf] = 0
-                #weights2[weights2 == np.inf] = 0
-
-                current_flux1.append( np.sum(weights1*bin_1_vals) / np.sum(weights1) )
-                current_flux2.append( np.sum(weights2*bin_2_vals) / np.sum(weights2) )
-
-                current_err1.append( np.sqrt(1.0/np.sum(weights1) ) )
-                current_err2.append( np.sqrt(1.0/np.sum(weights2) ) )
-
-            else:
-                current_flux1.append(bin_1_vals.sum())
-                current_flux2.append(bin_2_vals.sum())
-
-                current_err1.append(np.sqrt(np.sum(bin_e1_vals**2)) )
-                current_err2.append(np.sqrt(np.sum(bin_e2_vals**2)) )
-
-        photon_noise_star1.append(current_photon_noise_1)
-        photon_noise_star2.append(current_photon_noise_2)
-
-        binned_flux1.append(np.array(current_flux1))
-        binned_flux2.append(np.array(current_flux2))
-
-        binned_err1.append(np.array(current_err1))
-        binned_err2.append(np.array(current_err2))
+        if weighted:
+            # the weights are 1/(Tukey weight*error)**2
+            sum_weights1 = sum_in_bins(1.0/err1**2,bin_map1,power=-2)
+            sum_weights2 = sum_in_bins(1.0/err2**2,bin_map2,power=-2)
 
-        binned_xpos.append(np.array(current_xpos))
-        binned_sky.append(np.array(current_sky))
+            binned_flux1 = sum_in_bins(flux1/err1**2,bin_map1,power=-1)/sum_weights1
+            binned_flux2 = sum_in_bins(flux2/err2**2,bin_map2,power=-1)/sum_weights2
 
+            binned_err1 = np.sqrt(1.0/sum_weights1)
+            binned_err2 = np.sqrt(1.0/sum_weights2)
 
-    binned_flux1 = np.array(binned_flux1)
-    binned_err1 = np.array(binned_err1)
+        else:
+            binned_flux1 = sum_in_bins(flux1,bin_map1)
+            binned_flux2 = sum_in_bins(flux2,bin_map2)
 
-    binned_flux2 = np.array(binned_flux2)
-    binned_err2 = np.array(binned_err2)
+            binned_err1 = np.sqrt(sum_in_bins(err1**2,bin_map1,power=2))
+            binned_err2 = np.sqrt(sum_in_bins(err2**2,bin_map2,power=2))
 
+        binned_xpos = sum_in_bins(xpos,bin_map1)/bin_map1['counts']
+        binned_sky = sum_in_bins(sky,bin_map1)/bin_map1['counts']
 
     flux_ratio = (binned_flux1/binned_flux2)
     err_ratio = np.sqrt((binned_err1/binned_flux1)**2 + (binned_err2/binned_flux2)**2)*flux_ratio
@@ -1282,14 +1058,14 @@ def binning(x, y,  dy=None, binwidth=None, r=None,newx= None, log = False, nan=F
 	if newx is not None:
 		bin_x = newx
 		bin_x, bin_y, bin_dy, bin_n = uniform_tophat_mean(bin_x,x, y, dy=dy,nan=nan)
-		bin_edge = astrobin.calculate_bin_edges(bin_x)
+		bin_edge = wc.calculate_bin_edges(bin_x)
 
 		return {'bin_y':bin_y, 'bin_x':bin_x, 'bin_edge':bin_edge, 'bin_dy':bin_dy, 'bin_n':bin_n}
 
 	elif r is not None:
 		bin_x = bin_wave_to_R(x, r)
 		bin_x, bin_y, bin_dy, bin_n = uniform_tophat_mean(bin_x,x, y, dy=dy,nan=nan)
-		bin_edge = astrobin.calculate_bin_edges(bin_x)
+		bin_edge = wc.calculate_bin_edges(bin_x)
 
 		return {'bin_y':bin_y, 'bin_x':bin_x, 'bin_edge':bin_edge, 'bin_dy':bin_dy, 'bin_n':bin_n}
 
@@ -1304,7 +1080,7 @@ def binning(x, y,  dy=None, binwidth=None, r=None,newx= None, log = False, nan=F
 		elif not log:
 			bin_x = np.arange(min(x),max(x),binwidth)
 		bin_x, bin_y, bin_dy, bin_n = uniform_tophat_mean(bin_x,x, y, dy=dy,nan=nan)
-		bin_edge = astrobin.calculate_bin_edges(bin_x)
+		bin_edge = wc.calculate_bin_edges(bin_x)
 
 		return {'bin_y':bin_y, 'bin_x':bin_x, 'bin_edge':bin_edge, 'bin_dy':bin_dy, 'bin_n':bin_n}
 
@@ -8,42 +8,118 @@ import matplotlib.pyplot as plt
 import peakutils
 from scipy import stats,optimize,interpolate,conjugate, polyfit
 import pickle
+from concurrent.futures import ProcessPoolExecutor
 from scipy.fftpack import fft, ifft
 from scipy.interpolate import UnivariateSpline as US
 from scipy.signal import medfilt as MF
 from astropy.stats import median_absolute_deviation
-import warnings
 
-with warnings.catch_warnings():
-    # This is to supress the warnings that are generated upon importing pysynphot and are only becuase we've not downloaded the calibration files - which are not needed by us
-    warnings.filterwarnings("ignore", category=UserWarning)
-    from pysynphot import observation
-    from pysynphot import spectrum
 
-
-def rebin_spec(wave, specin, wavnew):
-    """Using pysynphot which conserves flux during resampling.
-    A function that resamples (linearly interpolates) wavelengths and spectra onto a desired wavelength spacing. Formerly this used STSci functions but np.interp performs the same function.
+def calculate_bin_edges(centers):
+    """Calculate the edges of bins from their centres, as done by pysynphot.binning.calculate_bin_edges. The edges are half way between neighbouring centres and are extrapolated by half a bin at each end.
 
     Inputs:
-    wave - the (old) wavelengths to be resampled
-    specin - the single 1D spectrum/error corresponding to the old wavelengths
-    wavnew - the wavelength array to be resampled onto
+    centers - the 1D array of bin centres
 
     Returns:
-    resampled_spectra - the 1D array of the resampled 1D spectrum/errors"""
+    edges - the 1D array of the len(centers)+1 bin edges"""
 
-    spec = spectrum.ArraySourceSpectrum(wave=wave, flux=specin)
-    f = np.ones(len(wave))
-    filt = spectrum.ArraySpectralElement(wave, f, waveunits='angstrom')
-    obs = observation.Observation(spec, filt, binset=wavnew, force='taper')
+    centers = np.asarray(centers)
+    edges = np.zeros(len(centers)+1)
+    edges[1:-1] = (centers[1:] + centers[:-1]) / 2.
+    edges[0] = centers[0] - (centers[1] - centers[0]) / 2.
+    edges[-1] = centers[-1] + (centers[-1] - centers[-2]) / 2.
+    return edges
 
-    return obs.binflux
+
+def rebin_spec(wave, specin, wavnew, mask=None):
+    """A function that resamples spectra onto a desired wavelength spacing while conserving flux. This reproduces pysynphot's Observation(ArraySourceSpectrum(wave,specin),ArraySpectralElement(wave,1),binset=wavnew,force='taper').binflux,
+    without needing pysynphot: each new bin is the integral of the linearly interpolated spectrum across the bin divided by the bin width, with the spectrum tapered to zero beyond the ends of wave (at wave[0]**2/wave[1] and wave[-1]**2/wave[-2]) as done by pysynphot.
+    The integrals are taken from the cumulative integrals of the spectra at the bin edges, so that a whole stack of spectra is resampled in one call. Bins overlapping a nan in a spectrum are nan.
+
+    Inputs:
+    wave - the (old) wavelengths to be resampled. Either a 1D array shared by all spectra or an ndarray of shape (nframes, npixels) with the wavelengths of each frame
+    specin - the single 1D spectrum/error corresponding to the old wavelengths, or a stack of these of shape (nframes, npixels) or (nspectra, nframes, npixels), e.g. the fluxes and errors of all frames
+    wavnew - the wavelength array to be resampled onto
+    mask - boolean array of the shape of wave, defining the points to use (e.g. wave > 0). Default=None, which uses all points
+
+    Returns:
+    resampled_spectra - the array of the resampled spectra/errors, which has the shape of specin except along the last axis, which has len(wavnew) points"""
+
+    single_spectrum = np.ndim(wave) == 1 and np.ndim(specin) == 1
+    wave = np.atleast_2d(np.asarray(wave,dtype=float))
+    specin = np.asarray(specin,dtype=float)
+    edges = calculate_bin_edges(np.asarray(wavnew,dtype=float))
+    nwave,npixels = wave.shape
+    nedges = len(edges)
+    nknots = npixels+2
+
+    if mask is None:
+        mask = np.ones(wave.shape,dtype=bool)
+    mask = np.broadcast_to(np.atleast_2d(mask),wave.shape)
+
+    # move the points in use to the start of each row, padding the rows with repeats of their last point which add nothing to the integrals
+    nvalid = mask.sum(axis=1)
+    order = np.argsort(~mask,axis=1,kind='stable')
+    order = np.where(np.arange(npixels) < nvalid[:,None],order,np.take_along_axis(order,(nvalid-1)[:,None],axis=1))
+    x = np.take_along_axis(wave,order,axis=1)
+
+    # the spectrum is tapered as by pysynphot: it falls linearly to zero at one extra point at each end, spaced by the ratio of the two points at that end, and is zero beyond these
+    first = x[:,0]
+    last = np.take_along_axis(x,(nvalid-1)[:,None],axis=1)[:,0]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        lower = first*first/x[:,1]
+        upper = last*last/np.take_along_axis(x,(nvalid-2)[:,None],axis=1)[:,0]
+    knots = np.hstack((lower[:,None],x,upper[:,None]))
+    widths = np.diff(knots,axis=1)
+
+    # the number of knots of each row that are at or below (a) and below (b) each bin edge
+    rows = np.arange(nwave)[:,None]*(nedges+1)
+    a = np.bincount((rows+np.searchsorted(edges,knots,side='left')).ravel(),minlength=nwave*(nedges+1)).reshape(nwave,nedges+1).cumsum(axis=1)[:,:-1]
+    b = np.bincount((rows+np.searchsorted(edges,knots,side='right')).ravel(),minlength=nwave*(nedges+1)).reshape(nwave,nedges+1).cumsum(axis=1)[:,:-1]
+
+    # the spectra at the knots
+    flux = np.broadcast_to(specin,np.broadcast_shapes(specin.shape,wave.shape))
+    flux = np.take_along_axis(flux,np.broadcast_to(order,flux.shape),axis=-1)
+    zeros = np.zeros(flux.shape[:-1]+(1,))
+    flux = np.concatenate((zeros,flux,zeros),axis=-1)
+    bad = ~np.isfinite(flux)
+    flux[bad] = 0
+
+    # the cumulative integrals of the spectra at the knots
+    integral = np.zeros(flux.shape)
+    np.cumsum((flux[...,1:]+flux[...,:-1])/2*widths,axis=-1,out=integral[...,1:])
+
+    # ...and at the bin edges, adding the part of the segment between the last knot at or below each edge and the edge
+    j = np.clip(a-1,0,nknots-2)
+    x0 = np.take_along_axis(knots,j,axis=1)
+    dx = np.clip(edges,knots[:,:1],knots[:,-1:])-x0
+    w = np.take_along_axis(widths,j,axis=1)
+    frac = np.divide(dx,w,out=np.zeros(dx.shape),where=w > 0)
+
+    j = np.broadcast_to(j,flux.shape[:-1]+(nedges,))
+    f0 = np.take_along_axis(flux,j,axis=-1)
+    f1 = np.take_along_axis(flux,j+1,axis=-1)
+    edge_integral = np.take_along_axis(integral,j,axis=-1) + dx*(f0+(f1-f0)*frac/2)
+
+    resampled_spectra = np.diff(edge_integral,axis=-1)/np.diff(edges)
+
+    # nan any bin that overlaps a segment with a nan at either end
+    bad_segments = np.zeros(flux.shape)
+    np.cumsum((bad[...,1:] | bad[...,:-1]) & (widths > 0),axis=-1,out=bad_segments[...,1:])
+    lo = np.broadcast_to(np.clip(a[:,:-1]-1,0,nknots-1),resampled_spectra.shape)
+    hi = np.broadcast_to(np.clip(b[:,1:],0,nknots-1),resampled_spectra.shape)
+    nbad = np.take_along_axis(bad_segments,hi,axis=-1)-np.take_along_axis(bad_segments,lo,axis=-1)
+    resampled_spectra[(nbad > 0) | (nvalid[:,None] < 2)] = np.nan
+
+    if single_spectrum:
+        return resampled_spectra[0]
+    return resampled_spectra
 
 
 def resample_spectra(current_pixels,star,error,sampled_grid):
 
-    """The function that iterates through the ndarray of all 1D spectra and errors and resamples them.
+    """The function that resamples the ndarray of all 1D spectra and errors, in one call of rebin_spec.
 
     Inputs:
     current_pixels - the ndarray of the current pixel locations (equal to np.arange(0,len(spectrum)))
@@ -56,21 +132,13 @@ def resample_spectra(current_pixels,star,error,sampled_grid):
     np.array(resampled_errors) - the ndarray of resampled 1D errors
     """
 
-    resampled_flux = []
-    resampled_error = []
-
     clip_idx = sampled_grid > 0
     sampled_grid = sampled_grid[clip_idx]
 
-    for i,s in enumerate(star):
-
-        non_negative = current_pixels[i] > 0
-
-        resampled_flux.append(rebin_spec(current_pixels[i][non_negative],star[i][non_negative],sampled_grid))
+    current_pixels = np.asarray(current_pixels)
+    resampled_flux,resampled_error = rebin_spec(current_pixels,np.array([star,error]),sampled_grid,mask=current_pixels > 0)
 
-        resampled_error.append(rebin_spec(current_pixels[i][non_negative],error[i][non_negative],sampled_grid))
-
-    return np.array(resampled_flux),np.array(resampled_error)
+    return resampled_flux,resampled_error
 
 def find_solution(z_pos, phi_ref_check_m):
     '''
@@ -151,23 +219,81 @@ def cross_correlate(frame, reference_image):
     return z_pos_x, phi_ref_check_m_x
 
 
+def cross_correlate_all(frames, reference_image):
+    """The batched version of cross_correlate, which cross-correlates a stack of 1D spectra with the reference spectrum.
+    The FFT of the reference is computed once and all frames are transformed with a single real FFT along their last axis.
+
+    Inputs:
+    frames - the ndarray of 1D spectra, of shape (nframes, npoints)
+    reference_image - the spectrum to compare to
+
+    Returns:
+    cross_power - the ndarray of the cross-power spectra, of shape (nframes, npoints//2+1), which can be passed to find_all_solutions"""
+
+    return np.conj(np.fft.rfft(reference_image))*np.fft.rfft(np.atleast_2d(frames),axis=-1)
+
+
+def find_all_solutions(cross_power, npoints, method="parabolic"):
+    """The batched version of find_solution, which converts the cross-power spectra of cross_correlate_all into the shifts of all frames.
+    The peak of each cross-correlation function is refined to sub-pixel resolution with either:
+    "parabolic" - the quadratic through the three pixels around the peak, as done by find_solution (the results are identical)
+    "phase" - the weighted slope of the phase of the cross-power spectrum once the integer shift of the peak has been removed, which uses all frequencies rather than three pixels
+
+    Inputs:
+    cross_power - the ndarray of the cross-power spectra, as returned by cross_correlate_all
+    npoints - the number of points in the cross-correlated spectra
+    method - the sub-pixel refinement, "parabolic" or "phase". Default="parabolic"
+
+    Returns:
+    solution - the array of the shifts in pixels of all frames, with the same sign as find_solution"""
+
+    phi = np.fft.irfft(cross_power,npoints,axis=-1)
+    rows = np.arange(len(phi))
+    z_pos = np.argmax(phi,axis=1)
+
+    if method == "parabolic":
+        left = phi[rows,z_pos-1]
+        centre = phi[rows,z_pos]
+        right = phi[rows,(z_pos+1)%npoints]
+        with np.errstate(divide='ignore',invalid='ignore'):
+            peak = z_pos + (left-right)/(2*(left-2*centre+right))
+
+    elif method == "phase":
+        # remove the integer shift, leaving a phase of -2 pi k offset / npoints at frequency k
+        k = np.arange(cross_power.shape[1])
+        residual = cross_power*np.exp(2j*np.pi*k*z_pos[:,None]/npoints)
+        weights = np.abs(residual)
+        phase = np.angle(residual)
+        peak = z_pos - npoints/(2*np.pi)*np.sum(weights*k*phase,axis=1)/np.sum(weights*k**2,axis=1)
+
+    else:
+        raise ValueError('method must be "parabolic" or "phase"')
+
+    # peaks in the second half of the cross-correlation function are negative lags
+    solution = np.where(z_pos <= npoints/2,-peak,npoints-peak)
+
+    return solution
 
-def compute_shifts(frame,reference_frame,line_positions,box_width=10,verbose=False):
+
+
+def compute_shifts(frame,reference_frame,line_positions,box_width=10,verbose=False,method="parabolic"):
 
     """
-    The function that performs the cross correlation for a single frame/1D spectrum.
+    The function that performs the cross correlation for a single frame/1D spectrum, or for all frames at once if given an ndarray of 1D spectra.
 
     Inputs:
-    frame - the 1D spectrum
+    frame - the 1D spectrum, or the ndarray of 1D spectra of shape (nframes, npoints)
     reference_frame - the reference 1D spectrum
     line_positions - the positions of absorption lines to look into with the cross correlation
     box_width - the width of the region around each absorption line over which the cross correlation is performed. Default=10
     verbose - True/False - plot the output? Default=False
+    method - the sub-pixel refinement of the cross-correlation peak, "parabolic" or "phase" (see find_all_solutions). Default="parabolic"
 
     Returns:
-    np.array(shifts) - the measured shifts between the input spectrum and the reference
+    np.array(shifts) - the measured shifts between the input spectrum and the reference, of shape (nlines) for a single spectrum or (nframes, nlines) for an ndarray of spectra
     """
 
+    frames = np.atleast_2d(frame)
     shifts = []
 
     if verbose:
@@ -177,10 +303,10 @@ def compute_shifts(frame,reference_frame,line_positions,box_width=10,verbose=Fal
     for i,l in enumerate(line_positions):
         if isinstance(box_width,list):
             ref_region = reference_frame[l-box_width[i]:l+box_width[i]]
-            frame_region = frame[l-box_width[i]:l+box_width[i]]
+            frame_region = frames[:,l-box_width[i]:l+box_width[i]]
         else:
             ref_region = reference_frame[l-box_width:l+box_width]
-            frame_region = frame[l-box_width:l+box_width]
+            frame_region = frames[:,l-box_width:l+box_width]
 
 
         # Now lets normalise
@@ -192,18 +318,16 @@ def compute_shifts(frame,reference_frame,line_positions,box_width=10,verbose=Fal
         ref_region = ref_region/poly_ref(np.arange(len(ref_region)))
         ref_region = ref_region/min(ref_region)
 
-        poly_frame = np.poly1d(np.polyfit(np.array([0,len(frame_region)]),np.array([frame_region[0],frame_region[-1]]),1))
-        frame_region = frame_region/poly_ref(np.arange(len(frame_region)))
-        frame_region = frame_region/min(frame_region)
+        frame_region = frame_region/poly_ref(np.arange(frame_region.shape[1]))
+        frame_region = frame_region/frame_region.min(axis=1)[:,None]
 
-
-        cc = cross_correlate(frame_region,ref_region)
-        sol = find_solution(cc[0],cc[1])
+        sol = find_all_solutions(cross_correlate_all(frame_region,ref_region),len(ref_region),method)
 
         if verbose:
             #plt.subplot(nfeatures,1,i+1)
             plt.plot(ref_region-i*0.4,color='r')
-            plt.plot(frame_region-i*0.4,color='b',label=str(sol))
+            for f,s in zip(frame_region,sol):
+                plt.plot(f-i*0.4,color='b',label=str(s))
             plt.yticks(visible=False)
             plt.legend(loc='upper right')
             plt.xlabel('Pixel position')
@@ -215,7 +339,11 @@ def compute_shifts(frame,reference_frame,line_positions,box_width=10,verbose=Fal
     if verbose:
         plt.show()
 
-    return np.array(shifts)
+    shifts = np.array(shifts).T
+
+    if np.ndim(frame) == 1:
+        return shifts[0]
+    return shifts
 
 
 def polyfit_shifts(line_positions,shifts,npoints,poly_order=3,verbose=False,refit_polynomial=None):
@@ -286,7 +414,7 @@ def polyfit_shifts(line_positions,shifts,npoints,poly_order=3,verbose=False,refi
 
 
 
-def compute_all_shifts(ref_frame,all_frames,all_errors,line_positions,search_width=10,poly_order=3,verbose=False,refit_polynomial=None,resample=True,ancillary_data=None):
+def compute_all_shifts(ref_frame,all_frames,all_errors,line_positions,search_width=10,poly_order=3,verbose=False,refit_polynomial=None,resample=True,ancillary_data=None,method="parabolic"):
     """The function that computes the shifts in the spectra for all 1D spectra using the cross-correlation technique.
 
     Inputs:
@@ -301,6 +429,7 @@ def compute_all_shifts(ref_frame,all_frames,all_errors,line_positions,search_wid
                        The value given to refit_polynomial is an integer and is interpreted as the number of standard deviations away from the residuals that should be clipped.
     resample - True/False - Set whether you want this function to perform the flux and error resampling. Default=True.
     ancillary_data - a dictionary of ancillary data to be resampled (e.g., xpos, sky). Can be left as None, in which case no ancillary data is resampled
+    method - the sub-pixel refinement of the cross-correlation peaks, "parabolic" or "phase" (see find_all_solutions). Default="parabolic"
 
     Returns:
     np.array(resampled_flux) - the 1D spectra resampled onto the same x-axis as the reference spectrum
@@ -311,7 +440,6 @@ def compute_all_shifts(ref_frame,all_frames,all_errors,line_positions,search_wid
     """
     resampled_flux = []
     resampled_error = []
-    all_shifts = []
     all_polys = []
 
 
@@ -325,24 +453,24 @@ def compute_all_shifts(ref_frame,all_frames,all_errors,line_positions,search_wid
         for i in ancillary_data.keys():
             resampled_dict[i] = []
 
-    for i,f in enumerate(all_frames):
-        shifts = compute_shifts(f,ref_frame,line_positions,search_width)
-        all_shifts.append(shifts)
+    # cross-correlate all frames at once
+    all_shifts = compute_shifts(all_frames,ref_frame,line_positions,search_width,method=method)
 
+    for shifts in all_shifts:
         pixel_solution = polyfit_shifts(line_positions,shifts,npoints,poly_order,False,refit_polynomial)
 
         all_polys.append(pixel_solution)
 
-        # Only take the positive indices
-        idx = pixel_solution > 0
-
-        if resample:
-            resampled_flux.append(rebin_spec(pixel_solution[idx],f[idx],np.arange(1,npoints+1)))
-            resampled_error.append(rebin_spec(pixel_solution[idx],all_errors[i][idx],np.arange(1,npoints+1)))
+    if resample:
+        # resample the fluxes, errors and ancillary data of all frames at once, only taking the positive indices of each pixel solution
+        pixel_solutions = np.array(all_polys)
+        keys = [] if ancillary_data is None else list(resampled_dict.keys())
+        resampled = rebin_spec(pixel_solutions,np.array([all_frames,all_errors]+[ancillary_data[k] for k in keys]),np.arange(1,npoints+1),mask=pixel_solutions > 0)
 
-            if ancillary_data is not None:
-                for k in resampled_dict.keys():
-                    resampled_dict[k].append(rebin_spec(pixel_solution[idx],ancillary_data[k][i][idx],np.arange(1,npoints+1)))
+        resampled_flux = resampled[0]
+        resampled_error = resampled[1]
+        for j,k in enumerate(keys):
+            resampled_dict[k] = resampled[j+2]
 
 
     if verbose:
@@ -384,7 +512,7 @@ def nan_helper(y):
 
 
 
-def compute_all_shifts_whole_spectrum(ref_frame,all_frames,all_errors,verbose=False,resample=True,ancillary_data=None,user_shifts=None):
+def compute_all_shifts_whole_spectrum(ref_frame,all_frames,all_errors,verbose=False,resample=True,ancillary_data=None,user_shifts=None,method="parabolic"):
     """The function that computes the shifts in the spectra for all 1D spectra using the cross-correlation technique.
     Unlike compute_all_shifts() which computes the cross-correlation function at different points along the spectrum,
     this function computes one cross-correlation function for the entire function, which is applicable when the spectra are
@@ -398,6 +526,7 @@ def compute_all_shifts_whole_spectrum(ref_frame,all_frames,all_errors,verbose=Fa
     resample - True/False - Set whether you want this function to perform the flux and error resampling. Default=True.
     ancillary_data - a dictionary of ancillary data to be resampled (e.g., xpos, sky). Can be left as None, in which case no ancillary data is resampled
     user_shifts - if wanting to override the shifts calculated for this star with shifts calculated from another star, parse the new user-defined shifts here
+    method - the sub-pixel refinement of the cross-correlation peak, "parabolic" or "phase" (see find_all_solutions). Default="parabolic"
 
     Returns:
     np.array(resampled_flux) - the 1D spectra resampled onto the same x-axis as the reference spectrum
@@ -407,7 +536,6 @@ def compute_all_shifts_whole_spectrum(ref_frame,all_frames,all_errors,verbose=Fa
 
     resampled_flux = []
     resampled_error = []
-    all_shifts = []
 
     # replace any nans with a linear interpolation for finding shifts only - the end spectra still contain nans
     if np.any(~np.isfinite(ref_frame)):
@@ -425,36 +553,29 @@ def compute_all_shifts_whole_spectrum(ref_frame,all_frames,all_errors,verbose=Fa
 
     x_ref = np.arange(10,len(ref_frame)+10) # add 10 here, this keeps the pixel solution positive and doesn't actually matter since we're not using this as our final solution, only for calculating shifts!
 
-    for i,f in enumerate(all_frames):
-        print("cross-correlating frame %d"%i)
+    if user_shifts is None:
+        print("cross-correlating %d frames"%len(all_frames))
 
         # replace any nans with a linear interpolation for finding shifts only - the end spectra still contain nans
-        if np.any(~np.isfinite(f)):
-            y = f.copy()
-            nans, x= nan_helper(y)
-            y[nans]= np.interp(x(nans), x(~nans), y[~nans])
-        else:
-            y = f
-
-        if user_shifts is None:
-            cc = cross_correlate(y[20:-20],ref_frame[20:-20]) # ignore 20 pixels at edge of spectra when doing cross-correlation
-            shift = find_solution(cc[0],cc[1])
-        else:
-            shift = user_shifts[i]
+        y = np.array(all_frames,dtype=float)
+        for i in np.where(np.any(~np.isfinite(y),axis=1))[0]:
+            nans, x= nan_helper(y[i])
+            y[i][nans]= np.interp(x(nans), x(~nans), y[i][~nans])
 
-        all_shifts.append(shift)
-
-        x = x_ref + shift
-
-        interp = rebin_spec(x,f,x_ref)
+        all_shifts = find_all_solutions(cross_correlate_all(y[:,20:-20],ref_frame[20:-20]),len(ref_frame[20:-20]),method) # ignore 20 pixels at edge of spectra when doing cross-correlation
+    else:
+        all_shifts = np.array(user_shifts)[:len(all_frames)]
 
-        if resample:
-            resampled_flux.append(rebin_spec(x,f,x_ref))
-            resampled_error.append(rebin_spec(x,all_errors[i],x_ref))
+    if resample:
+        # resample the fluxes, errors and ancillary data of all frames at once, each frame on its own shifted x-axis
+        x = x_ref + np.array(all_shifts)[:,None]
+        keys = [] if ancillary_data is None else list(resampled_dict.keys())
+        resampled = rebin_spec(x,np.array([all_frames,all_errors]+[ancillary_data[k] for k in keys]),x_ref)
 
-            if ancillary_data is not None:
-                for k in resampled_dict.keys():
-                    resampled_dict[k].append(rebin_spec(x,ancillary_data[k][i],x_ref))
+        resampled_flux = resampled[0]
+        resampled_error = resampled[1]
+        for j,k in enumerate(keys):
+            resampled_dict[k] = resampled[j+2]
 
     if verbose:
 
@@ -725,7 +846,7 @@ def resample_smoothly(reference_pixel_locations,measured_shifts,input_arrays,sig
     refit_polynomial - Define whether we want to refit the polynomial after the initial fit. This allows us to clip outliers from the first fit.
                        The value given to refit_polynomial is an integer and is interpreted as the number of standard deviations away from the residuals that should be clipped.
     reference_wvl_array: can be set to the wavelength array to resample the data onto if working in wavelength, not pixel, space. If working in pixel space, leave this as None.
-    use_pysynphot - True/False. Choose whether to use pysynphot to perform the resampling (via rebin_spec) or use np.interp for 1D linear interpolation. Note the difference is negligible but np.interp1d is much faster. Default=False.
+    use_pysynphot - True/False. Choose whether to perform a flux-conserving resampling (via rebin_spec, which reproduces pysynphot's resampling) or use np.interp for 1D linear interpolation. Note the difference is negligible but np.interp is faster. Default=False.
 
     Returns:
     resampled_dict - the dictionary of inputs resampled onto the desired x-axis
@@ -855,6 +976,8 @@ def resample_smoothly(reference_pixel_locations,measured_shifts,input_arrays,sig
     else:
         x_ref = npixels = reference_wvl_array
 
+    pixel_solutions = []
+
     for i in frames:
         if i == 0 and verbose or i == len(frames)-1 and verbose:
             print('PIXEL SOLUTION PLOT FOR FRAME %d'%i)
@@ -866,17 +989,19 @@ def resample_smoothly(reference_pixel_locations,measured_shifts,input_arrays,sig
         pixel_solution_refitted = polyfit_shifts(reference_pixel_locations[good_lines],smooth_shifts[i],npixels,poly_order=poly_order,verbose=v,refit_polynomial=refit_polynomial)
 
         if use_pysynphot:
-            # Only take the positive indices
-            idx = pixel_solution_refitted > 0
+            pixel_solutions.append(pixel_solution_refitted)
 
-        for d in input_arrays:
-
-            if use_pysynphot:
-                resampled_dict[d].append(rebin_spec(pixel_solution_refitted[idx],input_arrays[d][i][idx],x_ref))
-
-            else:
+        else:
+            for d in input_arrays:
                 resampled_dict[d].append(np.interp(x_ref,pixel_solution_refitted,input_arrays[d][i]))
 
+    if use_pysynphot:
+        # resample all inputs of all frames at once, only taking the positive indices of each pixel solution
+        pixel_solutions = np.array(pixel_solutions)
+        resampled = rebin_spec(pixel_solutions,np.array([input_arrays[d] for d in input_arrays]),x_ref,mask=pixel_solutions > 0)
+        for j,d in enumerate(input_arrays):
+            resampled_dict[d] = resampled[j]
+
     # convert from lists to arrays
     for d in input_arrays:
         resampled_dict[d] = np.array(resampled_dict[d])
@@ -925,8 +1050,38 @@ def moffat_residuals(a,r,y):
 
 
 
+def moffat_jacobian(a,r,y):
+    """The analytic Jacobian of moffat_residuals with respect to the Moffat parameters, which is passed to optimize.leastsq (as Dfun) so that it doesn't need to estimate it by finite differences.
+
+    Inputs:
+    a - the list of [alpha,beta,location,width,amplitude,continuum flux] as required by moffat()
+    r - the x array (typically pixels)
+    y - the y array (flux), unused but needed to match the arguments of moffat_residuals
 
-def moffat_fit_lines(flux,error,line_positions,wvl=None,tolerance=10,box_width=60,enforce_negative=False,verbose=False,return_nans=True):
+    Returns:
+    jacobian - the ndarray of shape (len(r), 6) of the derivatives of the residuals with respect to each parameter
+    """
+
+    u = (r-a[2])/a[0]
+    x = 2. * (a[1]-1.) / (a[0] * a[0])
+    y_factor = 1. + u**2.
+    profile = y_factor ** -a[1]
+
+    jacobian = np.empty((len(r),6))
+    jacobian[:,0] = 2. * a[3] * x * profile / a[0] * (a[1] * u**2. / y_factor - 1.)
+    jacobian[:,1] = a[3] * profile * (2. / (a[0] * a[0]) - x * np.log(y_factor))
+    jacobian[:,2] = 2. * a[3] * x * a[1] * u * profile / (y_factor * a[0])
+    jacobian[:,3] = x * profile
+    jacobian[:,4] = r
+    jacobian[:,5] = 1.
+
+    # the residuals are y - moffat, so their derivatives are minus those of the profile
+    return -jacobian
+
+
+
+
+def moffat_fit_lines(flux,error,line_positions,wvl=None,tolerance=10,box_width=60,enforce_negative=False,verbose=False,return_nans=True,initial_guesses=None,return_parameters=False):
     """A function to fit Moffat profiles at a list of user-defined absorption line locations for a SINGLE stellar spectrum, not an ndarry of multiple spectra. For this use fit_all_moffat_profiles().
 
     Inputs:
@@ -942,11 +1097,15 @@ def moffat_fit_lines(flux,error,line_positions,wvl=None,tolerance=10,box_width=6
                        negative despite a good fit, so should be used with caution. Default=False
     verbose - True/False. If set to True, plot the results of the fit. Default=False
     return_nans - True/False. If True, any fits which have failed return centres which are at np.nan - so that they can be easily ignored by subsequent analysis while preserving the shape of the input arrays. Default=True
+    initial_guesses - the ndarray of shape (nlines, 6) of the Moffat parameters to start the fit of each line from, e.g. the fitted parameters of the previous spectrum. Lines with nan guesses, or whose fits from these guesses fail,
+                      are fitted from the default starting parameters [4.0,1.5,line position,-150000.,0.,50000.]. Default=None, using the default starting parameters for all lines
+    return_parameters - True/False. If True, also return the fitted Moffat parameters of each line. Default=False
 
     Returns:
     ref_lines - the ndarray of the fitted absorption line centres
     resulting_box_widths - the ndarray of the box widths used to actually fit the data
     indices_of_good_lines - the indices (line number) of the absorption lines where a successful fit was found
+    fitted_parameters - (only if return_parameters=True) the ndarray of shape (nlines, 6) of the fitted Moffat parameters of each line, which are nan for the lines whose fits failed
 
     """
 
@@ -961,58 +1120,72 @@ def moffat_fit_lines(flux,error,line_positions,wvl=None,tolerance=10,box_width=6
 
     indices_of_good_lines = []
 
+    fitted_parameters = np.full((len(line_positions),6),np.nan)
+
     for i,l in enumerate(line_positions):
 
-        for w in box_width:
+        # try the initial guess first (if given) and fall back to the default starting parameters
+        starting_parameters = [np.array([4.0,1.5,l,-150000.,0.,50000.])]
+        if initial_guesses is not None and np.all(np.isfinite(initial_guesses[i])):
+            starting_parameters.insert(0,np.array(initial_guesses[i]))
 
-            if wvl is not None: # we're working in wavelength (A) space
+        for p0 in starting_parameters:
 
-                index = ((wvl >= l-w//2) & (wvl < l+w//2))
-                flux_y = flux[index]
-                error_y = error[index]
-                x = wvl[index]
+            for w in box_width:
 
-            else: # we're working in pixel space
+                if wvl is not None: # we're working in wavelength (A) space
 
-                if (l - w//2) < 0:
-                    left_pixel = 0
-                else:
-                    left_pixel = l - w//2
+                    index = ((wvl >= l-w//2) & (wvl < l+w//2))
+                    flux_y = flux[index]
+                    error_y = error[index]
+                    x = wvl[index]
 
-                if (l + w//2) > len(spectrum):
-                    right_pixel = len(spectrum)
-                else:
-                    right_pixel = l + w//2
+                else: # we're working in pixel space
+
+                    if (l - w//2) < 0:
+                        left_pixel = 0
+                    else:
+                        left_pixel = l - w//2
+
+                    if (l + w//2) > len(flux):
+                        right_pixel = len(flux)
+                    else:
+                        right_pixel = l + w//2
+
+                    flux_y = flux[left_pixel:right_pixel]
 
-                flux_y = flux[left_pixel:right_pixel]
+                    x = np.arange(left_pixel,right_pixel)
 
-                x = np.arange(left_pixel,right_pixel)
+                parms_y = optimize.leastsq(moffat_residuals,p0,args=(x,flux_y),Dfun=moffat_jacobian)
 
-            parms_y = optimize.leastsq(moffat_residuals,np.array([4.0,1.5,l,-150000.,0.,50000.]),args=(x,flux_y))
+                xfine = np.arange(x[0],x[-1],0.001)
 
-            xfine = np.arange(x[0],x[-1],0.001)
+                if abs(parms_y[0][2] - l) <= tolerance:
 
-            if abs(parms_y[0][2] - l) <= tolerance:
+                    success = True
 
-                success = True
+                    if enforce_negative:
+                        if parms_y[0][3] < 0:
+                            ref_lines.append(parms_y[0][2])
+                            resulting_box_widths.append(w)
+                            indices_of_good_lines.append(i)
+                            fitted_parameters[i] = parms_y[0]
+                            break
+                        else:
+                            success = False
 
-                if enforce_negative:
-                    if parms_y[0][3] < 0:
+                    else:
                         ref_lines.append(parms_y[0][2])
                         resulting_box_widths.append(w)
                         indices_of_good_lines.append(i)
+                        fitted_parameters[i] = parms_y[0]
                         break
-                    else:
-                        success = False
 
                 else:
-                    ref_lines.append(parms_y[0][2])
-                    resulting_box_widths.append(w)
-                    indices_of_good_lines.append(i)
-                    break
+                    success = False
 
-            else:
-                success = False
+            if success:
+                break
 
         if not success and return_nans:
             ref_lines.append(np.nan)
@@ -1033,13 +1206,46 @@ def moffat_fit_lines(flux,error,line_positions,wvl=None,tolerance=10,box_width=6
                 plt.xlabel("Y pixel")
             plt.show()
 
+    if return_parameters:
+        return np.array(ref_lines),np.array(resulting_box_widths),np.array(indices_of_good_lines),fitted_parameters
+
     return np.array(ref_lines),np.array(resulting_box_widths),np.array(indices_of_good_lines)
 
 
-def fit_all_moffat_profiles(flux_array,error_array,ref_lines,wvl_array=None,tolerance=10,box_width=60,enforce_negative=False,verbose=False,return_nans=True):
+def fit_moffat_block(block):
+    """Fit the Moffat profiles of a contiguous block of 1D spectra in turn, starting the fits to each spectrum from the fitted parameters of the previous spectrum if warm_start=True.
+    This is the function executed by each worker process of fit_all_moffat_profiles.
+
+    Inputs:
+    block - the tuple of (flux_array,error_array,wvl_array,ref_lines,tolerance,box_width,enforce_negative,verbose,return_nans,warm_start) of the block, as described in fit_all_moffat_profiles
+
+    Returns:
+    np.array(moffat_line_centres) - the ndarray of absorption line shifts of the spectra in the block"""
+
+    flux_array,error_array,wvl_array,ref_lines,tolerance,box_width,enforce_negative,verbose,return_nans,warm_start = block
+
+    moffat_line_centres = []
+    fitted_parameters = None
+
+    for spectrum,error,wavelength in zip(flux_array,error_array,wvl_array):
+
+        line_locations,_,_,parameters = moffat_fit_lines(spectrum,error,ref_lines,wavelength,tolerance,box_width,enforce_negative,verbose,return_nans,fitted_parameters,True)
+
+        if warm_start:
+            fitted_parameters = parameters
+
+        shifts = ref_lines - line_locations
+
+        moffat_line_centres.append(shifts)
+
+    return np.array(moffat_line_centres)
+
+
+def fit_all_moffat_profiles(flux_array,error_array,ref_lines,wvl_array=None,tolerance=10,box_width=60,enforce_negative=False,verbose=False,return_nans=True,warm_start=True,nworkers=1):
 
     """
     A function to fit Moffat profiles to the ndarray of all 1D spectra, by looping through each and running moffat_fit_lines().
+    The fits to each spectrum start from the fitted parameters of the previous spectrum, and the spectra can be split into contiguous blocks that are fitted in parallel.
 
     Inputs:
     flux_array - the ndarray of 1D spectra
@@ -1052,29 +1258,27 @@ def fit_all_moffat_profiles(flux_array,error_array,ref_lines,wvl_array=None,tole
                the fitting procedure, with the first box width that corresponds to a successful fit being used. Default=60
     enforce_negative - use this to enforce that the Moffat profile's ampitude is negative (as it should be for an absorption line). HOWEVER: sometimes the other Moffat normalisation functions can prevent this from being
                        negative despite a good fit, so should be used with caution. Default=False
-    verbose - True/False. If set to True, plot the results of the fit. Default=False
+    verbose - True/False. If set to True, plot the results of the fit. This is switched off if nworkers > 1. Default=False
     return_nans - True/False. If True, any fits which have failed return centres which are at np.nan - so that they can be easily ignored by subsequent analysis while preserving the shape of the input arrays. Default=True
+    warm_start - True/False. If True, start the fits to each spectrum from the fitted parameters of the previous spectrum (within each block), rather than from the default starting parameters. Default=True
+    nworkers - the number of worker processes to fit the spectra with, each fitting one contiguous block of spectra. Default=1
 
     Returns:
     np.array(moffat_line_centres) - the ndarray of absorption line shifts as measured for each 1D spectrum. This is calculated as: reference location - measured location
 
     """
 
-    moffat_line_centres = []
-
     if wvl_array is None: # we make an array of pixel numbers equal in shape to flux_array
         wvl_array = np.array(list(range(0,flux_array.shape[1]))*flux_array.shape[0]).reshape(flux_array.shape[0],flux_array.shape[1])
 
+    if nworkers > 1:
+        print("Fitting Moffat profiles to %d spectra with %d worker processes, plotting is switched off"%(len(flux_array),nworkers))
+        blocks = [(flux_array[b],error_array[b],wvl_array[b],ref_lines,tolerance,box_width,enforce_negative,False,return_nans,warm_start) for b in np.array_split(np.arange(len(flux_array)),nworkers)]
+        with ProcessPoolExecutor(nworkers) as pool:
+            moffat_line_centres = np.vstack(list(pool.map(fit_moffat_block,blocks)))
 
-    for spectrum,error,wavelength in zip(flux_array,error_array,wvl_array):
-
-        current_shifts = []
-
-        line_locations,_,_ = moffat_fit_lines(spectrum,error,ref_lines,wavelength,tolerance,box_width,enforce_negative,verbose,return_nans)
-
-        shifts = ref_lines - line_locations
-
-        moffat_line_centres.append(shifts)
+    else:
+        moffat_line_centres = fit_moffat_block((flux_array,error_array,wvl_array,ref_lines,tolerance,box_width,enforce_negative,verbose,return_nans,warm_start))
 
     return np.array(moffat_line_centres)
 
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the scripts are run from their own directory with src on the path, so import their sibling modules (e.g. cosmic_removal) and global_utils directly
+src = os.path.join(os.path.dirname(__file__),'..','src')
+sys.path.insert(0,src)
+sys.path.insert(0,os.path.join(src,'reduction_utils'))
@@ -0,0 +1,65 @@
+import warnings
+import numpy as np
+import pytest
+
+cosmic_removal = pytest.importorskip("cosmic_removal")
+
+
+def looped_interp_bad_pixels(frame,pixel_mask):
+    """The row-by-row loop that interp_bad_pixels(..., replace_with_medians=True) replaced: each bad pixel is replaced by the median of its
+    nearest good neighbour to the left and to the right (the adjacent pixel, else the one beyond it)"""
+    nrows,ncols = frame.shape
+    for i in range(nrows):
+        for j in range(ncols):
+            if pixel_mask[i][j]:
+                surrounding_pixels = []
+                if j > 0:
+                    if not pixel_mask[i][j-1]:
+                        surrounding_pixels.append(frame[i][j-1])
+                    elif j > 1 and not pixel_mask[i][j-2]:
+                        surrounding_pixels.append(frame[i][j-2])
+                if j < ncols-1:
+                    if not pixel_mask[i][j+1]:
+                        surrounding_pixels.append(frame[i][j+1])
+                    elif j < ncols-2 and not pixel_mask[i][j+2]:
+                        surrounding_pixels.append(frame[i][j+2])
+                frame[i][j] = np.nanmedian(surrounding_pixels)
+    return frame
+
+
+def bad_frame(rng,shape,dtype):
+    frame = rng.normal(1000,50,shape).astype(dtype)
+    pixel_mask = rng.random(shape) < 0.15
+    pixel_mask[...,0] = pixel_mask[...,-1] = True # pixels at the edges
+    pixel_mask[...,3,10:14] = True # a run of bad pixels with no good neighbours for the middle two
+    if np.issubdtype(dtype,np.floating):
+        frame[...,5,20] = np.nan # a NaN neighbour
+        pixel_mask[...,5,21] = True
+    return frame,pixel_mask
+
+
+@pytest.mark.parametrize("dtype",[np.float64,np.float32,np.int32])
+def test_median_replacement_matches_loop(dtype):
+    frame,pixel_mask = bad_frame(np.random.default_rng(5),(30,40),dtype)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore",RuntimeWarning) # the nanmedian of no good neighbours
+        expected = looped_interp_bad_pixels(frame.copy(),pixel_mask)
+        replaced = cosmic_removal.interp_bad_pixels(frame.copy(),pixel_mask,replace_with_medians=True)
+
+    assert replaced.dtype == expected.dtype
+    np.testing.assert_array_equal(replaced,expected)
+
+
+def test_median_replacement_of_cube():
+    rng = np.random.default_rng(6)
+    frames,pixel_masks = bad_frame(rng,(3,30,40),np.float64)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore",RuntimeWarning)
+        replaced = cosmic_removal.interp_bad_pixels(frames.copy(),pixel_masks,replace_with_medians=True)
+        shared_mask = cosmic_removal.interp_bad_pixels(frames.copy(),pixel_masks[0],replace_with_medians=True)
+
+        for i in range(3):
+            np.testing.assert_array_equal(replaced[i],looped_interp_bad_pixels(frames[i].copy(),pixel_masks[i]))
+            np.testing.assert_array_equal(shared_mask[i],looped_interp_bad_pixels(frames[i].copy(),pixel_masks[0]))
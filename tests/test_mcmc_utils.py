@@ -0,0 +1,122 @@
+import numpy as np
+import pytest
+
+emcee = pytest.importorskip("emcee")
+mcmc_utils = pytest.importorskip("Tiberius.src.fitting_utils.mcmc_utils")
+
+
+def ar1_chain(nsteps,nwalkers,phi,rng):
+    """An AR(1) chain of shape (nsteps, nwalkers, len(phi)), whose integrated autocorrelation time is (1+phi)/(1-phi)"""
+    chain = np.zeros((nsteps,nwalkers,len(phi)))
+    chain[0] = rng.normal(size=(nwalkers,len(phi)))
+    for t in range(1,nsteps):
+        chain[t] = phi*chain[t-1] + rng.normal(size=(nwalkers,len(phi)))
+    return chain + np.array([5.,-100.,1e3])
+
+
+def test_autocorrelation_time_matches_emcee():
+    rng = np.random.default_rng(2)
+    phi = np.array([0.3,0.7,0.9])
+    chain = ar1_chain(3000,16,phi,rng)
+
+    monitor = mcmc_utils.AutocorrelationMonitor(16,3,check_interval=100,multiple=1e9,max_lag=1000)
+    for nsteps,pos in enumerate(chain,1):
+        monitor.update(pos)
+        if nsteps in [100,700,1500,3000]:
+            tau,measured = monitor.integrated_time()
+            assert np.all(measured)
+            np.testing.assert_allclose(tau,emcee.autocorr.integrated_time(chain[:nsteps],quiet=True),rtol=1e-8)
+
+    # the estimates made every check_interval steps, and one made part way through a block
+    assert monitor.tau_steps == list(range(100,3001,100))
+    np.testing.assert_allclose(monitor.tau_history[-1],emcee.autocorr.integrated_time(chain,quiet=True),rtol=1e-8)
+    np.testing.assert_allclose(monitor.tau_history[-1],(1+phi)/(1-phi),rtol=0.2)
+
+    monitor.update(chain[-1])
+    np.testing.assert_allclose(monitor.integrated_time()[0],emcee.autocorr.integrated_time(np.concatenate((chain,chain[-1:])),quiet=True),rtol=1e-8)
+
+
+def test_converges_after_multiple_autocorrelation_times():
+    rng = np.random.default_rng(3)
+    chain = ar1_chain(2000,10,np.array([0.5,0.5,0.5]),rng)
+
+    monitor = mcmc_utils.AutocorrelationMonitor(10,3,check_interval=50,multiple=100)
+    for pos in chain:
+        if monitor.update(pos):
+            break
+
+    assert monitor.converged
+    assert monitor.nsteps % 50 == 0
+    assert monitor.steps_per_tau >= 100
+    # and hadn't at the previous check
+    assert (monitor.nsteps-50)/np.median(emcee.autocorr.integrated_time(chain[:monitor.nsteps-50],quiet=True)) < 100
+
+
+def gaussian_lnprob(p):
+    return 10-0.5*np.sum((p-np.array([1.,-2.]))**2/np.array([0.1,3.])**2)
+
+
+def looped_text_chain(filename,chain,lnprob,nsteps):
+    """The steps that advance_chain used to append to the text chain file, one line per walker per step"""
+    f = open(filename,'w')
+    for i in range(nsteps):
+        for k in range(chain.shape[1]):
+            if nsteps > 500 and i > nsteps/2. or nsteps < 500 and i > nsteps - 100:
+                f.write("{0:4d} {1:s} {2:f}\n".format(k," ".join(map(str,chain[i,k])),lnprob[i,k]))
+    f.close()
+    return np.loadtxt(filename)
+
+
+@pytest.mark.parametrize("nsteps",[150,600])
+def test_chain_store_matches_text_chain(nsteps,tmp_path):
+    np.random.seed(8)
+    sampler = emcee.EnsembleSampler(8,2,gaussian_lnprob)
+    chain_store = mcmc_utils.ChainStore(str(tmp_path/'prod_chain_wb0001.npy'),8,2,flush_interval=7)
+    mcmc_utils.advance_chain(sampler,np.random.normal(0,0.1,(8,2)),nsteps,chain_store)
+
+    saved = mcmc_utils.load_chain(str(tmp_path/'prod_chain_wb0001.npy'))
+    expected = looped_text_chain(str(tmp_path/'prod_chain_wb0001.txt'),sampler.get_chain(),sampler.get_log_prob(),nsteps)
+
+    assert saved.shape == expected.shape
+    np.testing.assert_array_equal(saved[:,:-1],expected[:,:-1])
+    np.testing.assert_allclose(saved[:,-1],expected[:,-1],atol=1e-6) # the text chains rounded the lnprobability to 6 decimal places
+
+
+def test_chain_store_resume(tmp_path):
+    filename = str(tmp_path/'prod_chain_wb0001.npy')
+    rng = np.random.default_rng(9)
+    positions = rng.normal(size=(30,4,3))
+    probabilities = rng.normal(size=(30,4))
+
+    chain_store = mcmc_utils.ChainStore(filename,4,3,flush_interval=5)
+    chain_store.allocate(25)
+    for pos,prob in zip(positions[:12],probabilities[:12]):
+        chain_store.save_step(pos,prob)
+
+    # the rows allocated beyond the saved steps aren't returned
+    chain_store.flush()
+    assert len(mcmc_utils.load_chain(filename)) == 12*4
+    del chain_store
+
+    # a resumed store continues after the last complete step, growing the file beyond the space first allocated
+    resumed = mcmc_utils.ChainStore(filename,4,3,resume=True)
+    assert resumed.nrows == 12*4
+    np.testing.assert_array_equal(resumed.last_sample(),positions[11])
+    for pos,prob in zip(positions[12:],probabilities[12:]):
+        resumed.save_step(pos,prob)
+    resumed.flush()
+
+    saved = mcmc_utils.load_chain(filename,mmap=False)
+    assert saved.shape == (30*4,5)
+    np.testing.assert_array_equal(saved[:,0],np.tile(np.arange(4),30))
+    np.testing.assert_array_equal(saved[:,1:-1],positions.reshape(-1,3))
+    np.testing.assert_array_equal(saved[:,-1],probabilities.ravel())
+
+    # discarding steps only removes those saved by the resumed run
+    resumed.discard_steps(5)
+    saved = mcmc_utils.load_chain(filename)
+    assert saved.shape == (25*4,5)
+    np.testing.assert_array_equal(saved[:,1:-1],np.concatenate((positions[:12],positions[17:])).reshape(-1,3))
+
+    with pytest.raises(ValueError):
+        mcmc_utils.ChainStore(filename,4,2,resume=True)
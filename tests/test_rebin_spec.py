@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from Tiberius.src.reduction_utils.wavelength_calibration import rebin_spec
+
+
+# a shifted and stretched pixel solution whose first two pixels are negative, and the binflux of
+# Observation(ArraySourceSpectrum(pix[pix>0],flux[pix>0]),ArraySpectralElement(pix[pix>0],1),binset=wavnew,force='taper') from pysynphot 2.0.0
+pix = np.arange(1,13)-2.6+0.01*np.arange(12)**2
+flux = np.array([90.,110,95,105,120,80,100,102,98,97,130,115])
+wavnew = np.arange(1,13.)
+pysynphot_binflux = np.array([100.33355807743656, 112.14953271028037, 103.76192231844294, 86.92185304570626, 99.87559276090249, 101.21826779530589,
+                              98.41670308435525, 98.38151978740214, 118.70692409195081, 122.56198347107438, 81.72660343041409, 9.529327420649608])
+
+
+def test_edge_bins_match_pysynphot():
+    np.testing.assert_allclose(rebin_spec(pix[pix > 0],flux[pix > 0],wavnew),pysynphot_binflux,rtol=1e-12)
+    np.testing.assert_allclose(rebin_spec(pix,flux,wavnew,mask=pix > 0),pysynphot_binflux,rtol=1e-12)
+
+
+def test_stack_matches_single_spectra():
+    rng = np.random.default_rng(1)
+    pixels = np.arange(1,101)[None]+rng.normal(0,2,(5,1))-2
+    fluxes = rng.normal(100,10,(2,5,100))
+    fluxes[0,2,50] = np.nan
+
+    resampled = rebin_spec(pixels,fluxes,np.arange(1,101),mask=pixels > 0)
+
+    for i in range(2):
+        for j in range(5):
+            use = pixels[j] > 0
+            np.testing.assert_allclose(resampled[i,j],rebin_spec(pixels[j][use],fluxes[i,j][use],np.arange(1,101)),rtol=1e-12)
+
+
+def test_matches_pysynphot():
+    pysynphot = pytest.importorskip("pysynphot")
+    from pysynphot import observation, spectrum
+
+    rng = np.random.default_rng(0)
+    for n in [5,40,300]:
+        wave = np.arange(1,n+1)+rng.normal(0,3)+1e-4*(np.arange(n)-n/2)**2/n
+        spec = rng.normal(100,10,n)
+        spec[rng.integers(0,n)] = np.nan
+        use = wave > 0
+
+        obs = observation.Observation(spectrum.ArraySourceSpectrum(wave=wave[use],flux=spec[use]),spectrum.ArraySpectralElement(wave[use],np.ones(use.sum()),waveunits='angstrom'),binset=np.arange(1,n+1.),force='taper')
+
+        np.testing.assert_allclose(rebin_spec(wave,spec,np.arange(1,n+1.),mask=use),obs.binflux,rtol=1e-10,atol=1e-10)
@@ -0,0 +1,171 @@
+import os
+import pickle
+import shutil
+import numpy as np
+import pytest
+from astropy.io import fits
+
+import matplotlib
+matplotlib.use('Agg')
+
+se = pytest.importorskip("spectral_extraction")
+
+
+def synthetic_frame(rng,nrows=120,ncols=250,centre=125.,amplitude=5e3):
+    """A tilted Gaussian trace on a sloped background with Gaussian noise, clear of the 65 buffer pixels at either edge of an EFOSC frame"""
+    x = np.arange(ncols)
+    trace = centre+0.02*np.arange(nrows)
+    return np.array([amplitude*np.exp(-(x-t)**2/(2*2.**2))+200+0.5*x for t in trace])+rng.normal(0,10,(nrows,ncols))
+
+
+def write_efosc_frames(directory,nframes=6):
+    rng = np.random.default_rng(0)
+    science_list = []
+    for i in range(nframes):
+        hdu = fits.PrimaryHDU(synthetic_frame(rng,amplitude=5e3*(1-0.01*i)))
+        hdu.header['MJD-OBS'] = 58000+i/1440.
+        hdu.header['EXPTIME'] = 30.
+        hdu.header['HIERARCH ESO TEL AIRM START'] = 1.1+0.01*i
+        science_list.append(os.path.join(directory,'EFOSC_Spectrum_%d.fits'%i))
+        hdu.writeto(science_list[-1])
+    return science_list
+
+
+def extract(science_list,directory,nworkers,verbose=0,checkpoint_interval=0):
+    trace_dict = {'guess_locations':[125],'search_width':[20],'gaussian_width':5,'trace_poly_order':2,'trace_spline_sf':0,'co_add_rows':0}
+    window_dict = {'instrument':'EFOSC','nwindows':1,'row_min':0,'row_max':120,'readout_speed':'fast','rotate_frame':False}
+    extraction_dict = {'aperture_width':[10],'background_offset':[5],'background_width':[10],'poly_bg_order':[1],'nstars':1,'masks':{'mask1':None},
+                       'ACAM_linearity_correction':False,'gaussian_defined_aperture':False,'NIRSPEC_order':None,'use_lacosmic':False,'rectify_frame':False}
+    if not os.path.isdir(directory):
+        os.mkdir(directory)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        se.extract_all_frame_fluxes(science_list,None,None,trace_dict,window_dict,extraction_dict,verbose=verbose,nworkers=nworkers,checkpoint_interval=checkpoint_interval)
+        return {f:pickle.load(open(os.path.join('pickled_objects',f),'rb')) for f in sorted(os.listdir('pickled_objects')) if f.endswith('.pickle')}
+    finally:
+        os.chdir(cwd)
+
+
+def test_parallel_extraction_matches_serial(tmp_path,monkeypatch):
+    science_list = write_efosc_frames(str(tmp_path))
+
+    serial = extract(science_list,str(tmp_path/'serial'),1)
+    parallel = extract(science_list,str(tmp_path/'parallel'),2)
+
+    assert sorted(serial) == sorted(parallel)
+    assert serial['star1_flux.pickle'].shape == (6,120)
+    assert np.all(serial['star1_flux.pickle'] > 0)
+    for name in serial:
+        np.testing.assert_array_equal(parallel[name],serial[name],err_msg=name)
+
+    # a serial extraction that plots extracts the rows one at a time, which agrees to within rounding
+    monkeypatch.setattr(se.plt,'show',lambda *args,**kwargs: None)
+    monkeypatch.setattr(se.plt,'pause',lambda *args,**kwargs: None)
+    plotted = extract(science_list,str(tmp_path/'plotted'),1,verbose=1)
+    for name in serial:
+        np.testing.assert_allclose(plotted[name],parallel[name],rtol=1e-8,atol=1e-8,err_msg=name)
+
+
+def sloped_frame(rng,nrows=200,ncols=300,keck=False):
+    """A curved trace on a quadratic background with hot pixels, NaNs (including within the aperture) and, for Keck/NIRSPEC, bright edge columns"""
+    x = np.arange(ncols)
+    trace = 150+5*np.sin(np.arange(nrows)/40)
+    frame = 100+0.3*x[None]+2e-3*(x[None]-150)**2+3000*np.exp(-0.5*((x[None]-trace[:,None])/3)**2)+rng.normal(0,5,(nrows,ncols))
+    frame[rng.integers(0,nrows,30),rng.integers(0,ncols,30)] += 2000
+    frame[rng.integers(0,nrows,15),rng.integers(0,ncols,15)] = np.nan
+    frame[10,int(np.round(trace[10]))-5] = np.nan
+    frame[11,int(np.round(trace[11]))] = np.nan
+    if keck:
+        frame[::7,0] = 5000
+        frame[::9,-1] = 5000
+        frame[:,170:174] = 0
+    return frame,trace
+
+
+@pytest.mark.parametrize("options",[dict(),dict(poly_bg_order=-2),dict(poly_bg_order=-2,background_width=1),dict(co_add_rows=5),dict(co_add_rows=4,poly_bg_order=-1),
+                                    dict(instrument='Keck/NIRSPEC',background_width=1),dict(instrument='Keck/NIRSPEC',poly_bg_order=-2,co_add_rows=3),
+                                    dict(instrument='ACAM',mask=np.array([-20,-19,15]),poly_bg_order=1),dict(instrument='JWST/NIRSpec',poly_bg_order=1)])
+def test_batched_rows_match_row_loop(options,tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(se.plt,'show',lambda *args,**kwargs: None)
+    monkeypatch.setattr(se.plt,'pause',lambda *args,**kwargs: None)
+
+    arguments = dict(aperture_width=10,background_offset=3,background_width=20,poly_bg_order=2,am=1.2,exposure_time=30,star=0,mask=None,instrument='EFOSC',
+                     row_min=0,gauss_std=None,readout_speed='fast',co_add_rows=0,rectify_frame=False,oversampling_factor=1,gain_file=None,readnoise_file=None)
+    arguments.update(options)
+
+    frame,trace = sloped_frame(np.random.default_rng(3),keck=arguments['instrument'] == 'Keck/NIRSPEC')
+    pre_flat_frame = 0.99*frame
+    if "JWST" in arguments['instrument']:
+        frame = np.array([frame,np.sqrt(np.abs(frame))])
+
+    # verbose = 1 plots the rows as they're extracted, so these go through the row-by-row loop
+    looped = se.extract_trace_flux(frame.copy(),trace,verbose=1,pre_flat_frame=pre_flat_frame,**arguments)
+    se.plt.close('all')
+    batched = se.extract_trace_flux(frame.copy(),trace,verbose=False,pre_flat_frame=pre_flat_frame,**arguments)
+
+    assert len(batched) == len(looped)
+    for i,(b,l) in enumerate(zip(batched,looped)):
+        np.testing.assert_allclose(np.asarray(b,float),np.asarray(l,float),rtol=1e-7,atol=1e-6,equal_nan=True,err_msg="output %d"%i)
+
+
+def frame_output(rng,nrows,m1temp=None):
+    """A frame output as returned by extract_frame, with two stars extracted"""
+    stars = [(rng.normal(100,1,nrows),rng.normal(5,0.1,nrows),tuple(rng.normal(size=nrows) for j in range(3))) for star in range(2)]
+    return {'obs_time':rng.random(),'exposure_time':30.,'airmass':1+rng.random(),'m1temp':m1temp,'cosmic_pixels':None,'stars':stars}
+
+
+def test_checkpoint_round_trip(tmp_path):
+    pytest.importorskip("h5netcdf")
+    rng = np.random.default_rng(7)
+    science_list = ['frame%d.fits'%i for i in range(5)]
+    checkpoint_file = str(tmp_path/'extraction_checkpoint.h5')
+    frame_outputs = [frame_output(rng,50,m1temp=10.+i) for i in range(5)]
+
+    assert se.load_checkpoint(checkpoint_file,science_list) == []
+
+    # appended in two parts, as the extraction does every checkpoint_interval frames
+    se.save_checkpoint(checkpoint_file,frame_outputs[:3],0,science_list)
+    se.save_checkpoint(checkpoint_file,frame_outputs[3:],3,science_list)
+    loaded = se.load_checkpoint(checkpoint_file,science_list)
+
+    assert len(loaded) == 5
+    for saved,reloaded in zip(frame_outputs,loaded):
+        for key in ['obs_time','exposure_time','airmass','m1temp','cosmic_pixels']:
+            assert reloaded[key] == saved[key]
+        assert len(reloaded['stars']) == 2
+        for (trace,fwhm,extracted_arrays),(saved_trace,saved_fwhm,saved_arrays) in zip(reloaded['stars'],saved['stars']):
+            np.testing.assert_array_equal(trace,saved_trace)
+            np.testing.assert_array_equal(fwhm,saved_fwhm)
+            assert len(extracted_arrays) == 3
+            for array,saved_array in zip(extracted_arrays,saved_arrays):
+                np.testing.assert_array_equal(array,saved_array)
+
+    with pytest.raises(ValueError):
+        se.load_checkpoint(checkpoint_file,science_list[1:])
+
+
+def test_resumed_extraction_matches_uninterrupted(tmp_path):
+    h5netcdf = pytest.importorskip("h5netcdf")
+    science_list = write_efosc_frames(str(tmp_path),nframes=25)
+
+    uninterrupted = extract(science_list,str(tmp_path/'uninterrupted'),1,checkpoint_interval=20)
+
+    # roll the checkpoint back to the first 20 frames, as if the extraction had been interrupted after saving them
+    directory = str(tmp_path/'interrupted')
+    os.makedirs(os.path.join(directory,'pickled_objects'))
+    checkpoint_file = os.path.join(directory,'pickled_objects','extraction_checkpoint.h5')
+    shutil.copyfile(os.path.join(str(tmp_path),'uninterrupted','pickled_objects','extraction_checkpoint.h5'),checkpoint_file)
+    with h5netcdf.File(checkpoint_file,'a',invalid_netcdf=True) as store:
+        assert int(store.attrs['nframes_complete']) == 25
+        store.attrs['nframes_complete'] = 20
+
+    resumed = extract(science_list,directory,1,checkpoint_interval=20)
+
+    # only the last 5 frames were extracted again
+    assert len(open(os.path.join(directory,'reduction_output.log')).readlines()) == 5
+
+    assert sorted(resumed) == sorted(uninterrupted)
+    for name in uninterrupted:
+        np.testing.assert_array_equal(resumed[name],uninterrupted[name],err_msg=name)
@@ -0,0 +1,163 @@
+import numpy as np
+import pytest
+from scipy import signal
+from Tiberius.src.reduction_utils import wavelength_binning as wb
+
+
+def looped_wvl_bin_data(flux1,err1,flux2,err2,wvl_solution,bins,ancillary_data,weighted=False,n_tukey_points=0,wvl_solution_2=None):
+    """The frame-by-frame, bin-by-bin loop that wvl_bin_data replaced, returning its outputs with shape (nframes, nbins)"""
+
+    def window(values,npoints):
+        if n_tukey_points == 0:
+            return values
+        dummy = np.zeros(npoints+2)
+        dummy[1:-1] = values
+        return (dummy*signal.windows.tukey(npoints+2,float(n_tukey_points)/npoints))[1:-1]
+
+    def bin_star(flux,err,idx):
+        npoints = len(np.where(flux[idx])[0])
+        bin_vals = window(flux[idx],npoints)
+        bin_e_vals = window(err[idx],npoints)
+        if weighted:
+            weights = 1.0/bin_e_vals**2
+            binned = [np.sum(weights*bin_vals)/np.sum(weights),np.sqrt(1.0/np.sum(weights))]
+        else:
+            binned = [np.nansum(bin_vals),np.sqrt(np.nansum(bin_e_vals**2))]
+        return binned + [np.mean(1/np.sqrt(flux[idx])),np.sqrt(bin_vals).mean()]
+
+    names = ['flux1','err1','photon_noise1','SN1','flux2','err2','photon_noise2','SN2']+list(ancillary_data.keys())
+    outputs = {name:np.zeros((len(flux1),len(bins)-1)) for name in names}
+    wvl_solution = np.ones_like(flux1)*wvl_solution
+    if wvl_solution_2 is not None:
+        wvl_solution_2 = np.ones_like(flux2)*wvl_solution_2
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        for i in range(len(flux1)):
+            for j in range(len(bins)-1):
+                idx = (wvl_solution[i] >= bins[j]) & (wvl_solution[i] < bins[j+1])
+                idx2 = idx if wvl_solution_2 is None else (wvl_solution_2[i] >= bins[j]) & (wvl_solution_2[i] < bins[j+1])
+                binned = bin_star(flux1[i],err1[i],idx)
+                if flux2 is not None:
+                    binned += bin_star(flux2[i],err2[i],idx2)
+                for name,value in zip(names,binned):
+                    outputs[name][i,j] = value
+                for k in ancillary_data.keys():
+                    outputs[k][i,j] = wb.nan_mean(window(ancillary_data[k][i][idx],len(np.where(flux1[i][idx])[0])))
+
+    for k in ancillary_data.keys():
+        outputs[k] = (outputs[k]-outputs[k].mean(axis=0))/outputs[k].std(axis=0)
+
+    return outputs
+
+
+def spectra(rng,nframes=6,npixels=200,nans=True):
+    flux1 = rng.normal(1e4,100,(nframes,npixels))
+    flux2 = rng.normal(2e4,150,(nframes,npixels))
+    if nans:
+        flux1[2,40] = np.nan
+        flux2[4,150] = np.nan
+    ancillary_data = {'xpos':rng.normal(0,1,(nframes,npixels)),'sky':rng.normal(100,5,(nframes,npixels))}
+    ancillary_data['sky'][1,100] = np.nan
+    return flux1,np.sqrt(np.abs(flux1)),flux2,np.sqrt(np.abs(flux2)),ancillary_data
+
+
+def compare(binned_outputs,expected,single_star=False):
+    if single_star:
+        flux_ratio,err_ratio,ancillary_data_norm,photon_noise1,SN1 = binned_outputs
+        np.testing.assert_allclose(flux_ratio.T,expected['flux1'],rtol=1e-10,equal_nan=True)
+        np.testing.assert_allclose(err_ratio.T,expected['err1'],rtol=1e-10,equal_nan=True)
+    else:
+        flux_ratio,err_ratio,flux1,err1,flux2,err2,ancillary_data_norm,photon_noise1,photon_noise2,SN1,SN2 = binned_outputs
+        for name,binned in [('flux1',flux1),('err1',err1),('flux2',flux2),('err2',err2),('photon_noise2',photon_noise2),('SN2',SN2)]:
+            np.testing.assert_allclose(binned.T,expected[name],rtol=1e-10,equal_nan=True,err_msg=name)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            np.testing.assert_allclose(flux_ratio.T,expected['flux1']/expected['flux2'],rtol=1e-10,equal_nan=True)
+
+    np.testing.assert_allclose(photon_noise1.T,expected['photon_noise1'],rtol=1e-10,equal_nan=True)
+    np.testing.assert_allclose(SN1.T,expected['SN1'],rtol=1e-10,equal_nan=True)
+    for k,binned in ancillary_data_norm.items():
+        np.testing.assert_allclose(binned,expected[k].T,rtol=1e-8,atol=1e-10,equal_nan=True,err_msg=k)
+
+
+wavelengths = 4000+5*np.arange(200.)
+bins_with_empty_bin = np.array([4010,4100,4101,4104,4300,4557,4800,4990])
+bins = np.array([4010,4100,4103,4300,4557,4800,4990])
+
+
+@pytest.mark.parametrize("weighted",[False,True])
+@pytest.mark.parametrize("n_tukey_points",[0,3])
+@pytest.mark.parametrize("single_star",[False,True])
+def test_shared_wavelength_solution_matches_loop(weighted,n_tukey_points,single_star):
+    flux1,err1,flux2,err2,ancillary_data = spectra(np.random.default_rng(10))
+    if single_star:
+        flux2 = err2 = None
+    bin_edges = bins if n_tukey_points else bins_with_empty_bin
+
+    expected = looped_wvl_bin_data(flux1,err1,flux2,err2,wavelengths,bin_edges,ancillary_data,weighted,n_tukey_points)
+
+    # a 1D solution, and the same solution repeated for every frame
+    compare(wb.wvl_bin_data(flux1,err1,flux2,err2,wavelengths,bin_edges,ancillary_data,weighted,n_tukey_points),expected,single_star)
+    compare(wb.wvl_bin_data(flux1,err1,flux2,err2,np.tile(wavelengths,(6,1)),bin_edges,ancillary_data,weighted,n_tukey_points),expected,single_star)
+
+
+@pytest.mark.parametrize("n_tukey_points",[0,3])
+def test_separate_solution_for_each_star_matches_loop(n_tukey_points):
+    flux1,err1,flux2,err2,ancillary_data = spectra(np.random.default_rng(11))
+    wavelengths_2 = wavelengths[::-1].copy() # a reversed (non-monotonic increasing) solution, so the pixels of the bins can't be sliced
+
+    expected = looped_wvl_bin_data(flux1,err1,flux2,err2,wavelengths,bins,ancillary_data,False,n_tukey_points,wavelengths_2)
+    compare(wb.wvl_bin_data(flux1,err1,flux2,err2,wavelengths,bins,ancillary_data,False,n_tukey_points,wavelengths_2),expected)
+
+
+def test_tukey_weights_match_scipy():
+    for npoints in [1,2,5,17]:
+        for n_tukey_points in [1,3]:
+            np.testing.assert_allclose(wb.tukey_weights(npoints,n_tukey_points),signal.windows.tukey(npoints+2,float(n_tukey_points)/npoints)[1:-1],rtol=1e-15)
+
+    # the weights are cached, so can't be modified by the caller
+    assert wb.tukey_weights(5,3) is wb.tukey_weights(5,3)
+    assert not wb.tukey_weights(5,3).flags.writeable
+
+
+# a separate wavelength solution for each frame, shifted by a fraction of a pixel so that the pixels move between bins
+shifted_wavelengths = wavelengths+0.4*np.arange(6)[:,None]
+
+
+@pytest.mark.parametrize("weighted",[False,True])
+@pytest.mark.parametrize("n_tukey_points",[0,3])
+@pytest.mark.parametrize("single_star",[False,True])
+def test_separate_solution_for_each_frame_matches_loop(weighted,n_tukey_points,single_star):
+    flux1,err1,flux2,err2,ancillary_data = spectra(np.random.default_rng(12))
+    if single_star:
+        flux2 = err2 = None
+    bin_edges = bins if n_tukey_points else bins_with_empty_bin
+
+    expected = looped_wvl_bin_data(flux1,err1,flux2,err2,shifted_wavelengths,bin_edges,ancillary_data,weighted,n_tukey_points)
+    compare(wb.wvl_bin_data(flux1,err1,flux2,err2,shifted_wavelengths,bin_edges,ancillary_data,weighted,n_tukey_points),expected,single_star)
+
+    if not single_star:
+        # a separate solution for each frame and star, with a shared solution for the comparison
+        expected = looped_wvl_bin_data(flux1,err1,flux2,err2,shifted_wavelengths,bin_edges,ancillary_data,weighted,n_tukey_points,wavelengths)
+        compare(wb.wvl_bin_data(flux1,err1,flux2,err2,shifted_wavelengths,bin_edges,ancillary_data,weighted,n_tukey_points,wavelengths),expected)
+
+
+@pytest.mark.parametrize("weighted",[False,True])
+@pytest.mark.parametrize("n_tukey_points",[0,3])
+def test_different_and_individual_wvl_solutions_match_loop(weighted,n_tukey_points):
+    # these sum without ignoring NaNs, as their loops did, so are compared on finite spectra
+    flux1,err1,flux2,err2,ancillary_data = spectra(np.random.default_rng(13),nans=False)
+    ancillary_data['sky'][1,100] = 100.
+    xpos,sky = ancillary_data['xpos'],ancillary_data['sky']
+    shifted_wavelengths_2 = shifted_wavelengths[::-1]
+
+    for binned,expected in [(wb.wvl_bin_data_different_wvl_solutions(flux1,err1,flux2,err2,shifted_wavelengths,bins,xpos,sky,weighted,n_tukey_points),
+                             looped_wvl_bin_data(flux1,err1,flux2,err2,shifted_wavelengths,bins,ancillary_data,weighted,n_tukey_points)),
+                            (wb.wvl_bin_data_indivdual_wvl_solutions(flux1,err1,flux2,err2,shifted_wavelengths,shifted_wavelengths_2,bins,xpos,sky,weighted,n_tukey_points),
+                             looped_wvl_bin_data(flux1,err1,flux2,err2,shifted_wavelengths,bins,ancillary_data,weighted,n_tukey_points,shifted_wavelengths_2))]:
+
+        flux_ratio,err_ratio,binned_flux1,binned_err1,binned_flux2,binned_err2,XPOS_norm,SKY_norm,photon_noise1,photon_noise2 = binned
+        for name,values in [('flux1',binned_flux1),('err1',binned_err1),('flux2',binned_flux2),('err2',binned_err2),('photon_noise1',photon_noise1),('photon_noise2',photon_noise2)]:
+            np.testing.assert_allclose(values.T,expected[name],rtol=1e-10,err_msg=name)
+        np.testing.assert_allclose(flux_ratio.T,expected['flux1']/expected['flux2'],rtol=1e-10)
+        np.testing.assert_allclose(XPOS_norm,expected['xpos'].T,rtol=1e-8,atol=1e-10)
+        np.testing.assert_allclose(SKY_norm,expected['sky'].T,rtol=1e-8,atol=1e-10)